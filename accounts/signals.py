@@ -0,0 +1,13 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from accounts.models import CustomUser
+from accounts.usercache import user_cache
+
+
+# Password changes, profile updates and deactivations are all saves; each
+# one makes every process reload the user on its next request.
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def bump_user_version(sender, instance, **kwargs):
+    user_cache.bump(instance.pk)
@@ -1,3 +1,52 @@
 from django.test import TestCase
 
 # Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.urls import reverse
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from accounts.usercache import UserCache, user_cache
+
+User = get_user_model()
+
+
+class UserCacheTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        user_cache.clear()
+        self.user = User.objects.create_user(email='cached@example.com', password='oldpassword', username='cached')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+
+    def change_password(self):
+        return self.client.post(reverse('change_password'), {
+            'old_password': 'oldpassword', 'new_password': 'newpassword', 'confirm_new_password': 'newpassword',
+        })
+
+    def test_authenticated_requests_skip_the_user_query(self):
+        url = reverse('notification-unread-count')
+        self.client.get(url)
+        self.assertEqual(user_cache.stats()['misses'], 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(user_cache.stats()['hits'], 1)
+
+    def test_changes_reload_the_user(self):
+        self.assertEqual(self.change_password().status_code, 200)
+        # The view saved the password on its own copy; the next request
+        # must see it.
+        self.assertEqual(self.change_password().status_code, 400)
+        self.assertEqual(user_cache.stats()['misses'], 2)
+
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertEqual(self.client.get(reverse('update_profile')).status_code, 200)
+        user_cache.bump(self.user.pk)
+        self.assertEqual(self.client.get(reverse('update_profile')).status_code, 401)
+
+    def test_size_is_bounded(self):
+        small = UserCache(max_size=2, ttl=60)
+        for i in range(3):
+            small.get_or_load(i, lambda: self.user)
+        small.get_or_load(2, lambda: self.user)
+        self.assertEqual(small.stats(), {'size': 2, 'hits': 1, 'misses': 3, 'evictions': 1})
@@ -0,0 +1,105 @@
+"""
+Per-process cache of the users that requests authenticate as.
+
+Entries are keyed by user id and remember the user's version, a counter
+kept in Django's cache under ``user-version:<id>``. Saving or deleting a
+user bumps it (see accounts/signals.py): a password change, a profile
+update, a deactivation. Every process then reloads that user on its next
+request, as long as CACHES points at a shared backend; with the default
+per-process LocMemCache, other processes notice within USER_CACHE["TTL"]
+seconds. Code that changes users with QuerySet.update() must call bump()
+itself.
+
+At most USER_CACHE["MAX_SIZE"] users are kept, least recently used dropped
+first. stats() reports hits, misses and evictions.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def version_key(user_id):
+    return f"user-version:{user_id}"
+
+
+def new_version():
+    # Versions start from the clock rather than from zero, so a counter
+    # that was evicted from the cache does not repeat an old value.
+    return time.time_ns()
+
+
+class UserCache:
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # user id -> (version, expires at, user)
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_load(self, user_id, load):
+        """
+        Returns a copy of the cached user `user_id`, calling `load()` for a
+        fresh one when the cached one is missing, expired or out of date.
+        """
+        key = str(user_id)
+        version = cache.get(version_key(key))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and version is not None and entry[0] == version and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.copy(entry[2])
+            self.misses += 1
+
+        user = load()
+        if version is None:
+            cache.add(version_key(key), new_version(), None)
+            version = cache.get(version_key(key))
+        self.put(key, version, user)
+        return copy.copy(user)
+
+    def put(self, key, version, user):
+        ttl = self.ttl if self.ttl is not None else settings.USER_CACHE["TTL"]
+        max_size = self.max_size if self.max_size is not None else settings.USER_CACHE["MAX_SIZE"]
+        with self._lock:
+            self._entries[key] = (version, time.monotonic() + ttl, user)
+            self._entries.move_to_end(key)
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def bump(self, user_id):
+        """
+        Marks every process's cached copy of `user_id` out of date.
+        """
+        key = str(user_id)
+        try:
+            cache.incr(version_key(key))
+        except ValueError:
+            cache.set(version_key(key), new_version(), None)
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+user_cache = UserCache()
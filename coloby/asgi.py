@@ -5,14 +5,19 @@ from channels.routing import ProtocolTypeRouter, URLRouter
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'coloby.settings')
 
+# Set up Django before the consumers import any models.
+django_asgi_app = get_asgi_application()
+
 from cowork import routing
+from cowork.sendqueue import BackpressureMiddleware
 
 
 application = ProtocolTypeRouter({
-    'http': get_asgi_application(),
-    "websocket":AuthMiddlewareStack(
+    'http': django_asgi_app,
+    # Outermost, so it sees daphne's own send callable.
+    "websocket": BackpressureMiddleware(AuthMiddlewareStack(
         URLRouter(
             routing.websocket_urlpatterns
         )
-    )
+    ))
 })
@@ -59,6 +59,10 @@ INSTALLED_APPS = [
 SESSION_EXPIRE_AT_BROWSER_CLOSE = False
 
 MIDDLEWARE = [
+    # First, so its timings cover every other middleware.
+    "cowork.metrics.MetricsMiddleware",
+    # Outside the session middleware, so session writes count as writes.
+    "cowork.replicas.ReplicaMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -69,12 +73,16 @@ MIDDLEWARE = [
 
     "corsheaders.middleware.CorsMiddleware",
     'accounts.middleware.TokenMiddleware',
-    "debug_toolbar.middleware.DebugToolbarMiddleware",
 
     # Add the account middleware:
     # "allauth.account.middleware.AccountMiddleware",
 ]
 
+# The debug toolbar is far too slow to run under load; development only.
+if DEBUG:
+    INSTALLED_APPS += ["debug_toolbar"]
+    MIDDLEWARE += ["debug_toolbar.middleware.DebugToolbarMiddleware"]
+
 ROOT_URLCONF = "coloby.urls"
 
 TEMPLATES = [
@@ -110,6 +118,127 @@ DATABASES = {
 database_url = config("DATABASE_URL")
 DATABASES["default"] = dj_database_url.parse(database_url)
 
+# Read replicas, as a comma-separated DATABASE_REPLICA_URLS, serve the GET
+# requests of the read-only API views (see cowork/replicas.py). Whoever
+# writes reads from the primary for the next STICKY_SECONDS; replicas are
+# checked every CHECK_INTERVAL seconds and skipped while they are more than
+# MAX_LAG seconds behind. A PostgreSQL replica that does not answer within
+# CONNECT_TIMEOUT seconds counts as down. Tests run the replicas on the test
+# database; coloby/test_settings.py adds one when none is configured.
+REPLICAS = {
+    "ALIASES": [],
+    "STICKY_SECONDS": 5,
+    "MAX_LAG": config('REPLICA_MAX_LAG', default=10, cast=float),
+    "CHECK_INTERVAL": 15,
+    "CONNECT_TIMEOUT": config('REPLICA_CONNECT_TIMEOUT', default=2, cast=int),
+}
+for i, replica_url in enumerate(filter(None, config("DATABASE_REPLICA_URLS", default="").split(","))):
+    DATABASES[f"replica{i + 1}"] = dj_database_url.parse(replica_url.strip())
+    DATABASES[f"replica{i + 1}"]["TEST"] = {"MIRROR": "default"}
+    REPLICAS["ALIASES"].append(f"replica{i + 1}")
+for alias in REPLICAS["ALIASES"]:
+    if DATABASES[alias]["ENGINE"] == "django.db.backends.postgresql":
+        DATABASES[alias].setdefault("OPTIONS", {}).setdefault("connect_timeout", REPLICAS["CONNECT_TIMEOUT"])
+
+DATABASE_ROUTERS = ["cowork.replicas.ReplicaRouter"]
+
+
+# The default is per process; deployments with several workers should point
+# this at a shared cache such as memcached so invalidations reach them all.
+CACHES = {
+    "default": {
+        "BACKEND": config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        "LOCATION": config('CACHE_LOCATION', default='coloby'),
+    }
+}
+
+# The userdata endpoint serves per-user summaries kept in the cache and
+# dropped section by section when the rows behind them change. TIMEOUT
+# bounds how long a missed invalidation can go unnoticed.
+DASHBOARD = {
+    "TIMEOUT": 60 * 60,
+}
+
+# Full-text search (cowork/search.py). Pages hold PAGE_SIZE results unless
+# the client asks for another ?limit=, which is capped at MAX_PAGE_SIZE.
+SEARCH = {
+    "PAGE_SIZE": 25,
+    "MAX_PAGE_SIZE": 100,
+}
+
+# Notification lists are paged newest first; ?limit= is capped at
+# MAX_PAGE_SIZE.
+NOTIFICATIONS = {
+    "PAGE_SIZE": 50,
+    "MAX_PAGE_SIZE": 200,
+}
+
+# New notifications are delivered to each member's inbox after the writing
+# transaction commits, CHUNK_SIZE recipients per bulk insert, on a background
+# thread (or inline once committed, with BACKGROUND off). A delivery that has
+# held a notification for CLAIM_TIMEOUT seconds is presumed dead; one that
+# failed MAX_ATTEMPTS times is given up on.
+NOTIFICATION_FANOUT = {
+    "CHUNK_SIZE": 1000,
+    "BACKGROUND": config('NOTIFICATION_FANOUT_BACKGROUND', default=True, cast=bool),
+    "CLAIM_TIMEOUT": 10 * 60,
+    "MAX_ATTEMPTS": 5,
+}
+
+# Room name autocomplete (cowork/autocomplete.py) is served from an index in
+# each process, rebuilt in the background once it is MAX_AGE seconds old to
+# pick up writes made by other processes.
+AUTOCOMPLETE = {
+    "MAX_RESULTS": 10,
+    "MAX_AGE": 10 * 60,
+}
+
+# Transactional email goes through the outbox (cowork/outbox.py). A failed
+# message is retried after RETRY_BACKOFF seconds, doubling per attempt up to
+# MAX_BACKOFF, MAX_ATTEMPTS times in all. With SEND_ON_COMMIT each process
+# sends what it queued from a background thread; without it only
+# `manage.py send_outbox` sends.
+EMAIL_OUTBOX = {
+    "BATCH_SIZE": 100,
+    "MAX_ATTEMPTS": 6,
+    "RETRY_BACKOFF": 30,
+    "MAX_BACKOFF": 60 * 60,
+    # How long a sender may hold claimed messages before another may retry
+    # them.
+    "CLAIM_SECONDS": 5 * 60,
+    "SEND_ON_COMMIT": config('EMAIL_OUTBOX_SEND_ON_COMMIT', default=True, cast=bool),
+}
+
+# With ENABLED, task and comment emails are collected into one digest per
+# recipient, sent WINDOW seconds after its first entry, with repeats about
+# the same task merged.
+EMAIL_DIGEST = {
+    "ENABLED": config('EMAIL_DIGEST_ENABLED', default=False, cast=bool),
+    "WINDOW": 15 * 60,
+}
+
+# Verified API keys are cached in each process for up to CACHE_TTL seconds,
+# at most CACHE_SIZE of them (cowork/apikeys.py).
+API_KEYS = {
+    "CACHE_TTL": 60,
+    "CACHE_SIZE": 10000,
+}
+
+# Request and WebSocket metrics (cowork/metrics.py), scraped from
+# /api/v1/metrics/ with `Authorization: Bearer <TOKEN>`. BUCKETS are the
+# latency histogram bounds, in seconds.
+METRICS = {
+    "TOKEN": config('METRICS_TOKEN', default=''),
+    "BUCKETS": (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+}
+
+# Users authenticated by JWT are cached in each process (accounts/usercache.py),
+# at most MAX_SIZE of them, each for up to TTL seconds unless changed sooner.
+USER_CACHE = {
+    "MAX_SIZE": 10000,
+    "TTL": 5 * 60,
+}
+
 
 
 # AUTH_PASSWORD_VALIDATORS = [
@@ -149,10 +278,88 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
-CHANNEL_LAYERS = {
-    'default': {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",
+# Space separated broker addresses, e.g. "unix:///tmp/coloby-channels.sock" or
+# "tcp://10.0.0.5:7400 tcp://10.0.0.6:7400". Start each with `manage.py runchannelbroker`.
+# Leave empty to keep everything in a single process.
+CHANNEL_BROKER_HOSTS = config('CHANNEL_BROKER_HOSTS', default='')
+
+if CHANNEL_BROKER_HOSTS:
+    CHANNEL_LAYERS = {
+        'default': {
+            "BACKEND": "cowork.layers.BrokerChannelLayer",
+            "CONFIG": {
+                "hosts": CHANNEL_BROKER_HOSTS.split(),
+            },
+        }
     }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        }
+    }
+
+# ORM calls made by the WebSocket consumers run on this many dedicated threads,
+# each keeping its own database connection.
+CONSUMER_DB_EXECUTOR = {
+    "MAX_WORKERS": config('CONSUMER_DB_WORKERS', default=8, cast=int),
+}
+
+# ChatConsumer broadcasts messages first and saves them in batches of up to
+# MAX_BATCH rows, or every FLUSH_INTERVAL_MS. DURABILITY decides when the
+# sender gets its ack: "broadcast" (as soon as the room has it) or "persist"
+# (once the row has been written).
+CHAT_MESSAGE_BUFFER = {
+    "MAX_BATCH": 100,
+    "FLUSH_INTERVAL_MS": 50,
+    "MAX_PENDING": 5000,
+    "DURABILITY": config('CHAT_MESSAGE_DURABILITY', default='broadcast'),
+}
+
+# NotificationConsumer events are written the same way, one buffer per event
+# type (see cowork/notifications.py).
+NOTIFICATION_EVENT_BUFFER = {
+    "MAX_BATCH": 100,
+    "FLUSH_INTERVAL_MS": 50,
+    "MAX_PENDING": 5000,
+}
+
+# Chat history is paged over the socket with {"type": "history", "before": <cursor>, "limit": n}.
+CHAT_HISTORY = {
+    "PAGE_SIZE": 50,
+    "MAX_PAGE_SIZE": 200,
+}
+
+# Messages older than RETENTION_DAYS are moved out of the Message table into
+# one gzipped NDJSON file per room and month under MEDIA_ROOT/archive by
+# `manage.py archive_messages`. History paging reads them back, keeping the
+# last CACHE_SIZE files it opened decoded in memory.
+CHAT_ARCHIVE = {
+    "RETENTION_DAYS": config('CHAT_ARCHIVE_RETENTION_DAYS', default=180, cast=int),
+    "CACHE_SIZE": 16,
+}
+
+# Online presence per room. Clients send {"type": "heartbeat"} frames and are
+# shown as away after TTL seconds without one; joins and leaves are batched
+# into one diff per room every BROADCAST_INTERVAL seconds.
+PRESENCE = {
+    "TTL": 60,
+    "BROADCAST_INTERVAL": 1.0,
+}
+
+# The multiplexed socket at ws/ carries at most MAX_SUBSCRIPTIONS room streams.
+MULTIPLEX_SOCKET = {
+    "MAX_SUBSCRIPTIONS": 100,
+}
+
+# Each WebSocket connection queues at most MAX_SIZE outbound frames for its
+# client. POLICY is "drop_oldest", "coalesce" or "disconnect"; with the first
+# two a client is closed once DISCONNECT_AFTER frames have been dropped
+# (0 never closes it).
+WEBSOCKET_SEND_QUEUE = {
+    "MAX_SIZE": config('WEBSOCKET_SEND_QUEUE_SIZE', default=256, cast=int),
+    "POLICY": config('WEBSOCKET_SEND_QUEUE_POLICY', default='coalesce'),
+    "DISCONNECT_AFTER": 1000,
 }
 
 
@@ -166,7 +373,7 @@ AUTHENTICATION_BACKENDS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'accounts.authentication.CachedJWTAuthentication',
         'rest_framework.authentication.TokenAuthentication',
     ],
 }
@@ -266,4 +473,6 @@ EMAIL_PORT = 587
 EMAIL_HOST_USER = config('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD')
 EMAIL_USE_TLS = True
-EMAIL_USE_SSL = False
\ No newline at end of file
+EMAIL_USE_SSL = False
+# Keeps a stalled SMTP server from holding the outbox sender forever.
+EMAIL_TIMEOUT = 30
\ No newline at end of file
@@ -0,0 +1,14 @@
+"""
+Settings for running the tests:
+
+    python manage.py test --settings=coloby.test_settings
+
+Without DATABASE_REPLICA_URLS, reads are routed to a replica that mirrors the
+test database, so the replica routing is tested without a second server.
+"""
+from coloby.settings import *  # noqa: F401,F403
+from coloby.settings import DATABASES, REPLICAS
+
+if not REPLICAS["ALIASES"]:
+    DATABASES["replica1"] = {**DATABASES["default"], "TEST": {"MIRROR": "default"}}
+    REPLICAS["ALIASES"].append("replica1")
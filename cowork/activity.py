@@ -0,0 +1,67 @@
+"""
+The room-wide notifications, and emails, that new messages and tasks make.
+
+Rows saved one at a time get here from post_save (see cowork/signals.py).
+Rows a WriteBehindBuffer inserts in bulk send no signals and get here from
+its on_write hook, rows_written() in cowork/notifications.py. Either way
+this runs in the transaction that wrote the rows; the notifications are
+delivered (cowork/fanout.py) and the emails sent (cowork/outbox.py) once it
+commits.
+"""
+from django.conf import settings
+
+from accounts.models import CustomUser
+from cowork import outbox
+from cowork.fanout import fanout
+from cowork.models import Notification, Room
+
+
+def by_pk(rows):
+    # Ids on unsaved rows may still be strings, as they came off a socket.
+    return {str(pk): value for pk, value in rows}
+
+
+def messages_posted(messages):
+    """
+    Records one notification per chat message in `messages`.
+    """
+    messages = [message for message in messages if message.message]
+    if not messages:
+        return
+    usernames = by_pk(
+        CustomUser.objects.filter(pk__in={message.user_id for message in messages}).values_list('pk', 'username')
+    )
+    Notification.objects.bulk_create([
+        Notification(
+            room_id=message.room_id,
+            sender_id=message.user_id,
+            message=f"{usernames[str(message.user_id)]} sent a message: {message.message[:100]}",
+        )
+        for message in messages
+    ])
+    fanout.schedule_on_commit()
+
+
+def tasks_created(tasks):
+    """
+    Records a notification for each new task in `tasks` and queues the email
+    telling its assignee.
+    """
+    if not tasks:
+        return
+    room_names = by_pk(
+        Room.objects.with_deleted().filter(pk__in={task.room_id for task in tasks}).values_list('pk', 'name')
+    )
+    emails = by_pk(
+        CustomUser.objects.filter(pk__in={task.assigned_to_id for task in tasks}).values_list('pk', 'email')
+    )
+    notifications = []
+    for task in tasks:
+        message = f"Task '{task.title}' assigned to you in room '{room_names[str(task.room_id)]}'"
+        notifications.append(Notification(room_id=task.room_id, sender_id=task.created_by_id, message=message))
+        outbox.notify(
+            [emails[str(task.assigned_to_id)]], 'New Task Assignment', message,
+            key=f"task:{task.pk}:assigned", from_email=settings.EMAIL_HOST_USER,
+        )
+    Notification.objects.bulk_create(notifications)
+    fanout.schedule_on_commit()
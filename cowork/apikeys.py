@@ -0,0 +1,94 @@
+"""
+Looks up API keys for APIKeyAuthentication.
+
+A presented key is found by its prefix and checked against the stored
+SHA-256 hash in constant time. Keys that check out are kept, with their
+user, in a per-process cache holding up to API_KEYS["CACHE_SIZE"] keys for
+API_KEYS["CACHE_TTL"] seconds, least recently used dropped first, so a busy
+client authenticates without a query. Entries are found by the hash of the
+key; the key itself is never kept or logged.
+
+Deleting a key or saving or deleting its user drops the cached entries at
+once in the process that made the change (see cowork/signals.py); other
+processes notice within the TTL.
+"""
+import copy
+import hmac
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from cowork.models import APIKey
+
+
+class KeyCache:
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # hashed key -> (expires at, APIKey with its user)
+        self._entries = OrderedDict()
+
+    def get(self, hashed_key):
+        with self._lock:
+            entry = self._entries.get(hashed_key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[hashed_key]
+                return None
+            self._entries.move_to_end(hashed_key)
+            return entry[1]
+
+    def put(self, hashed_key, api_key):
+        ttl = self.ttl if self.ttl is not None else settings.API_KEYS["CACHE_TTL"]
+        max_size = self.max_size if self.max_size is not None else settings.API_KEYS["CACHE_SIZE"]
+        with self._lock:
+            self._entries[hashed_key] = (time.monotonic() + ttl, api_key)
+            self._entries.move_to_end(hashed_key)
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key_id=None, user_id=None):
+        """
+        Drops the entries of the key `key_id` or of every key of `user_id`.
+        """
+        with self._lock:
+            for hashed_key, (_, api_key) in list(self._entries.items()):
+                if api_key.pk == key_id or api_key.user_id == user_id:
+                    del self._entries[hashed_key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+key_cache = KeyCache()
+
+
+def lookup(raw_key):
+    """
+    Returns the APIKey, with its user, that `raw_key` belongs to, or None.
+    Callers get their own copies, free to change.
+    """
+    if len(raw_key) <= APIKey.PREFIX_LENGTH:
+        return None
+    hashed_key = APIKey.hash_key(raw_key)
+    api_key = key_cache.get(hashed_key)
+    if api_key is None:
+        candidates = APIKey.objects.select_related('user').filter(prefix=raw_key[:APIKey.PREFIX_LENGTH])
+        api_key = next(
+            (candidate for candidate in candidates if hmac.compare_digest(candidate.hashed_key, hashed_key)),
+            None,
+        )
+        if api_key is None:
+            return None
+        key_cache.put(hashed_key, api_key)
+    api_key = copy.copy(api_key)
+    api_key.user = copy.copy(api_key.user)
+    return api_key
@@ -0,0 +1,197 @@
+"""
+Cold storage for old chat history.
+
+archive() moves the live messages older than CHAT_ARCHIVE["RETENTION_DAYS"]
+out of the Message table, one room and month at a time, into a gzipped
+NDJSON file under MEDIA_ROOT/archive, one message per line, oldest first,
+recorded by a MessageArchive row. A month archived before is rewritten with
+the new messages merged in. The rows and their search entries are deleted
+in the transaction that records the file, so the table and its indexes only
+hold recent history. Soft-deleted messages are left to purge_soft_deleted,
+and cannot be restored once their room has archived anything newer (see
+MessageQuerySet.restorable()).
+
+history_rows() is the read side, used by cowork/history.py once a room's
+live messages run out. Since archival always takes everything before the
+horizon, archived messages are older than every live one.
+"""
+import gzip
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from cowork import search
+from cowork.models import Message, MessageArchive
+
+# Rows deleted per statement, well under SQLite's limit on parameters.
+DELETE_CHUNK_SIZE = 500
+
+
+def file_name(room_id, month):
+    return f"{room_id}/{month:%Y-%m}.ndjson.gz"
+
+
+def next_month(start):
+    return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def encode(rows):
+    lines = "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in rows)
+    return gzip.compress(lines.encode("utf8"))
+
+
+def read_rows(archive):
+    """
+    Returns the messages stored in `archive`, oldest first, as they were
+    written.
+    """
+    with archive.file.open("rb") as f:
+        data = gzip.decompress(f.read())
+    return [json.loads(line) for line in data.splitlines() if line]
+
+
+class ArchiveCache:
+    """
+    The rows of the archive files read last, decoded, least recently used
+    dropped first. Files are rewritten under a new name, so entries are
+    never out of date.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # (file name, archived at) -> rows
+        self._entries = OrderedDict()
+
+    def rows(self, archive):
+        key = (archive.file.name, archive.archived_at)
+        with self._lock:
+            rows = self._entries.get(key)
+            if rows is not None:
+                self._entries.move_to_end(key)
+                return rows
+
+        rows = read_rows(archive)
+        for row in rows:
+            row["created_at"] = datetime.fromisoformat(row["created_at"])
+        max_size = self.max_size if self.max_size is not None else settings.CHAT_ARCHIVE["CACHE_SIZE"]
+        with self._lock:
+            self._entries[key] = rows
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+        return rows
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+archive_cache = ArchiveCache()
+
+
+def archive(horizon=None):
+    """
+    Archives every live message created before `horizon`, RETENTION_DAYS
+    ago by default. Returns how many messages were moved and into how many
+    monthly files.
+    """
+    if horizon is None:
+        horizon = timezone.now() - timedelta(days=settings.CHAT_ARCHIVE["RETENTION_DAYS"])
+    old = Message.objects.filter(created_at__lt=horizon)
+    months = list(
+        old.annotate(month=TruncMonth('created_at'))
+        .values_list('room_id', 'month')
+        .distinct()
+        .order_by('room_id', 'month')
+    )
+    moved = 0
+    for room_id, month in months:
+        moved += archive_month(old.filter(room_id=room_id, created_at__gte=month, created_at__lt=next_month(month)))
+    return moved, len(months)
+
+
+def archive_month(messages):
+    """
+    Moves `messages`, one room's from one month, into that month's file and
+    returns how many there were.
+    """
+    with transaction.atomic():
+        found = list(
+            messages.select_for_update()
+            .order_by('created_at', 'id')
+            .values('id', 'room_id', 'user_id', 'user__username', 'message', 'media', 'created_at')
+        )
+        if not found:
+            return 0
+        room_id = found[0]["room_id"]
+        month = timezone.localtime(found[0]["created_at"]).date().replace(day=1)
+        ids = [row["id"] for row in found]
+        rows = [
+            {
+                "id": row["id"],
+                "user_id": str(row["user_id"]),
+                "username": row["user__username"],
+                "message": row["message"],
+                "media": row["media"] or None,
+                "created_at": row["created_at"].isoformat(),
+            }
+            for row in found
+        ]
+
+        record = MessageArchive.objects.select_for_update().filter(room_id=room_id, month=month).first()
+        old_name = None
+        if record is None:
+            record = MessageArchive(room_id=room_id, month=month)
+        else:
+            old_name = record.file.name
+            merged = {row["id"]: row for row in read_rows(record)}
+            merged.update((row["id"], row) for row in rows)
+            rows = sorted(merged.values(), key=lambda row: (datetime.fromisoformat(row["created_at"]), row["id"]))
+
+        # Written under a new name, so the old file stays intact until this
+        # commits.
+        record.file.save(file_name(room_id, month), ContentFile(encode(rows)), save=False)
+        try:
+            record.message_count = len(rows)
+            record.first_created_at = datetime.fromisoformat(rows[0]["created_at"])
+            record.last_created_at = datetime.fromisoformat(rows[-1]["created_at"])
+            record.save()
+
+            search.unindex_rows(Message, Message.objects.with_deleted().filter(pk__in=ids))
+            for start in range(0, len(ids), DELETE_CHUNK_SIZE):
+                # Nothing refers to messages and their search entries are
+                # gone, so skip loading every row for post_delete.
+                chunk = Message.objects.with_deleted().filter(pk__in=ids[start:start + DELETE_CHUNK_SIZE])
+                chunk._raw_delete(chunk.db)
+        except BaseException:
+            record.file.storage.delete(record.file.name)
+            raise
+        if old_name:
+            storage = record.file.storage
+            transaction.on_commit(lambda: storage.delete(old_name))
+        return len(ids)
+
+
+def history_rows(room, before=None, limit=None):
+    """
+    Returns up to `limit` archived messages of `room`, newest first, older
+    than the (created_at, id) position `before`.
+    """
+    archives = MessageArchive.objects.filter(room=room).order_by('-month')
+    if before is not None:
+        archives = archives.filter(first_created_at__lte=before[0])
+    rows = []
+    for record in archives:
+        for row in reversed(archive_cache.rows(record)):
+            if before is None or (row["created_at"], row["id"]) < before:
+                rows.append(row)
+                if len(rows) >= limit:
+                    return rows
+    return rows
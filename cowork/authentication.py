@@ -1,51 +1,44 @@
 import logging
 from rest_framework.authentication import BaseAuthentication
 from rest_framework.exceptions import AuthenticationFailed
-from .models import APIKey
+from cowork import apikeys
 
 logger = logging.getLogger(__name__)
 
-import logging
-
-logger = logging.getLogger(__name__)
 
 class APIKeyAuthentication(BaseAuthentication):
+    """
+    Authenticates with an API key from the Authorization header
+    ("<scheme> <key>") or the api_key query parameter. The request body is
+    never read, so uploads are not parsed just to authenticate them.
+    """
+
     def authenticate(self, request):
         # Check headers
-        api_key = request.headers.get('Authorization')
-        if api_key:
-            try:
-                key = api_key.split(' ')[1]  # Extract the API key from the Authorization header
-                api_key_obj = APIKey.objects.get(key=key)
-                logger.info(f'User {api_key_obj.user.username} authenticated successfully with API key from headers: {api_key_obj.key}')
-                return (api_key_obj.user, api_key_obj)
-            except (IndexError, APIKey.DoesNotExist):
-                logger.warning('Invalid API key provided in the request headers.')
-                pass
+        header = request.headers.get('Authorization')
+        if header:
+            parts = header.split()
+            if len(parts) == 2:
+                result = self.authenticate_key(parts[1], 'headers')
+                if result:
+                    return result
+            else:
+                logger.warning('Malformed Authorization header.')
 
         # Check query parameters
         api_key = request.query_params.get('api_key')
         if api_key:
-            try:
-                api_key_obj = APIKey.objects.get(key=api_key)
-                logger.info(f'User {api_key_obj.user.username} authenticated successfully with API key from query parameters: {api_key_obj.key}')
-                return (api_key_obj.user, api_key_obj)
-            except APIKey.DoesNotExist:
-                logger.warning('Invalid API key provided in the query parameters.')
-                pass
-
-        # Check request body (if it's sent as JSON)
-        api_key = request.data.get('api_key')
-        if api_key:
-            try:
-                api_key_obj = APIKey.objects.get(key=api_key)
-                logger.info(f'User {api_key_obj.user.username} authenticated successfully with API key from request body: {api_key_obj.key}')
-                return (api_key_obj.user, api_key_obj)
-            except APIKey.DoesNotExist:
-                logger.warning('Invalid API key provided in the request body.')
-                pass
+            return self.authenticate_key(api_key, 'query parameters')
 
-        # No API key found in headers, query parameters, or request body
-        logger.warning('No API key provided in the request.')
         return None
 
+    def authenticate_key(self, raw_key, source):
+        api_key = apikeys.lookup(raw_key)
+        if api_key is None:
+            # Only the prefix, which is not enough to use the key, is logged.
+            logger.warning(f'Invalid API key {raw_key[:8]}... provided in the request {source}.')
+            return None
+        if not api_key.user.is_active:
+            raise AuthenticationFailed('User inactive or deleted.')
+        logger.info(f'User {api_key.user.username} authenticated with API key {api_key.prefix}... from {source}')
+        return (api_key.user, api_key)
@@ -0,0 +1,275 @@
+"""
+In-process autocomplete for public room names and slugs.
+
+Every word of a room's name and slug is indexed under its first one, two and
+three characters. Each of those keys maps to a posting list of the rooms
+having such a word, kept sorted by member count (most first), and to the
+same rooms as a set. A query word matches a room when it is the start of one
+of the room's words, and a room must match every query word.
+
+A lookup walks the shortest posting list among the query's words in rank
+order and stops once it has `limit` matches, which is quick whenever
+matches are common. If SCAN_BUDGET rooms go by without filling the page,
+the matches are rare and are found instead by intersecting the sets of
+the query words' keys, then ranked.
+
+The index is built from the database on the first lookup in each process,
+by one caller while any others arriving meanwhile wait for it, and then kept
+current by the Room signal handlers in cowork/signals.py. Writes made by
+other processes are picked up by a rebuild, started in a background thread
+by the first lookup after AUTOCOMPLETE["MAX_AGE"] seconds; lookups keep
+using the old index until the new one is ready. Changes signalled while a
+build reads the database are replayed onto its result, so none are lost.
+"""
+import logging
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count
+
+from cowork.models import Room
+
+logger = logging.getLogger(__name__)
+
+KEY_LENGTH = 3
+
+# Rooms a lookup checks in rank order before switching to set intersection.
+SCAN_BUDGET = 256
+
+
+def words(text):
+    return re.findall(r'[^\W_]+', (text or '').casefold())
+
+
+def text(room_words):
+    return " " + " ".join(sorted(room_words))
+
+
+def keys(room_words):
+    return {word[:length] for word in room_words for length in range(1, KEY_LENGTH + 1)}
+
+
+class RoomAutocomplete:
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        # room id -> (rank, name, slug, text). The rank, (-members, id), is
+        # what posting lists are sorted by; text is " word word ...", so that
+        # " " + prefix in text tells whether a word starts with the prefix.
+        self._rooms = None
+        self._postings = {}
+        self._sets = {}
+        self._built_at = 0.0
+        self._rebuilding = False
+        # Held by whoever is building the index for the first time.
+        self._build_lock = threading.Lock()
+        # Changes made while a build reads the database, as (method, args),
+        # or None when no build is running.
+        self._changes = None
+
+    @property
+    def built(self):
+        return self._rooms is not None
+
+    @property
+    def tracking(self):
+        """
+        Whether the index is built or being built, so changes matter to it.
+        """
+        return self.built or self._changes is not None
+
+    def build(self):
+        """
+        Loads every public room from the database.
+        """
+        with self._lock:
+            self._changes = []
+        members = dict(
+            Room.users.through.objects.values('room_id').annotate(count=Count('pk')).values_list('room_id', 'count')
+        )
+        rooms = Room.objects.filter(is_private=False).values_list('pk', 'name', 'slug').iterator(chunk_size=10000)
+        self.load((pk, name, slug, members.get(pk, 0)) for pk, name, slug in rooms)
+
+    def load(self, rows):
+        """
+        Replaces the index with `rows` of (id, name, slug, member count).
+        """
+        rooms = {}
+        postings = {}
+        for pk, name, slug, members in rows:
+            rank = (-members, pk)
+            room_words = set(words(name)) | set(words(slug))
+            rooms[pk] = (rank, name, slug, text(room_words))
+            for key in keys(room_words):
+                postings.setdefault(key, []).append(rank)
+        for posting in postings.values():
+            posting.sort()
+        sets = {key: {pk for _, pk in posting} for key, posting in postings.items()}
+        with self._lock:
+            self._rooms = rooms
+            self._postings = postings
+            self._sets = sets
+            self._built_at = time.monotonic()
+            changes, self._changes = self._changes, None
+            for method, args in changes or ():
+                method(*args)
+
+    def reset(self):
+        """
+        Drops the index; the next lookup rebuilds it.
+        """
+        with self._lock:
+            self._rooms = None
+            self._postings = {}
+            self._sets = {}
+            self._changes = None
+
+    def ensure_built(self):
+        if not self.built:
+            # One caller scans the rooms; the others wait for its index.
+            with self._build_lock:
+                if not self.built:
+                    self.build()
+            return
+        max_age = self.max_age if self.max_age is not None else settings.AUTOCOMPLETE["MAX_AGE"]
+        with self._lock:
+            if self._rebuilding or time.monotonic() - self._built_at <= max_age:
+                return
+            self._rebuilding = True
+        threading.Thread(target=self._rebuild, name="room-autocomplete", daemon=True).start()
+
+    def _rebuild(self):
+        try:
+            self.build()
+        except Exception:
+            logger.exception("Error rebuilding the room autocomplete index")
+            with self._lock:
+                self._changes = None
+        finally:
+            self._rebuilding = False
+            connection.close()
+
+    def lookup(self, query, limit=10):
+        """
+        Returns up to `limit` public rooms matching `query`, as dicts, the
+        ones with the most members first.
+        """
+        query_words = words(query)
+        if not query_words or limit < 1:
+            return []
+        self.ensure_built()
+        needles = [" " + word for word in query_words]
+        with self._lock:
+            query_keys = {word[:KEY_LENGTH] for word in query_words}
+            if not all(key in self._postings for key in query_keys):
+                return []
+            shortest = min((self._postings[key] for key in query_keys), key=len)
+            if len(query_words) == 1 and len(query_words[0]) <= KEY_LENGTH:
+                # The key is the whole query: every room listed matches.
+                matches = [self._rooms[pk] for _, pk in shortest[:limit]]
+            elif len(query_keys) == 1:
+                matches = self._scan(shortest, needles, limit)
+            else:
+                matches = self._scan(shortest[:SCAN_BUDGET], needles, limit)
+                if len(matches) < limit and len(shortest) > SCAN_BUDGET:
+                    sets = sorted((self._sets[key] for key in query_keys), key=len)
+                    candidates = sets[0].intersection(*sets[1:])
+                    if len(candidates) * 8 < len(shortest):
+                        ranks = sorted(self._rooms[pk][0] for pk in candidates)
+                        matches = self._scan(ranks, needles, limit)
+                    else:
+                        # Plenty of candidates: the next ones in rank order
+                        # are close by.
+                        matches = self._scan(shortest, needles, limit, candidates)
+        return [
+            {"id": rank[1], "name": name, "slug": slug, "members": -rank[0]}
+            for rank, name, slug, _ in matches
+        ]
+
+    def _scan(self, ranks, needles, limit, candidates=None):
+        matches = []
+        for _, pk in ranks:
+            if candidates is not None and pk not in candidates:
+                continue
+            room = self._rooms[pk]
+            if all(needle in room[3] for needle in needles):
+                matches.append(room)
+                if len(matches) == limit:
+                    break
+        return matches
+
+    def update(self, room, members=None):
+        """
+        Adds, re-indexes or drops `room` after it was saved. Its member count
+        is kept unless `members` is given.
+        """
+        self._change(self._update, room, members)
+
+    def remove(self, room_id):
+        self._change(self._remove, room_id)
+
+    def refresh_members(self, room_ids):
+        """
+        Re-reads the member counts of `room_ids` after users joined or left.
+        """
+        if not self.tracking:
+            return
+        room_ids = list(room_ids)
+        counts = dict(
+            Room.users.through.objects.filter(room_id__in=room_ids)
+            .values('room_id').annotate(count=Count('pk')).values_list('room_id', 'count')
+        )
+        self._change(self._set_members, room_ids, counts)
+
+    def _change(self, method, *args):
+        # Applies a change to the index, and keeps it for the build under
+        # way, if any, whose snapshot may predate it.
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((method, args))
+            if self.built:
+                method(*args)
+
+    def _update(self, room, members):
+        old = self._remove(room.pk)
+        if room.is_private or room.deleted_at is not None:
+            return
+        if members is None:
+            members = -old[0][0] if old else 0
+        self._add(room.pk, room.name, room.slug, members)
+
+    def _set_members(self, room_ids, counts):
+        for pk in room_ids:
+            old = self._remove(pk)
+            if old is not None:
+                _, name, slug, _ = old
+                self._add(pk, name, slug, counts.get(pk, 0))
+
+    def _add(self, pk, name, slug, members):
+        rank = (-members, pk)
+        room_words = set(words(name)) | set(words(slug))
+        self._rooms[pk] = (rank, name, slug, text(room_words))
+        for key in keys(room_words):
+            insort(self._postings.setdefault(key, []), rank)
+            self._sets.setdefault(key, set()).add(pk)
+
+    def _remove(self, pk):
+        room = self._rooms.pop(pk, None)
+        if room is None:
+            return None
+        rank, _, _, room_text = room
+        for key in keys(room_text.split()):
+            posting = self._postings[key]
+            del posting[bisect_left(posting, rank)]
+            self._sets[key].discard(pk)
+            if not posting:
+                del self._postings[key]
+                del self._sets[key]
+        return room
+
+
+room_autocomplete = RoomAutocomplete()
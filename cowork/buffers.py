@@ -0,0 +1,149 @@
+import asyncio
+import atexit
+import logging
+
+from django.db import DatabaseError, transaction
+
+from cowork.db import db_executor
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """
+    Collects unsaved model instances in memory and writes them with a single
+    bulk_create once `max_batch` rows are waiting or `flush_interval` seconds
+    have passed since the first one arrived, whichever comes first.
+
+    At most `max_pending` rows are held; once full, add() waits for a flush
+    instead of growing further. Whatever is still pending when the process
+    exits is written synchronously. If the database rejects a batch, its rows
+    are retried one at a time so a bad row only fails its own future.
+
+    Note that bulk_create does not send post_save signals for the rows; pass
+    `on_write`, called as on_write(model, instances) in the same transaction
+    as every insert, for anything that would otherwise hang off post_save.
+    """
+
+    def __init__(self, model, max_batch=100, flush_interval=0.05, max_pending=5000, on_write=None):
+        self.model = model
+        self.on_write = on_write
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = []
+        self._loop = None
+        self._lock = None
+        self._timer = None
+        atexit.register(self.flush_sync)
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._lock = asyncio.Lock()
+            self._timer = None
+        return loop
+
+    async def add(self, instance):
+        """
+        Queues `instance` for insertion and returns a future that resolves
+        once its row has been written.
+        """
+        loop = self._bind_loop()
+        if len(self.pending) >= self.max_pending:
+            await self.flush()
+
+        future = loop.create_future()
+        self.pending.append((instance, future))
+        if len(self.pending) >= self.max_batch:
+            loop.create_task(self.flush())
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_interval, lambda: loop.create_task(self.flush()))
+        return future
+
+    async def flush(self):
+        """
+        Writes everything that is currently pending.
+        """
+        self._bind_loop()
+        async with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            batch, self.pending = self.pending, []
+            if not batch:
+                return
+
+            try:
+                errors = await db_executor.run(self._write, [instance for instance, _ in batch])
+            except Exception as e:
+                errors = [e] * len(batch)
+            failed = [error for error in errors if error is not None]
+            if failed:
+                logger.error(f"Error writing {len(failed)} of {len(batch)} {self.model.__name__} rows: {str(failed[0])}")
+            for (instance, future), error in zip(batch, errors):
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(instance)
+                else:
+                    future.set_exception(error)
+                    # Already logged above; callers that only wanted the
+                    # broadcast never look at the future.
+                    future.exception()
+
+    def flush_sync(self):
+        """
+        Writes pending rows from outside the event loop, used at shutdown.
+        """
+        batch, self.pending = self.pending, []
+        if batch:
+            self._write([instance for instance, _ in batch])
+
+    def _write(self, instances):
+        """
+        Inserts `instances` and returns the error for each one, or None.
+        """
+        try:
+            self._insert(instances, self.max_batch)
+            return [None] * len(instances)
+        except DatabaseError:
+            if len(instances) == 1:
+                raise
+        # One bad row (say, a foreign key to something since deleted) fails
+        # the whole batch; retry row by row so only that one is lost.
+        errors = []
+        for instance in instances:
+            try:
+                self._insert([instance])
+                errors.append(None)
+            except DatabaseError as e:
+                errors.append(e)
+        return errors
+
+    def _insert(self, instances, batch_size=None):
+        # Whatever on_write records commits together with the rows.
+        with transaction.atomic():
+            self.model.objects.bulk_create(instances, batch_size=batch_size)
+            if any(instance.pk is None for instance in instances):
+                self._fill_in_pks(instances)
+            if self.on_write is not None:
+                self._written(instances)
+
+    def _fill_in_pks(self, instances):
+        # Some databases (SQLite among them) do not hand back the keys of
+        # bulk inserted rows. SQLite lets one writer in at a time, so inside
+        # the inserting transaction they are the newest len(instances).
+        pks = self.model._base_manager.order_by('-pk').values_list('pk', flat=True)[:len(instances)]
+        for instance, pk in zip(instances, reversed(list(pks))):
+            instance.pk = pk
+            instance._state.adding = False
+
+    def _written(self, instances):
+        # The rows are in; a failing hook must not fail their futures.
+        try:
+            with transaction.atomic():
+                self.on_write(self.model, instances)
+        except Exception:
+            logger.exception(f"Error in on_write for {len(instances)} {self.model.__name__} rows")
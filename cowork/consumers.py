@@ -1,11 +1,107 @@
+import functools
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 from django.shortcuts import get_object_or_404
-from asgiref.sync import sync_to_async
-from cowork.models import Room, Message, Task
+from cowork.buffers import WriteBehindBuffer
+from cowork.db import in_db_executor
+from cowork.history import history_page
+from cowork.metrics import ConsumerMetricsMixin
+from cowork.models import Room, Message
+from cowork.notifications import notification_events, rows_written
+from cowork.presence import merge_diffs, presence
+from cowork.sendqueue import SendQueueMixin
 from django.utils import timezone
+from rest_framework.exceptions import ValidationError
 
-class ChatConsumer(AsyncWebsocketConsumer):
+
+# Chat messages are broadcast first and written to the database in batches.
+message_buffer = WriteBehindBuffer(
+    Message,
+    max_batch=settings.CHAT_MESSAGE_BUFFER["MAX_BATCH"],
+    flush_interval=settings.CHAT_MESSAGE_BUFFER["FLUSH_INTERVAL_MS"] / 1000,
+    max_pending=settings.CHAT_MESSAGE_BUFFER["MAX_PENDING"],
+    on_write=rows_written,
+)
+
+
+def chat_group(room_slug):
+    return f"chat_{room_slug}"
+
+
+def notification_group(room_id):
+    return f"room_{room_id}"
+
+
+def presence_snapshot(room_slug, online):
+    return {
+        "type": "presence",
+        "stream": "chat",
+        "room": room_slug,
+        "online": [{"id": user_id, "username": username} for user_id, username in online.items()],
+    }
+
+
+async def post_chat_message(channel_layer, room, user, message):
+    """
+    Broadcasts a chat message to the room and queues it for writing. Returns
+    the future from `message_buffer`.
+    """
+    persisted = await message_buffer.add(Message(room=room, user=user, message=message))
+
+    # Encode the outbound frame once here; every recipient forwards the
+    # same text instead of running json.dumps per socket.
+    await channel_layer.group_send(
+        chat_group(room.slug),
+        {
+            "type": "chat_message",
+            "text": json.dumps({
+                "stream": "chat",
+                "room": room.slug,
+                "message": message,
+                "username": user.username,
+            }),
+        }
+    )
+    return persisted
+
+
+async def chat_receipt(persisted, client_id):
+    """
+    The ack or error frame owed to a client that tagged its message with a
+    client_id, sent either right after the broadcast or once the row is in
+    the database. None if nothing is owed.
+    """
+    if settings.CHAT_MESSAGE_BUFFER["DURABILITY"] == "persist":
+        try:
+            await persisted
+        except Exception:
+            return None if client_id is None else {"type": "error", "client_id": client_id}
+    if client_id is None:
+        return None
+    return {"type": "ack", "client_id": client_id}
+
+
+async def post_notification(channel_layer, event, room_id, room_slug, data):
+    """
+    Queues a validated notification event for writing and broadcasts it to
+    the room.
+    """
+    # Saves the event in the background, batched with others
+    timestamp = timezone.now()
+    await event.persist(room_id, data, timestamp)
+
+    # Broadcasts the notification(s) to the room group
+    await channel_layer.group_send(
+        notification_group(room_id),
+        {
+            'type': 'send_notification',
+            'text': json.dumps({'stream': 'notifications', 'room': room_slug, **event.payload(data, timestamp)})
+        }
+    )
+
+
+class ChatConsumer(ConsumerMetricsMixin, SendQueueMixin, AsyncWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.room = None
@@ -13,76 +109,87 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     async def connect(self):
         self.room_name = self.scope["url_route"]["kwargs"]["room_slug"]
-        self.room_group_name = f"chat_{self.room_name}"
+        self.room_group_name = chat_group(self.room_name)
         self.user = self.scope["user"]
         self.room = await self.get_or_create_room(self.room_name)
-        
+        if not await self.can_see(self.room):
+            await self.close()
+            return
+
         await self.channel_layer.group_add(
             self.room_group_name, self.channel_name
         )
-        
-        await self.add_user_to_room(self.room, self.user)
         await self.accept()
 
+        # Being connected only shows up in presence; Room.users is durable
+        # membership and is managed through the room API.
+        if self.user.is_authenticated:
+            online = await presence.join(
+                self.room_name, self.channel_name, str(self.user.pk), self.user.username, self.send_presence
+            )
+            await self.send(text_data=json.dumps(presence_snapshot(self.room_name, online)))
+
     async def disconnect(self, close_code):
-        await self.remove_user_from_room(self.room, self.user)
+        await presence.leave(self.room_name, self.channel_name)
         await self.channel_layer.group_discard(
             self.room_group_name, self.channel_name
         )
+        # Don't let this socket's last messages sit in memory once it is gone.
+        await message_buffer.flush()
 
     async def receive(self, text_data):
         text_data_json = json.loads(text_data)
-        message = text_data_json["message"]
-        username = self.user.username
+        presence.touch(self.room_name, self.channel_name)
+        frame_type = text_data_json.get("type", "message")
+        if frame_type == "heartbeat":
+            return
+        if frame_type == "history":
+            await self.send_history(text_data_json.get("before"), text_data_json.get("limit"))
+            return
 
-        await self.save_message(self.room, self.user, message)
+        message = text_data_json["message"]
+        client_id = text_data_json.get("client_id")
 
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "chat_message",
-                "message": message,
-                "username": username,
-            }
-        )
+        persisted = await post_chat_message(self.channel_layer, self.room, self.user, message)
+        receipt = await chat_receipt(persisted, client_id)
+        if receipt is not None:
+            await self.send(text_data=json.dumps(receipt))
 
     async def chat_message(self, event):
-        message = event["message"]
-        username = event["username"]
-        message_html = f"{message}"
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "message": message_html,
-                    "username": username
-                }
-            )
-        )
+        await self.send(text_data=event["text"])
+
+    async def send_history(self, before, limit):
+        try:
+            page = await self.get_history_page(self.room, before, limit)
+        except ValueError as e:
+            await self.send(text_data=json.dumps({"type": "error", "detail": str(e)}))
+            return
+        await self.send(text_data=json.dumps({"type": "history", "room": self.room_name, **page}))
 
-    @sync_to_async
-    def save_message(self, room, user, message):
-        Message.objects.create(room=room, user=user, message=message)
+    async def send_presence(self, frame):
+        await self.send(text_data=frame, coalesce="presence")
 
-    @sync_to_async
+    def merge_frames(self, key, queued, frame):
+        if key.startswith("presence"):
+            return merge_diffs(queued, frame)
+        return frame
+
+    @in_db_executor
+    def get_history_page(self, room, before, limit):
+        return history_page(room, before, limit)
+
+    @in_db_executor
     def get_or_create_room(self, slug):
         return get_object_or_404(Room, slug=slug)
 
-    @sync_to_async
-    def add_user_to_room(self, room, user):
-        if user not in room.users.all():
-            room.users.add(user)
-            room.save()
-
-    @sync_to_async
-    def remove_user_from_room(self, room, user):
-        if user in room.users.all():
-            room.users.remove(user)
-            room.save()
+    @in_db_executor
+    def can_see(self, room):
+        return room.visible_to(self.user)
 
 
 
 
-class NotificationConsumer(AsyncWebsocketConsumer):
+class NotificationConsumer(ConsumerMetricsMixin, SendQueueMixin, AsyncWebsocketConsumer):
     """
     A Django Channels consumer that handles various types of notifications
     within a specific room.
@@ -91,22 +198,23 @@ class NotificationConsumer(AsyncWebsocketConsumer):
     updates about messages, file uploads, branch activities, and tasks.
 
     Attributes:
-        room_name: The name of the room the consumer is connected to.
+        room_name: The primary key of the room the consumer is connected to.
         room_group_name: The name of the Channel group used for broadcasting
                         notifications to the room.
 
     Methods:
         connect(self):
-            Accepts the connection and joins the room group.
+            Accepts the connection and joins the room group, or closes it if
+            the user is not signed in, the room does not exist or it is
+            private and the user is not a member.
         disconnect(self, close_code):
             Leaves the room group when the connection is closed.
         receive(self, text_data):
             Handles incoming messages containing notification data.
                 - Parses received JSON data.
-                - Validates notification type (`message`, `file_upload`,
-                  `branch_activity`, or `task`).
-                - Saves the notification data to the database.
-                - Prepares a notification response with data and timestamp.
+                - Looks the notification type up in `notification_events`
+                  (see cowork/notifications.py) and validates the frame.
+                - Queues the event's row for a batched write.
                 - Broadcasts the notification to the room group.
                 - Handles potential errors.
         send_notification(self, event):
@@ -116,7 +224,18 @@ class NotificationConsumer(AsyncWebsocketConsumer):
     """
     async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
-        self.room_group_name = f'room_{self.room_name}'
+        self.room_group_name = notification_group(self.room_name)
+
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            await self.close()
+            return
+
+        room = await self.get_room(self.room_name)
+        if room is None or not await self.can_see(room, user):
+            await self.close()
+            return
+        self.room_slug = room.slug
 
         # Joins room group
         await self.channel_layer.group_add(
@@ -132,112 +251,31 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             self.room_group_name,
             self.channel_name
         )
+        await notification_events.flush()
 
     async def receive(self, text_data):
         try:
             data = json.loads(text_data)
             notification_type = data.get('type')
-
-            if notification_type == 'message':
-                message_text = data.get('message')
-                sender_id = data.get('sender_id')
-                timestamp = timezone.now()
-
-                # Saves message to the database
-                message = Message.objects.create(
-                    room_id=self.room_name,
-                    sender_id=sender_id,
-                    message=message_text,
-                    timestamp=timestamp
-                )
-
-                # Prepares notification response
-                notification = {
-                    'type': 'message',
-                    'message': message_text,
-                    'sender_id': sender_id,
-                    'timestamp': timestamp.strftime('%Y-%m-%d %H:%M:%S')
-                }
-
-            # elif notification_type == 'file_upload':
-            #     file_name = data.get('file_name')
-            #     uploader_id = data.get('uploader_id')
-            #     timestamp = timezone.now()
-
-            #     # Saves file upload activity to the database
-            #     uploaded_file = UploadedFile.objects.create(
-            #         room_id=self.room_name,
-            #         uploader_id=uploader_id,
-            #         file_name=file_name,
-            #         timestamp=timestamp
-            #     )
-
-            #     # Prepares notification response
-            #     notification = {
-            #         'type': 'file_upload',
-            #         'file_name': file_name,
-            #         'uploader_id': uploader_id,
-            #         'timestamp': timestamp.strftime('%Y-%m-%d %H:%M:%S')
-            #     }
-
-            # elif notification_type == 'branch_activity':
-            #     branch_name = data.get('branch_name')
-            #     actor_id = data.get('actor_id')
-            #     timestamp = timezone.now()
-
-            #     # Saves branch activity to the database
-            #     branch = Branch.objects.create(
-            #         room_id=self.room_name,
-            #         actor_id=actor_id,
-            #         branch_name=branch_name,
-            #         timestamp=timestamp
-            #     )
-
-            #     # Prepares notification response
-            #     notification = {
-            #         'type': 'branch_activity',
-            #         'branch_name': branch_name,
-            #         'actor_id': actor_id,
-            #         'timestamp': timestamp.strftime('%Y-%m-%d %H:%M:%S')
-            #     }
-
-            elif notification_type == 'task':
-                task_title = data.get('task_title')
-                creator_id = data.get('creator_id')
-                timestamp = timezone.now()
-
-                # Saves task to the database
-                task = Task.objects.create(
-                    room_id=self.room_name,
-                    creator_id=creator_id,
-                    title=task_title,
-                    timestamp=timestamp
-                )
-
-                # Prepares notification response
-                notification = {
-                    'type': 'task',
-                    'task_title': task_title,
-                    'creator_id': creator_id,
-                    'timestamp': timestamp.strftime('%Y-%m-%d %H:%M:%S')
-                }
-
-            # Broadcasts the notification(s) to the room group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'send_notification',
-                    'notification': notification
-                }
-            )
+            event = notification_events.get(notification_type)
+            if event is None:
+                await self.send_error_response(f"Unknown notification type: {notification_type}")
+                return
+
+            try:
+                validated = event.validate(data, self.scope.get('user'))
+            except ValidationError as e:
+                await self.send_error_response(e.detail)
+                return
+
+            await post_notification(self.channel_layer, event, self.room_name, self.room_slug, validated)
         except Exception as e:
             error_message = f"An error occurred: {str(e)}"
             await self.send_error_response(error_message)
 
     async def send_notification(self, event):
-        notification = event['notification']
-        # Sends notification to WebSocket (Channels)
-        await self.send(text_data=json.dumps(notification))
+        # The notification was encoded once by the sender; forward it as is.
+        await self.send(text_data=event['text'])
 
     async def send_error_response(self, error_message):
         # Sends error response to WebSocket (Channels)
@@ -245,4 +283,185 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             'type': 'error',
             'error_message': error_message
         }
-        await self.send(text_data=json.dumps(response))
\ No newline at end of file
+        await self.send(text_data=json.dumps(response))
+
+    @in_db_executor
+    def get_room(self, room_id):
+        if not room_id.isdigit():
+            return None
+        return Room.objects.filter(pk=room_id).first()
+
+    @in_db_executor
+    def can_see(self, room, user):
+        return room.visible_to(user)
+
+
+
+class MultiplexConsumer(ConsumerMetricsMixin, SendQueueMixin, AsyncWebsocketConsumer):
+    """
+    One socket for all of a user's rooms, in place of a ChatConsumer or
+    NotificationConsumer connection per room.
+
+    Control frames:
+        {"type": "subscribe", "stream": "chat" | "notifications", "room": <slug>}
+        {"type": "unsubscribe", "stream": ..., "room": <slug>}
+        {"type": "heartbeat"}
+
+    Any other frame is addressed to a subscription by "stream" and "room" and
+    otherwise looks like one sent to the single-room consumers: chat takes
+    "message" (the default type) and "history" frames, notifications take
+    the types in `notification_events`. Every frame sent back carries the
+    "stream" and "room" it belongs to.
+    """
+    streams = ("chat", "notifications")
+
+    async def connect(self):
+        self.user = self.scope["user"]
+        # (stream, room slug) -> Room
+        self.subscriptions = {}
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        for stream, room_slug in list(self.subscriptions):
+            await self.unsubscribe(stream, room_slug)
+        await message_buffer.flush()
+        await notification_events.flush()
+
+    async def receive(self, text_data):
+        try:
+            frame = json.loads(text_data)
+        except ValueError:
+            await self.send_error(None, None, "Frames must be JSON objects.")
+            return
+        if not isinstance(frame, dict):
+            await self.send_error(None, None, "Frames must be JSON objects.")
+            return
+
+        frame_type = frame.get("type", "message")
+        if frame_type == "heartbeat":
+            for stream, room_slug in self.subscriptions:
+                if stream == "chat":
+                    presence.touch(room_slug, self.channel_name)
+            return
+
+        stream, room_slug = frame.get("stream"), frame.get("room")
+        if stream not in self.streams:
+            await self.send_error(stream, room_slug, f"Unknown stream: {stream}")
+            return
+        if frame_type == "subscribe":
+            await self.subscribe(stream, room_slug)
+            return
+        if frame_type == "unsubscribe":
+            await self.unsubscribe(stream, room_slug)
+            await self.send(text_data=json.dumps({"type": "unsubscribed", "stream": stream, "room": room_slug}))
+            return
+
+        room = self.subscriptions.get((stream, room_slug))
+        if room is None:
+            await self.send_error(stream, room_slug, "Not subscribed.")
+        elif stream == "chat":
+            await self.receive_chat(room, frame_type, frame)
+        else:
+            await self.receive_notification(room, frame_type, frame)
+
+    async def subscribe(self, stream, room_slug):
+        if (stream, room_slug) not in self.subscriptions:
+            if len(self.subscriptions) >= settings.MULTIPLEX_SOCKET["MAX_SUBSCRIPTIONS"]:
+                await self.send_error(stream, room_slug, "Too many subscriptions.")
+                return
+            room = await self.get_room(room_slug) if isinstance(room_slug, str) else None
+            if room is None:
+                await self.send_error(stream, room_slug, "Unknown room.")
+                return
+            if not await self.can_see(room):
+                await self.send_error(stream, room_slug, "You do not have access to this room.")
+                return
+            self.subscriptions[(stream, room_slug)] = room
+            if stream == "chat":
+                await self.channel_layer.group_add(chat_group(room_slug), self.channel_name)
+            else:
+                await self.channel_layer.group_add(notification_group(room.pk), self.channel_name)
+
+        await self.send(text_data=json.dumps({"type": "subscribed", "stream": stream, "room": room_slug}))
+        if stream == "chat":
+            online = await presence.join(
+                room_slug, self.channel_name, str(self.user.pk), self.user.username,
+                functools.partial(self.send_room_presence, room_slug),
+            )
+            await self.send(text_data=json.dumps(presence_snapshot(room_slug, online)))
+
+    async def unsubscribe(self, stream, room_slug):
+        room = self.subscriptions.pop((stream, room_slug), None)
+        if room is None:
+            return
+        if stream == "chat":
+            await presence.leave(room_slug, self.channel_name)
+            await self.channel_layer.group_discard(chat_group(room_slug), self.channel_name)
+        else:
+            await self.channel_layer.group_discard(notification_group(room.pk), self.channel_name)
+
+    async def receive_chat(self, room, frame_type, frame):
+        presence.touch(room.slug, self.channel_name)
+        if frame_type == "history":
+            try:
+                page = await self.get_history_page(room, frame.get("before"), frame.get("limit"))
+            except ValueError as e:
+                await self.send_error("chat", room.slug, str(e))
+                return
+            await self.send(text_data=json.dumps({"type": "history", "stream": "chat", "room": room.slug, **page}))
+            return
+
+        message = frame.get("message")
+        if not isinstance(message, str):
+            await self.send_error("chat", room.slug, "A chat message needs a message.")
+            return
+        persisted = await post_chat_message(self.channel_layer, room, self.user, message)
+        receipt = await chat_receipt(persisted, frame.get("client_id"))
+        if receipt is not None:
+            await self.send(text_data=json.dumps({**receipt, "stream": "chat", "room": room.slug}))
+
+    async def receive_notification(self, room, frame_type, frame):
+        event = notification_events.get(frame_type)
+        if event is None:
+            await self.send_error("notifications", room.slug, f"Unknown notification type: {frame_type}")
+            return
+        try:
+            validated = event.validate(frame, self.user)
+        except ValidationError as e:
+            await self.send_error("notifications", room.slug, e.detail)
+            return
+        await post_notification(self.channel_layer, event, room.pk, room.slug, validated)
+
+    # Group messages; both were encoded once by the sender.
+
+    async def chat_message(self, event):
+        await self.send(text_data=event["text"])
+
+    async def send_notification(self, event):
+        await self.send(text_data=event["text"])
+
+    async def send_room_presence(self, room_slug, frame):
+        await self.send(text_data=frame, coalesce=f"presence:{room_slug}")
+
+    def merge_frames(self, key, queued, frame):
+        if key.startswith("presence"):
+            return merge_diffs(queued, frame)
+        return frame
+
+    async def send_error(self, stream, room_slug, detail):
+        await self.send(text_data=json.dumps({"type": "error", "stream": stream, "room": room_slug, "detail": detail}))
+
+    @in_db_executor
+    def get_room(self, slug):
+        return Room.objects.filter(slug=slug).first()
+
+    @in_db_executor
+    def can_see(self, room):
+        return room.visible_to(self.user)
+
+    @in_db_executor
+    def get_history_page(self, room, before, limit):
+        return history_page(room, before, limit)
@@ -0,0 +1,118 @@
+"""
+Per-user summary served by the userdata endpoint.
+
+Each section of a user's summary is cached on its own, under
+``dashboard:<user id>:<section>``. The signal handlers in cowork/signals.py
+drop just the sections a write touches, for just the users who can see it,
+once the write commits, and the next request rebuilds those. A request that finds everything in the
+cache makes no database queries at all.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from cowork.models import Room, Task
+from serializers.serializers import RoomSerializer, TaskSerializer, UserSummarySerializer
+
+SECTIONS = ("user", "joined_rooms", "created_rooms", "assigned_tasks")
+
+# The "user" section repeats the user's rooms, as UserSerializer does; they
+# are taken from the room sections rather than serialized a second time.
+DEPENDS_ON = {
+    "user": ("joined_rooms", "created_rooms"),
+}
+
+
+def cache_key(user_id, section):
+    return f"dashboard:{user_id}:{section}"
+
+
+def build_user(user):
+    return dict(UserSummarySerializer(user).data)
+
+
+def build_joined_rooms(user):
+    return list(RoomSerializer(user.room_set.with_members(), many=True).data)
+
+
+def build_created_rooms(user):
+    return list(RoomSerializer(user.created_rooms.with_members(), many=True).data)
+
+
+def build_assigned_tasks(user):
+    return list(TaskSerializer(Task.objects.filter(assigned_to=user).select_related('assigned_to'), many=True).data)
+
+
+BUILDERS = {
+    "user": build_user,
+    "joined_rooms": build_joined_rooms,
+    "created_rooms": build_created_rooms,
+    "assigned_tasks": build_assigned_tasks,
+}
+
+
+def parse_fields(value):
+    """
+    Turns a ?fields= value into a tuple of sections. Raises ValueError for
+    unknown section names.
+    """
+    if not value:
+        return SECTIONS
+    fields = [field.strip() for field in value.split(",") if field.strip()]
+    unknown = sorted(set(fields) - set(SECTIONS))
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}. Choose from: {', '.join(SECTIONS)}.")
+    return tuple(section for section in SECTIONS if section in fields)
+
+
+def get_dashboard(user, fields=SECTIONS):
+    needed = set(fields)
+    for section in fields:
+        needed.update(DEPENDS_ON.get(section, ()))
+
+    keys = {section: cache_key(user.pk, section) for section in needed}
+    cached = cache.get_many(list(keys.values()))
+    sections = {}
+    missing = {}
+    for section, key in keys.items():
+        if key in cached:
+            sections[section] = cached[key]
+        else:
+            sections[section] = missing[key] = BUILDERS[section](user)
+    if missing:
+        cache.set_many(missing, settings.DASHBOARD["TIMEOUT"])
+
+    if "user" in sections:
+        sections["user"] = {
+            **sections["user"],
+            "rooms": sections["joined_rooms"],
+            "created_rooms": sections["created_rooms"],
+        }
+    return {section: sections[section] for section in SECTIONS if section in fields}
+
+
+def invalidate(user_ids, sections=SECTIONS):
+    """
+    Drops `sections` of these users' summaries when the current transaction
+    commits; dropped any sooner, a request could cache them again from what
+    the database held before the write.
+    """
+    keys = [cache_key(user_id, section) for user_id in set(user_ids) if user_id for section in sections]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def invalidate_rooms(room_ids, user_ids=()):
+    """
+    Drops the room sections of everyone who can see any of these rooms in
+    their summary: members, creators and any extra `user_ids` (such as
+    users who were just removed).
+    """
+    room_ids = list(room_ids)
+    if not room_ids:
+        invalidate(user_ids, ("joined_rooms",))
+        return
+    members = Room.users.through.objects.filter(room_id__in=room_ids).values_list('customuser_id', flat=True)
+    creators = Room.objects.with_deleted().filter(pk__in=room_ids).values_list('created_by_id', flat=True)
+    invalidate(set(members) | set(user_ids), ("joined_rooms",))
+    invalidate(creators, ("created_rooms",))
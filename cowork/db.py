@@ -0,0 +1,100 @@
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+
+
+class DatabaseExecutor:
+    """
+    Runs ORM calls for the async consumers on a bounded pool of threads.
+
+    Bare ``sync_to_async`` is thread sensitive, so every socket in the process
+    queues up behind one thread for its database work. Here each pool thread
+    keeps its own database connection open between calls, and a connection is
+    only thrown away once it has failed.
+
+    ``stats()`` reports how many calls are waiting for a free thread.
+    """
+
+    def __init__(self, max_workers=None):
+        self._max_workers = max_workers
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.queue_depth = 0
+        self.active = 0
+        self.completed = 0
+
+    @property
+    def max_workers(self):
+        return self._max_workers or settings.CONSUMER_DB_EXECUTOR["MAX_WORKERS"]
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(
+                        max_workers=self.max_workers,
+                        thread_name_prefix="coloby-db",
+                    )
+        return self._pool
+
+    async def run(self, func, *args, **kwargs):
+        with self._stats_lock:
+            self.queue_depth += 1
+        return await sync_to_async(
+            self._call, thread_sensitive=False, executor=self.pool
+        )(func, args, kwargs)
+
+    def _call(self, func, args, kwargs):
+        with self._stats_lock:
+            self.queue_depth -= 1
+            self.active += 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._discard_broken_connections()
+            with self._stats_lock:
+                self.active -= 1
+                self.completed += 1
+
+    def _discard_broken_connections(self):
+        for conn in connections.all():
+            if conn.connection is not None and conn.errors_occurred:
+                if conn.is_usable():
+                    conn.errors_occurred = False
+                else:
+                    conn.close()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "max_workers": self.max_workers,
+                "queue_depth": self.queue_depth,
+                "active": self.active,
+                "completed": self.completed,
+            }
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+
+db_executor = DatabaseExecutor()
+
+
+def in_db_executor(func):
+    """
+    Decorator turning a synchronous ORM function or method into a coroutine
+    that runs on the shared ``db_executor``.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await db_executor.run(func, *args, **kwargs)
+
+    return wrapper
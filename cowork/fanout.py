@@ -0,0 +1,192 @@
+"""
+Delivers notifications to their recipients' inboxes.
+
+Creating a Notification only records the room-wide event. Once the
+transaction that wrote it commits, a background thread picks up every
+notification not yet delivered and writes an InboxItem for each member of
+its room except the sender, NOTIFICATION_FANOUT["CHUNK_SIZE"] at a time.
+Each chunk is one bulk_create plus one UPDATE of those recipients' unread
+counters, in its own transaction, so a 10k-member room never holds one long
+transaction and posting costs the same whatever the room's size.
+
+Undelivered notifications are found by ``delivered_at IS NULL``, so a
+delivery cut short (say, by a restart) is finished by the next one. Each
+delivery first claims its notification with a conditional UPDATE, so two
+threads or processes never deliver the same one at once; a claim older than
+NOTIFICATION_FANOUT["CLAIM_TIMEOUT"] seconds is taken to be abandoned. Items
+already written are skipped, and only the recipients actually given a new
+item have their counters moved. A notification whose delivery keeps failing
+is given up after NOTIFICATION_FANOUT["MAX_ATTEMPTS"] tries rather than
+holding up the rest.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from cowork import inbox
+from cowork.models import InboxItem, Notification, Room
+
+logger = logging.getLogger(__name__)
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def claimable(notifications, now):
+    """
+    Narrows `notifications` to those no delivery has or can give up on.
+    """
+    options = settings.NOTIFICATION_FANOUT
+    return notifications.filter(
+        Q(delivery_claimed_at__isnull=True)
+        | Q(delivery_claimed_at__lt=now - timedelta(seconds=options["CLAIM_TIMEOUT"])),
+        delivered_at__isnull=True,
+        delivery_attempts__lt=options["MAX_ATTEMPTS"],
+    )
+
+
+def claim(notification):
+    """
+    Takes `notification` for delivery and counts the attempt. Returns False
+    if it is delivered, being delivered elsewhere or out of attempts.
+    """
+    now = timezone.now()
+    claimed = claimable(Notification.objects.filter(pk=notification.pk), now).update(
+        delivery_attempts=F('delivery_attempts') + 1, delivery_claimed_at=now,
+    )
+    return claimed == 1
+
+
+def deliver_chunk(notification, recipients):
+    """
+    Writes the inbox items `recipients` do not have yet and counts them as
+    unread.
+    """
+    with transaction.atomic():
+        have = set(
+            InboxItem.objects.with_deleted()
+            .filter(notification=notification, recipient_id__in=recipients)
+            .values_list('recipient_id', flat=True)
+        )
+        new = [user_id for user_id in recipients if user_id not in have]
+        InboxItem.objects.bulk_create(
+            [
+                InboxItem(recipient_id=user_id, notification=notification, timestamp=notification.timestamp)
+                for user_id in new
+            ],
+            ignore_conflicts=True,
+        )
+        inbox.adjust(new, 1)
+
+
+def deliver(notification, chunk_size=None):
+    """
+    Writes the inbox items of one notification and marks it delivered.
+    Returns how many recipients it has, or None if it could not be claimed.
+    If delivery fails the claim is released, so the next run tries again.
+    """
+    chunk_size = chunk_size or settings.NOTIFICATION_FANOUT["CHUNK_SIZE"]
+    if not claim(notification):
+        return None
+    recipients = (
+        Room.users.through.objects.filter(room_id=notification.room_id)
+        .exclude(customuser_id=notification.sender_id)
+        .order_by('customuser_id')
+        .values_list('customuser_id', flat=True)
+    )
+    delivered = 0
+    try:
+        for chunk in chunked(recipients.iterator(chunk_size=chunk_size), chunk_size):
+            deliver_chunk(notification, chunk)
+            delivered += len(chunk)
+    except BaseException:
+        Notification.objects.filter(pk=notification.pk).update(delivery_claimed_at=None)
+        raise
+    Notification.objects.filter(pk=notification.pk).update(delivered_at=timezone.now(), delivery_claimed_at=None)
+    return delivered
+
+
+def deliver_pending(chunk_size=None):
+    """
+    Delivers every notification not delivered yet, oldest first, going on
+    past any that fail. Returns how many notifications were delivered.
+    """
+    count = 0
+    last = 0
+    while True:
+        pending = list(
+            claimable(Notification.objects.filter(pk__gt=last), timezone.now()).order_by('pk')[:100]
+        )
+        if not pending:
+            return count
+        for notification in pending:
+            last = notification.pk
+            try:
+                delivered = deliver(notification, chunk_size)
+            except Exception:
+                logger.exception(
+                    f"Error delivering notification {notification.pk} "
+                    f"(attempt {notification.delivery_attempts + 1} of {settings.NOTIFICATION_FANOUT['MAX_ATTEMPTS']})"
+                )
+                continue
+            if delivered is not None:
+                count += 1
+
+
+class FanOut:
+    """
+    Runs deliver_pending() on a single background thread. Schedule calls
+    made while a run is queued are folded into it.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._lock = threading.Lock()
+        self._queued = False
+
+    def schedule(self):
+        if not settings.NOTIFICATION_FANOUT["BACKGROUND"]:
+            deliver_pending()
+            return
+        with self._lock:
+            if self._queued:
+                return
+            self._queued = True
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="coloby-fanout")
+            self._executor.submit(self._run)
+
+    def schedule_on_commit(self):
+        transaction.on_commit(self.schedule)
+
+    def _run(self):
+        with self._lock:
+            self._queued = False
+        try:
+            deliver_pending()
+        except Exception:
+            logger.exception("Error delivering notifications")
+        finally:
+            connection.close()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+fanout = FanOut()
@@ -0,0 +1,84 @@
+import base64
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+
+from cowork import archive
+from cowork.models import Message
+
+
+def encode_cursor(created_at, pk):
+    raw = f"{created_at.isoformat()}|{pk}"
+    return base64.urlsafe_b64encode(raw.encode("utf8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    Returns the (created_at, id) pair a cursor points at. Raises ValueError
+    for anything that is not a cursor we handed out.
+    """
+    try:
+        created_at, pk = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf8").split("|")
+        return datetime.fromisoformat(created_at), int(pk)
+    except (AttributeError, UnicodeError, TypeError, ValueError) as e:
+        raise ValueError("Invalid history cursor.") from e
+
+
+def page_size(requested=None):
+    """
+    Returns the page size to use for a client's `requested` limit. Raises
+    ValueError when it is not a number.
+    """
+    if not requested:
+        return settings.CHAT_HISTORY["PAGE_SIZE"]
+    try:
+        requested = int(requested)
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid history limit.") from e
+    return max(1, min(requested, settings.CHAT_HISTORY["MAX_PAGE_SIZE"]))
+
+
+def history_page(room, before=None, limit=None):
+    """
+    Returns one page of a room's messages, newest first, that are older than
+    the `before` cursor.
+
+    Pages are keyed on (created_at, id) and served from the
+    (room, created_at, id) index, so each one costs the same however long the
+    room has existed. Once the live messages run out, the page is filled
+    from the room's archived months (see cowork/archive.py). `next` is the
+    cursor for the following, older page, or None once the start of the
+    room is reached.
+    """
+    limit = page_size(limit)
+    messages = Message.objects.filter(room=room)
+    position = None
+    if before:
+        position = decode_cursor(before)
+        created_at, pk = position
+        messages = messages.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+    rows = [
+        {"id": row["id"], "message": row["message"], "username": row["user__username"], "created_at": row["created_at"]}
+        for row in messages.order_by("-created_at", "-id")
+        .values("id", "message", "created_at", "user__username")[: limit + 1]
+    ]
+    if len(rows) <= limit:
+        # Archived messages are all older than the live ones.
+        rows += archive.history_rows(room, before=position, limit=limit + 1 - len(rows))
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    return {
+        "messages": [
+            {
+                "id": row["id"],
+                "message": row["message"],
+                "username": row["username"],
+                "created_at": row["created_at"].isoformat(),
+            }
+            for row in rows
+        ],
+        "next": encode_cursor(rows[-1]["created_at"], rows[-1]["id"]) if has_more else None,
+    }
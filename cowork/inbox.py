@@ -0,0 +1,154 @@
+"""
+Each user's notification inbox: paging, unread counts and bulk actions.
+
+A user's inbox holds an InboxItem for every notification delivered to them
+(see cowork/fanout.py), with their own read state. Items of soft-deleted
+notifications or rooms are hidden.
+
+The unread count is kept in an UnreadCounter row, moved with a single
+UPDATE whenever items are delivered or change read state (see the handlers
+in cowork/signals.py). Anything that hides or shows many items at once
+simply drops the counters of the users involved; a missing counter is
+recounted from the items on the next read.
+"""
+import base64
+from datetime import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+from cowork.models import InboxItem, UnreadCounter
+
+
+def visible(items):
+    return items.filter(notification__deleted_at__isnull=True, notification__room__deleted_at__isnull=True)
+
+
+def notifications_for(user):
+    return visible(InboxItem.objects.filter(recipient=user)).select_related('notification')
+
+
+# Unread counters
+
+def unread_count(user):
+    unread = UnreadCounter.objects.filter(user=user).values_list('unread', flat=True).first()
+    if unread is None:
+        unread = recount([user.pk])[user.pk]
+    return unread
+
+
+def recount(user_ids):
+    """
+    Recomputes the counters of `user_ids` from their inbox items and returns
+    them as {user id: unread}.
+    """
+    user_ids = set(user_ids)
+    counts = dict.fromkeys(user_ids, 0)
+    with transaction.atomic():
+        counts.update(
+            visible(InboxItem.objects.filter(recipient__in=user_ids, is_read=False))
+            .values_list('recipient').annotate(unread=Count('pk')).values_list('recipient', 'unread')
+        )
+        UnreadCounter.objects.filter(user_id__in=user_ids).delete()
+        UnreadCounter.objects.bulk_create([UnreadCounter(user_id=pk, unread=n) for pk, n in counts.items()])
+    return counts
+
+
+def forget(user_ids):
+    UnreadCounter.objects.filter(user_id__in=list(user_ids)).delete()
+
+
+def adjust(user_ids, delta):
+    """
+    Adds `delta` to the counters of `user_ids`.
+    """
+    if delta:
+        UnreadCounter.objects.filter(user_id__in=list(user_ids)).update(unread=F('unread') + delta)
+
+
+# Bulk actions
+
+def select(user, ids=None, up_to=None):
+    """
+    The user's inbox items with the given `ids`, or up to and including the
+    `up_to` timestamp, or all of them.
+    """
+    items = visible(InboxItem.objects.filter(recipient=user))
+    if ids is not None:
+        items = items.filter(pk__in=ids)
+    if up_to is not None:
+        items = items.filter(timestamp__lte=up_to)
+    return items
+
+
+def mark_read(user, items):
+    """
+    Marks `items` of the user's read with a single UPDATE and returns how
+    many changed.
+    """
+    with transaction.atomic():
+        updated = items.filter(is_read=False).update(is_read=True)
+        adjust([user.pk], -updated)
+    return updated
+
+
+def dismiss(user, items):
+    """
+    Soft-deletes `items` of the user's and returns how many changed.
+    """
+    with transaction.atomic():
+        # Lock the rows so the counter moves by exactly what the UPDATE
+        # hides; items arriving meanwhile are left alone.
+        rows = list(items.select_for_update(of=('self',)).values_list('pk', 'is_read'))
+        if not rows:
+            return 0
+        updated = items.filter(pk__lte=max(pk for pk, _ in rows)).update(deleted_at=timezone.now())
+        adjust([user.pk], -sum(not is_read for _, is_read in rows))
+    return updated
+
+
+# Paging
+
+def encode_cursor(timestamp, pk):
+    raw = f"{timestamp.isoformat()}|{pk}"
+    return base64.urlsafe_b64encode(raw.encode("utf8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    Returns the (timestamp, id) pair a cursor points at. Raises ValueError
+    for anything that is not a cursor we handed out.
+    """
+    try:
+        timestamp, pk = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf8").split("|")
+        return datetime.fromisoformat(timestamp), int(pk)
+    except (UnicodeError, TypeError, ValueError) as e:
+        raise ValueError("Invalid notification cursor") from e
+
+
+def page_size(requested=None):
+    if not requested:
+        return settings.NOTIFICATIONS["PAGE_SIZE"]
+    return max(1, min(int(requested), settings.NOTIFICATIONS["MAX_PAGE_SIZE"]))
+
+
+def notification_page(user, before=None, limit=None, unread_only=False):
+    """
+    Returns one page of the user's inbox, newest first, older than the
+    `before` cursor, as (items, next cursor). The cursor is None on the last
+    page.
+    """
+    limit = page_size(limit)
+    items = notifications_for(user)
+    if unread_only:
+        items = items.filter(is_read=False)
+    if before:
+        timestamp, pk = decode_cursor(before)
+        items = items.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk))
+
+    rows = list(items.order_by('-timestamp', '-id')[: limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1].timestamp, rows[-1].id) if has_more else None
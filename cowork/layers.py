@@ -0,0 +1,378 @@
+"""
+A channel layer that works across processes and hosts.
+
+``InMemoryChannelLayer`` only reaches consumers living in the same process, so
+every daphne worker ends up with its own private view of each room. This module
+ships a small standalone broker (``python manage.py runchannelbroker``) and a
+``BrokerChannelLayer`` that talks to it over a Unix socket or TCP.
+
+When several brokers are configured, groups and process channels are sharded
+across them by a stable hash of their name. Every worker connects to every
+broker, so a group's broker can deliver straight to the worker owning each
+member channel, batching all of a worker's channels into a single frame.
+
+Only process-specific channels (the ones handed out by ``new_channel()`` and
+used by every consumer) can be received on.
+"""
+import asyncio
+import base64
+import json
+import logging
+import struct
+import time
+import uuid
+import zlib
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BROKER_HOST = "unix:///tmp/coloby-channels.sock"
+
+FRAME_HEADER = struct.Struct("!I")
+
+# Seconds between attempts to reach a broker that went away, doubling up to
+# the maximum.
+RECONNECT_DELAY = 0.1
+MAX_RECONNECT_DELAY = 5.0
+
+
+def parse_address(address):
+    """
+    Turns "unix:///path", "/path", "tcp://host:port" or "host:port" into
+    a (family, target) tuple.
+    """
+    if address.startswith("unix://"):
+        return ("unix", address[len("unix://"):])
+    if address.startswith("/"):
+        return ("unix", address)
+    if address.startswith("tcp://"):
+        address = address[len("tcp://"):]
+    host, _, port = address.rpartition(":")
+    return ("tcp", (host or "127.0.0.1", int(port)))
+
+
+def shard_for(name, shard_count):
+    return zlib.crc32(name.encode("utf8")) % shard_count
+
+
+def _encode_default(value):
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode("ascii")}
+    raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+
+def _decode_hook(value):
+    if len(value) == 1 and "__bytes__" in value:
+        return base64.b64decode(value["__bytes__"])
+    return value
+
+
+def encode_message(message):
+    return json.dumps(message, default=_encode_default, separators=(",", ":")).encode("utf8")
+
+
+def decode_message(data):
+    return json.loads(data, object_hook=_decode_hook)
+
+
+def pack_frame(body):
+    return FRAME_HEADER.pack(len(body)) + body
+
+
+async def read_frame(reader):
+    """
+    Reads one length-prefixed frame, returning None once the peer has gone.
+    """
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+        return await reader.readexactly(FRAME_HEADER.unpack(header)[0])
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+
+async def open_connection(address):
+    family, target = address
+    if family == "unix":
+        return await asyncio.open_unix_connection(target)
+    return await asyncio.open_connection(*target)
+
+
+class ChannelBroker:
+    """
+    Keeps group membership and routes messages to the worker that owns each
+    process-specific channel.
+    """
+
+    def __init__(self, group_expiry=86400, max_buffer=8 * 1024 * 1024):
+        self.group_expiry = group_expiry
+        self.max_buffer = max_buffer
+        self.clients = {}
+        self.groups = {}
+        self.dropped = 0
+
+    async def serve(self, address):
+        family, target = parse_address(address)
+        if family == "unix":
+            return await asyncio.start_unix_server(self.handle_client, path=target)
+        return await asyncio.start_server(self.handle_client, *target)
+
+    async def handle_client(self, reader, writer):
+        prefix = None
+        try:
+            while True:
+                body = await read_frame(reader)
+                if body is None:
+                    break
+                frame = decode_message(body)
+                op = frame["op"]
+                if op == "hello":
+                    prefix = frame["prefix"]
+                    self.clients[prefix] = writer
+                elif op == "send":
+                    self.deliver({frame["channel"]}, encode_message(frame["message"]))
+                elif op == "group_add":
+                    self.groups.setdefault(frame["group"], {})[frame["channel"]] = time.time()
+                elif op == "group_discard":
+                    self.discard(frame["group"], frame["channel"])
+                elif op == "group_send":
+                    self.group_send(frame["group"], encode_message(frame["message"]))
+                elif op == "flush":
+                    self.groups.clear()
+        finally:
+            if prefix is not None and self.clients.get(prefix) is writer:
+                del self.clients[prefix]
+                self.forget_client(prefix)
+            writer.close()
+
+    def discard(self, group, channel):
+        members = self.groups.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del self.groups[group]
+
+    def forget_client(self, prefix):
+        """
+        Drops group membership of every channel that belonged to a worker
+        which has disconnected.
+        """
+        for group, members in list(self.groups.items()):
+            for channel in [c for c in members if c.startswith(prefix)]:
+                self.discard(group, channel)
+
+    def group_send(self, group, encoded_message):
+        members = self.groups.get(group)
+        if not members:
+            return
+        cutoff = time.time() - self.group_expiry
+        for channel in [c for c, joined in members.items() if joined < cutoff]:
+            self.discard(group, channel)
+        self.deliver(list(members), encoded_message)
+
+    def deliver(self, channels, encoded_message):
+        """
+        Writes one frame per owning worker carrying every target channel of
+        that worker, so a broadcast costs one write per process rather than
+        one per socket.
+        """
+        by_client = {}
+        for channel in channels:
+            prefix = channel[: channel.find("!") + 1]
+            by_client.setdefault(prefix, []).append(channel)
+
+        for prefix, targets in by_client.items():
+            writer = self.clients.get(prefix)
+            if writer is None:
+                continue
+            if writer.transport.get_write_buffer_size() > self.max_buffer:
+                self.dropped += len(targets)
+                logger.warning("Dropping message for slow channel layer client %s", prefix)
+                continue
+            body = b'{"op":"message","channels":%s,"message":%s}' % (
+                json.dumps(targets).encode("utf8"),
+                encoded_message,
+            )
+            writer.write(pack_frame(body))
+
+
+class BrokerChannelLayer(BaseChannelLayer):
+    """
+    Channel layer client for one or more ``ChannelBroker`` processes.
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(self, hosts=None, expiry=60, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.hosts = [parse_address(host) for host in (hosts or [DEFAULT_BROKER_HOST])]
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.client_prefix = "specific.%s!" % uuid.uuid4().hex
+        self.channels = {}
+        self.groups = {}
+        self._loop = None
+        self._connections = []
+        self._readers = []
+        self._lock = None
+
+    # Connection handling
+
+    def _reset_for_loop(self, loop):
+        # asyncio streams and queues are bound to the loop that created them,
+        # so a layer used from a new loop (tests, async_to_sync) starts afresh.
+        self._loop = loop
+        self._connections = [None] * len(self.hosts)
+        self._readers = [None] * len(self.hosts)
+        self._lock = asyncio.Lock()
+        self.channels = {}
+
+    async def _connection(self, index):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._reset_for_loop(loop)
+        writer = self._connections[index]
+        if writer is not None and not writer.is_closing():
+            return writer
+
+        async with self._lock:
+            writer = self._connections[index]
+            if writer is not None and not writer.is_closing():
+                return writer
+            reader, writer = await open_connection(self.hosts[index])
+            writer.write(pack_frame(encode_message({"op": "hello", "prefix": self.client_prefix})))
+            # Restore memberships this broker lost if we are reconnecting.
+            for group, channels in self.groups.items():
+                if shard_for(group, len(self.hosts)) == index:
+                    for channel in channels:
+                        writer.write(pack_frame(encode_message(
+                            {"op": "group_add", "group": group, "channel": channel}
+                        )))
+            await writer.drain()
+            self._connections[index] = writer
+            self._readers[index] = loop.create_task(self._read_loop(index, reader, writer))
+            return writer
+
+    async def _read_loop(self, index, reader, writer):
+        while True:
+            body = await read_frame(reader)
+            if body is None:
+                break
+            frame = decode_message(body)
+            for channel in frame["channels"]:
+                self._deliver_local(channel, frame["message"])
+
+        # Consumers waiting in receive() never write, so reconnect here
+        # rather than on the next write, restoring group memberships, or
+        # they would silently stop hearing from the broker.
+        logger.warning("Lost connection to channel broker, reconnecting")
+        writer.close()
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                await self._connection(index)
+                return
+            except OSError as e:
+                logger.warning("Channel broker unreachable (%s), retrying in %.1fs", e, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    async def _write(self, index, frame):
+        writer = await self._connection(index)
+        writer.write(pack_frame(encode_message(frame)))
+        await writer.drain()
+
+    def _deliver_local(self, channel, message):
+        queue = self.channels.setdefault(channel, asyncio.Queue())
+        if queue.qsize() >= self.get_capacity(channel):
+            logger.warning("Channel %s is full, dropping message", channel)
+            return
+        queue.put_nowait((time.time() + self.expiry, message))
+
+    def _clean_expired(self):
+        now = time.time()
+        for channel, queue in list(self.channels.items()):
+            # Empty queues may have a receive() waiting on them, so only drop
+            # the ones we emptied ourselves.
+            expired = False
+            while not queue.empty() and queue._queue[0][0] < now:
+                queue.get_nowait()
+                expired = True
+            if expired and queue.empty():
+                del self.channels[channel]
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        assert "!" in channel, "BrokerChannelLayer only supports process-specific channels"
+        if self.non_local_name(channel) == self.client_prefix:
+            queue = self.channels.get(channel)
+            if queue is not None and queue.qsize() >= self.get_capacity(channel):
+                raise ChannelFull(channel)
+            self._deliver_local(channel, message)
+            return
+        index = shard_for(self.non_local_name(channel), len(self.hosts))
+        await self._write(index, {"op": "send", "channel": channel, "message": message})
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        assert channel.startswith(self.client_prefix), "Can only receive on channels made by new_channel()"
+        # Make sure we are connected, otherwise nothing can ever arrive.
+        for index in range(len(self.hosts)):
+            await self._connection(index)
+        self._clean_expired()
+        queue = self.channels.setdefault(channel, asyncio.Queue())
+        try:
+            _, message = await queue.get()
+        finally:
+            if queue.empty() and self.channels.get(channel) is queue:
+                del self.channels[channel]
+        return message
+
+    async def new_channel(self, prefix="specific."):
+        return "%s%s" % (self.client_prefix, uuid.uuid4().hex[:12])
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        self.groups.setdefault(group, set()).add(channel)
+        index = shard_for(group, len(self.hosts))
+        await self._write(index, {"op": "group_add", "group": group, "channel": channel})
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), "Invalid channel name"
+        assert self.valid_group_name(group), "Invalid group name"
+        channels = self.groups.get(group)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self.groups[group]
+        index = shard_for(group, len(self.hosts))
+        await self._write(index, {"op": "group_discard", "group": group, "channel": channel})
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Invalid group name"
+        index = shard_for(group, len(self.hosts))
+        await self._write(index, {"op": "group_send", "group": group, "message": message})
+
+    # Flush extension
+
+    async def flush(self):
+        self.channels = {}
+        self.groups = {}
+        for index in range(len(self.hosts)):
+            await self._write(index, {"op": "flush"})
+
+    async def close(self):
+        for reader in self._readers:
+            if reader is not None:
+                reader.cancel()
+        for writer in self._connections:
+            if writer is not None:
+                writer.close()
+        self._loop = None
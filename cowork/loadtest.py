@@ -0,0 +1,310 @@
+"""
+WebSocket load test for the chat and notification consumers.
+
+Simulated clients spread over a number of rooms connect, then each sends
+messages at a fixed interval. Every message carries the time it was sent, so
+each client that receives the broadcast records one end-to-end latency.
+
+Clients either talk to the ASGI application in this process through
+``channels.testing.WebsocketCommunicator`` or open real sockets to a running
+server (``daphne coloby.asgi:application``), authenticated with a session
+cookie. ``bench_websockets`` is the command-line entry point.
+"""
+import asyncio
+import json
+import random
+import secrets
+import time
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.contrib.sessions.backends.db import SessionStore
+from django.utils import timezone
+
+from cowork.management.commands._bench import max_rss_kb, summarize_latencies
+from cowork.models import Room
+from cowork.routing import websocket_urlpatterns
+
+User = get_user_model()
+
+PREFIX = "loadtest"
+
+PATHS = {
+    "chat": "chat/{room}/",
+    "notifications": "ws/notifications/{room}/",
+}
+
+
+def new_run_id():
+    return secrets.token_hex(4)
+
+
+def run_prefix(run_id):
+    return f"{PREFIX}-{run_id}-"
+
+
+def create_fixtures(clients, rooms, run_id=None):
+    """
+    Creates one user per client and the rooms they are spread over, their
+    usernames and slugs marked with `run_id` so delete_fixtures() only ever
+    removes what this run made. Returns (users, rooms).
+    """
+    prefix = run_prefix(run_id or new_run_id())
+    users = User.objects.bulk_create([
+        User(username=f"{prefix}{i}", email=f"{prefix}{i}@example.com", first_name="Load", password="!")
+        for i in range(clients)
+    ])
+    rooms = Room.objects.bulk_create([
+        Room(name=f"Load test {i}", slug=f"{prefix}{i}") for i in range(rooms)
+    ])
+    # bulk_create only fills in primary keys on some databases.
+    rooms = list(Room.objects.filter(slug__startswith=prefix).order_by("id"))
+    return users, rooms
+
+
+def delete_fixtures(run_id):
+    """
+    Deletes the users and rooms create_fixtures() made for `run_id`.
+    """
+    prefix = run_prefix(run_id)
+    Room.objects.with_deleted().filter(slug__startswith=prefix).hard_delete()
+    User.objects.filter(username__startswith=prefix).delete()
+
+
+def session_cookie(user):
+    session = SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = "django.contrib.auth.backends.ModelBackend"
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.create()
+    return f"sessionid={session.session_key}"
+
+
+def outgoing_frame(consumer, user, seq):
+    stamp = f"{time.time():.6f}|{seq}"
+    if consumer == "chat":
+        return json.dumps({"message": stamp})
+    return json.dumps({"type": "message", "message": stamp, "sender_id": str(user.pk)})
+
+
+def sent_at(text):
+    """
+    The send time carried by a broadcast frame, or None for anything else
+    (acks, presence, errors).
+    """
+    frame = json.loads(text)
+    message = frame.get("message") if isinstance(frame, dict) else None
+    if not isinstance(message, str) or "|" not in message:
+        return None
+    try:
+        return float(message.split("|", 1)[0])
+    except ValueError:
+        return None
+
+
+class CommunicatorClient:
+    def __init__(self, application, path, user):
+        self.communicator = WebsocketCommunicator(application, path)
+        self.communicator.scope["user"] = user
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        return connected
+
+    async def send(self, text):
+        await self.communicator.send_to(text_data=text)
+
+    async def receive(self):
+        while True:
+            output = await self.communicator.receive_output(timeout=3600)
+            if output["type"] == "websocket.send":
+                return output.get("text") or ""
+            if output["type"] == "websocket.close":
+                raise ConnectionError("closed by server")
+
+    async def close(self):
+        if not self.communicator.future.done():
+            await self.communicator.disconnect()
+
+
+class SocketClient:
+    def __init__(self, session, url, cookie):
+        self.session = session
+        self.url = url
+        self.cookie = cookie
+        self.ws = None
+
+    async def connect(self):
+        self.ws = await self.session.ws_connect(self.url, headers={"Cookie": self.cookie})
+        return True
+
+    async def send(self, text):
+        await self.ws.send_str(text)
+
+    async def receive(self):
+        import aiohttp
+
+        message = await self.ws.receive()
+        if message.type != aiohttp.WSMsgType.TEXT:
+            raise ConnectionError(f"unexpected {message.type.name} frame")
+        return message.data
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+
+
+async def run(clients, consumer="chat", messages=5, interval=1.0, timeout=30.0, connect_concurrency=100):
+    """
+    Drives `clients`, a list of (client, user, room_index) tuples, through
+    one load test and returns the results as a dict.
+    """
+    room_sizes = {}
+    for _, _, room in clients:
+        room_sizes[room] = room_sizes.get(room, 0) + 1
+
+    # Connect
+    connect_latencies = []
+    failed = 0
+    limit = asyncio.Semaphore(connect_concurrency)
+
+    async def connect(client):
+        nonlocal failed
+        async with limit:
+            started = time.perf_counter()
+            try:
+                ok = await client.connect()
+            except Exception:
+                ok = False
+            if ok:
+                connect_latencies.append(time.perf_counter() - started)
+            else:
+                failed += 1
+            return ok
+
+    connect_started = time.perf_counter()
+    connected = await asyncio.gather(*(connect(client) for client, _, _ in clients))
+    connect_seconds = time.perf_counter() - connect_started
+    live = [entry for entry, ok in zip(clients, connected) if ok]
+
+    # Broadcast
+    latencies = []
+    errors = 0
+    last_received = 0.0
+    expected = sum(messages * room_sizes[room] for _, _, room in live)
+    everything_in = asyncio.Event()
+    if not expected:
+        everything_in.set()
+
+    async def read(client):
+        nonlocal errors, last_received
+        while True:
+            text = await client.receive()
+            stamp = sent_at(text)
+            if stamp is None:
+                if '"error"' in text:
+                    errors += 1
+                continue
+            last_received = time.time()
+            latencies.append(last_received - stamp)
+            if len(latencies) >= expected:
+                everything_in.set()
+
+    async def write(client, user):
+        await asyncio.sleep(random.random() * interval)
+        for seq in range(messages):
+            await client.send(outgoing_frame(consumer, user, seq))
+            await asyncio.sleep(interval)
+
+    readers = [asyncio.ensure_future(read(client)) for client, _, _ in live]
+    send_started = time.time()
+    await asyncio.gather(*(write(client, user) for client, user, _ in live))
+    try:
+        await asyncio.wait_for(everything_in.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    for reader in readers:
+        reader.cancel()
+    await asyncio.gather(*readers, return_exceptions=True)
+    await asyncio.gather(*(client.close() for client, _, _ in live), return_exceptions=True)
+    duration = max((last_received or time.time()) - send_started, 1e-9)
+
+    return {
+        "consumer": consumer,
+        "finished_at": timezone.now().isoformat(),
+        "clients": len(clients),
+        "rooms": len(room_sizes),
+        "messages_per_client": messages,
+        "interval_s": interval,
+        "connect": {
+            "connected": len(live),
+            "failed": failed,
+            "seconds": round(connect_seconds, 3),
+            "per_second": round(len(live) / connect_seconds, 1) if connect_seconds else 0.0,
+            "latency": summarize_latencies(connect_latencies),
+        },
+        "broadcast": {
+            "sent": messages * len(live),
+            "expected": expected,
+            "delivered": len(latencies),
+            "errors": errors,
+            "messages_per_second": round(messages * len(live) / duration, 1),
+            "deliveries_per_second": round(len(latencies) / duration, 1),
+            "latency": summarize_latencies(latencies),
+        },
+        "rss_kb": max_rss_kb(),
+    }
+
+
+def room_key(room, consumer):
+    # NotificationConsumer addresses rooms by primary key.
+    return room.slug if consumer == "chat" else room.pk
+
+
+def assign_rooms(users, rooms, consumer):
+    """
+    Spreads users round-robin over rooms; yields (user, room_index, path).
+    """
+    for i, user in enumerate(users):
+        room = i % len(rooms)
+        yield user, room, PATHS[consumer].format(room=room_key(rooms[room], consumer))
+
+
+async def run_in_process(users, rooms, consumer="chat", **options):
+    """
+    Load test against the ASGI app in this process. Users are put straight
+    on the scope, so the session lookup done by AuthMiddlewareStack is not
+    measured.
+    """
+    from cowork.consumers import message_buffer
+    from cowork.notifications import notification_events
+    from cowork.presence import presence
+
+    application = URLRouter(websocket_urlpatterns)
+    clients = [
+        (CommunicatorClient(application, "/" + path, user), user, room)
+        for user, room, path in assign_rooms(users, rooms, consumer)
+    ]
+    try:
+        return await run(clients, consumer, **options)
+    finally:
+        await message_buffer.flush()
+        await notification_events.flush()
+        await presence.stop()
+
+
+async def run_against_server(base_url, users, rooms, cookies, consumer="chat", **options):
+    """
+    Load test over real sockets against a server at `base_url`, e.g.
+    ws://127.0.0.1:8000. `cookies` holds one session cookie per user.
+    """
+    import aiohttp
+
+    base_url = base_url.rstrip("/")
+    async with aiohttp.ClientSession() as session:
+        clients = [
+            (SocketClient(session, f"{base_url}/{path}", cookie), user, room)
+            for (user, room, path), cookie in zip(assign_rooms(users, rooms, consumer), cookies)
+        ]
+        return await run(clients, consumer, **options)
@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from cowork import archive
+from cowork.models import Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves messages older than --days days (CHAT_ARCHIVE['RETENTION_DAYS'] by default) "
+        "into one compressed file per room and month. History paging keeps serving them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=None)
+        parser.add_argument("--dry-run", action="store_true", help="Only count what would be archived.")
+
+    def handle(self, *args, **options):
+        days = options["days"] if options["days"] is not None else settings.CHAT_ARCHIVE["RETENTION_DAYS"]
+        horizon = timezone.now() - timedelta(days=days)
+        if options["dry_run"]:
+            self.stdout.write(f"{Message.objects.filter(created_at__lt=horizon).count()} messages to archive")
+            return
+        moved, months = archive.archive(horizon)
+        self.stdout.write(f"Archived {moved} messages into {months} monthly files")
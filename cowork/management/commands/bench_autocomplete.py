@@ -0,0 +1,100 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from cowork.autocomplete import RoomAutocomplete, words
+from cowork.management.commands._bench import max_rss_kb, summarize_latencies
+
+VOCABULARY = (
+    "design review backend frontend mobile android ios web api platform data science machine learning "
+    "research growth marketing sales support help desk ops infra security cloud devops release qa testing "
+    "hiring onboarding product roadmap planning standup weekly sync team project alpha beta gamma delta "
+    "launch rocket apollo zeus atlas orion nova pixel kernel compiler database search payments billing"
+).split()
+
+
+def synthetic_rooms(count, seed):
+    """
+    Yields (id, name, slug, members) for `count` rooms named from a small
+    vocabulary plus a number, with a long-tailed member count.
+    """
+    rng = random.Random(seed)
+    for pk in range(1, count + 1):
+        name = " ".join(rng.sample(VOCABULARY, rng.randint(1, 3))).title() + f" {rng.randint(1, 999)}"
+        slug = "-".join(words(name)) + f"-{pk}"
+        yield pk, name, slug, int(rng.paretovariate(1.2)) - 1
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures the room autocomplete index on synthetic public rooms, in memory: build time, RSS, "
+        "lookup latency for queries of growing length, and the cost of re-indexing a saved room. "
+        "A linear scan over every name, the in-process equivalent of an icontains query, is timed "
+        "on a few queries for comparison."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=1_000_000)
+        parser.add_argument("--queries", type=int, default=20_000)
+        parser.add_argument("--limit", type=int, default=10)
+        parser.add_argument("--scans", type=int, default=5, help="Linear scans to time for comparison.")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rss_before = max_rss_kb()
+        rows = list(synthetic_rooms(options["rooms"], options["seed"]))
+        index = RoomAutocomplete(max_age=float("inf"))
+        started = time.perf_counter()
+        index.load(rows)
+        build_seconds = time.perf_counter() - started
+        index_rss_kb = max_rss_kb() - rss_before
+        self.stdout.write(
+            f"{options['rooms']} rooms indexed in {build_seconds:.2f}s, "
+            f"{len(index._postings)} keys, peak RSS +{index_rss_kb / 1024:.0f} MB (rows included)"
+        )
+
+        rng = random.Random(options["seed"] + 1)
+        queries = {}
+        for _ in range(options["queries"]):
+            name = rng.choice(rows)[1].lower()
+            length = rng.randint(1, len(name))
+            queries.setdefault(min(length, 12), []).append(name[:length])
+
+        self.stdout.write(f"{'query len':>9} {'count':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        for length in sorted(queries):
+            latencies = []
+            for query in queries[length]:
+                started = time.perf_counter()
+                index.lookup(query, options["limit"])
+                latencies.append(time.perf_counter() - started)
+            summary = summarize_latencies(latencies)
+            label = f"{length}+" if length == 12 else str(length)
+            self.stdout.write(
+                f"{label:>9} {summary['count']:>7} {summary['p50_ms']:>8} {summary['p95_ms']:>8} "
+                f"{summary['p99_ms']:>8} {summary['max_ms']:>8}"
+            )
+
+        class SavedRoom:
+            is_private = False
+            deleted_at = None
+
+        latencies = []
+        for _ in range(1000):
+            pk, name, _, _ = rng.choice(rows)
+            room = SavedRoom()
+            room.pk, room.name, room.slug = pk, name + " renamed", f"renamed-{pk}"
+            started = time.perf_counter()
+            index.update(room)
+            latencies.append(time.perf_counter() - started)
+        summary = summarize_latencies(latencies)
+        self.stdout.write(f"re-index on save: p50 {summary['p50_ms']} ms, p99 {summary['p99_ms']} ms")
+
+        latencies = []
+        names = [name.lower() for _, name, _, _ in rows]
+        for query in rng.sample(queries[max(queries)], min(options["scans"], len(queries[max(queries)]))):
+            started = time.perf_counter()
+            [name for name in names if query in name]
+            latencies.append(time.perf_counter() - started)
+        summary = summarize_latencies(latencies)
+        self.stdout.write(f"linear scan: p50 {summary['p50_ms']} ms, max {summary['max_ms']} ms")
@@ -0,0 +1,139 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from cowork.layers import BrokerChannelLayer, ChannelBroker
+
+from ._bench import summarize_latencies
+
+GROUP = "bench_fanout"
+
+
+def run_broker(bind):
+    async def serve():
+        server = await ChannelBroker().serve(bind)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def run_worker(hosts, sockets, messages, timeout, results):
+    asyncio.run(_worker(hosts, sockets, messages, timeout, results))
+
+
+async def _worker(hosts, sockets, messages, timeout, results):
+    layer = BrokerChannelLayer(hosts=hosts, capacity=messages + 1)
+    channels = [await layer.new_channel() for _ in range(sockets)]
+    for channel in channels:
+        await layer.group_add(GROUP, channel)
+    results.put(("ready", None))
+
+    latencies = []
+    last_received = 0.0
+
+    async def drain(channel):
+        nonlocal last_received
+        for _ in range(messages):
+            message = await layer.receive(channel)
+            last_received = time.time()
+            latencies.append(last_received - message["sent_at"])
+
+    try:
+        await asyncio.wait_for(asyncio.gather(*(drain(c) for c in channels)), timeout)
+    except asyncio.TimeoutError:
+        pass
+    results.put(("done", (latencies, last_received)))
+    await layer.close()
+
+
+async def publish(hosts, messages, rate):
+    layer = BrokerChannelLayer(hosts=hosts)
+    interval = 1.0 / rate if rate else 0
+    started = time.time()
+    for _ in range(messages):
+        await layer.group_send(GROUP, {"type": "bench.message", "sent_at": time.time()})
+        if interval:
+            await asyncio.sleep(interval)
+    await layer.close()
+    return started
+
+
+class Command(BaseCommand):
+    help = "Measures group_send fan-out latency and throughput of BrokerChannelLayer across worker processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+        parser.add_argument("--sockets", type=int, default=50, help="Group members per worker process.")
+        parser.add_argument("--messages", type=int, default=500, help="Broadcasts per run.")
+        parser.add_argument("--rate", type=int, default=500, help="Broadcasts per second, 0 for unpaced.")
+        parser.add_argument("--brokers", type=int, default=1, help="Number of broker shards.")
+        parser.add_argument("--timeout", type=float, default=60.0)
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"{'workers':>8} {'sockets':>8} {'delivered':>10} {'deliv/s':>10} "
+            f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+        )
+        for workers in options["workers"]:
+            row = self.run(workers, options)
+            self.stdout.write(
+                f"{workers:>8} {row['sockets']:>8} {row['count']:>10} {row['throughput']:>10.0f} "
+                f"{row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f} {row['p99_ms']:>8.2f}"
+            )
+
+    def run(self, workers, options):
+        sockets, messages = options["sockets"], options["messages"]
+        with tempfile.TemporaryDirectory() as tmp:
+            hosts = [f"unix://{os.path.join(tmp, f'broker{i}.sock')}" for i in range(options["brokers"])]
+            brokers = [multiprocessing.Process(target=run_broker, args=(host,), daemon=True) for host in hosts]
+            for broker in brokers:
+                broker.start()
+            self.wait_for_sockets(hosts)
+
+            results = multiprocessing.Queue()
+            procs = [
+                multiprocessing.Process(
+                    target=run_worker,
+                    args=(hosts, sockets, messages, options["timeout"], results),
+                    daemon=True,
+                )
+                for _ in range(workers)
+            ]
+            for proc in procs:
+                proc.start()
+            for _ in procs:
+                results.get(timeout=options["timeout"])
+
+            started = asyncio.run(publish(hosts, messages, options["rate"]))
+
+            latencies, finished = [], started
+            for _ in procs:
+                try:
+                    _, (worker_latencies, last_received) = results.get(timeout=options["timeout"] + 5)
+                except queue.Empty:
+                    continue
+                latencies.extend(worker_latencies)
+                finished = max(finished, last_received)
+
+            for proc in procs + brokers:
+                proc.terminate()
+                proc.join()
+
+        row = summarize_latencies(latencies)
+        row["sockets"] = workers * sockets
+        row["throughput"] = row["count"] / max(finished - started, 1e-9)
+        return row
+
+    def wait_for_sockets(self, hosts, timeout=10):
+        deadline = time.time() + timeout
+        for host in hosts:
+            while not os.path.exists(host[len("unix://"):]):
+                if time.time() > deadline:
+                    raise RuntimeError(f"Broker at {host} did not start")
+                time.sleep(0.01)
@@ -0,0 +1,61 @@
+import asyncio
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from accounts.models import CustomUser
+from cowork.db import DatabaseExecutor
+from cowork.models import Room
+
+
+def consumer_query(slug, user_id):
+    # The same shape of work ChatConsumer does per socket: look the room up
+    # and check membership.
+    room = Room.objects.filter(slug=slug).first()
+    return room.users.filter(pk=user_id).exists()
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares consumer ORM throughput through thread-sensitive sync_to_async and through "
+        "the dedicated DatabaseExecutor. Runs against a throwaway test database; the gap is "
+        "largest on a networked database such as PostgreSQL, where threads wait on I/O."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sockets", type=int, nargs="+", default=[100, 1000, 5000])
+        parser.add_argument("--messages", type=int, default=5, help="Queries per socket.")
+        parser.add_argument("--workers", type=int, default=8, help="DatabaseExecutor pool size.")
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            user = CustomUser.objects.create_user(email="bench@example.com", password="bench", username="bench")
+            room = Room.objects.create(name="Bench", slug="bench-room")
+            room.users.add(user)
+
+            self.stdout.write(f"{'sockets':>8} {'mode':>16} {'msgs/s':>10} {'seconds':>8}")
+            for sockets in options["sockets"]:
+                executor = DatabaseExecutor(max_workers=options["workers"])
+                modes = {
+                    "sync_to_async": sync_to_async(consumer_query),
+                    "db_executor": lambda *a: executor.run(consumer_query, *a),
+                }
+                for mode, call in modes.items():
+                    elapsed = asyncio.run(self.run(call, sockets, options["messages"], room.slug, user.pk))
+                    total = sockets * options["messages"]
+                    self.stdout.write(f"{sockets:>8} {mode:>16} {total / elapsed:>10.0f} {elapsed:>8.2f}")
+                executor.shutdown()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    async def run(self, call, sockets, messages, slug, user_id):
+        async def socket():
+            for _ in range(messages):
+                await call(slug, user_id)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(socket() for _ in range(sockets)))
+        return time.perf_counter() - started
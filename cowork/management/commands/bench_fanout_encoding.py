@@ -0,0 +1,54 @@
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from cowork.consumers import ChatConsumer
+
+
+async def legacy_chat_message(consumer, event):
+    # ChatConsumer.chat_message before frames were encoded once by the sender.
+    await consumer.send(text_data=json.dumps({"message": event["message"], "username": event["username"]}))
+
+
+class Command(BaseCommand):
+    help = "Measures CPU time per broadcast spent in ChatConsumer.chat_message, per-recipient encoding vs encode-once."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 2000])
+        parser.add_argument("--broadcasts", type=int, default=200)
+        parser.add_argument("--message-length", type=int, default=280)
+
+    def handle(self, *args, **options):
+        message = "x" * options["message_length"]
+        self.stdout.write(f"{'members':>8} {'per-socket us':>14} {'encode-once us':>15} {'speedup':>8}")
+        for size in options["sizes"]:
+            legacy, current = asyncio.run(self.run(size, options["broadcasts"], message))
+            self.stdout.write(f"{size:>8} {legacy:>14.0f} {current:>15.0f} {legacy / current:>7.1f}x")
+
+    async def run(self, size, broadcasts, message):
+        async def discard(message):
+            pass
+
+        consumers = []
+        for _ in range(size):
+            consumer = ChatConsumer()
+            consumer.base_send = discard
+            consumers.append(consumer)
+
+        started = time.process_time()
+        for _ in range(broadcasts):
+            event = {"type": "chat_message", "message": message, "username": "bench"}
+            for consumer in consumers:
+                await legacy_chat_message(consumer, event)
+        legacy = (time.process_time() - started) / broadcasts
+
+        started = time.process_time()
+        for _ in range(broadcasts):
+            event = {"type": "chat_message", "text": json.dumps({"message": message, "username": "bench"})}
+            for consumer in consumers:
+                await consumer.chat_message(event)
+        current = (time.process_time() - started) / broadcasts
+
+        return legacy * 1e6, current * 1e6
@@ -0,0 +1,77 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+
+from accounts.models import CustomUser
+from cowork.fanout import fanout
+from cowork.models import InboxItem, Notification, Room
+from cowork.management.commands._bench import summarize_latencies
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures notification delivery into rooms of growing size against a throwaway test "
+        "database: how long posting a notification takes (the request's share), how long the "
+        "background fan-out takes to deliver it, and, for comparison, writing one inbox item per "
+        "recipient synchronously in the request."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--members", type=int, nargs="+", default=[10, 1000, 10000])
+        parser.add_argument("--posts", type=int, default=5, help="Notifications posted per room.")
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument("--legacy", action="store_true", help="Also time per-recipient creation.")
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            CustomUser.objects.bulk_create(
+                CustomUser(email=f"bench{i}@example.com", username=f"bench{i}", password="!")
+                for i in range(max(options["members"]) + 1)
+            )
+            users = list(CustomUser.objects.order_by("pk").values_list("pk", flat=True))
+            sender = users[0]
+
+            self.stdout.write(
+                f"{'members':>8} {'post p50 ms':>12} {'post max ms':>12} {'deliver s':>10} {'rows/s':>10}"
+                + (f" {'legacy s':>9}" if options["legacy"] else "")
+            )
+            fan_out = {**settings.NOTIFICATION_FANOUT, "CHUNK_SIZE": options["chunk_size"], "BACKGROUND": True}
+            for members in options["members"]:
+                room = Room.objects.create(name=f"Bench {members}", slug=f"bench-{members}")
+                Room.users.through.objects.bulk_create(
+                    Room.users.through(room_id=room.pk, customuser_id=pk) for pk in users[: members + 1]
+                )
+                posts = []
+                delivered = 0
+                with override_settings(NOTIFICATION_FANOUT=fan_out):
+                    for i in range(options["posts"]):
+                        started = time.perf_counter()
+                        Notification.objects.create(room=room, sender_id=sender, message=f"post {i}")
+                        posts.append(time.perf_counter() - started)
+                        # Wait for the background delivery before the next
+                        # post, so each one is timed on its own.
+                        fanout.shutdown()
+                        delivered += time.perf_counter() - started - posts[-1]
+                rows = InboxItem.objects.filter(notification__room=room).count()
+                summary = summarize_latencies(posts)
+                line = (
+                    f"{members:>8} {summary['p50_ms']:>12} {summary['max_ms']:>12} "
+                    f"{delivered / options['posts']:>10.3f} {rows / delivered:>10.0f}"
+                )
+                if options["legacy"]:
+                    notification = Notification.objects.filter(room=room).first()
+                    InboxItem.objects.filter(notification=notification).hard_delete()
+                    started = time.perf_counter()
+                    for pk in users[1: members + 1]:
+                        InboxItem.objects.create(
+                            recipient_id=pk, notification=notification, timestamp=notification.timestamp
+                        )
+                    line += f" {time.perf_counter() - started:>9.3f}"
+                self.stdout.write(line)
+        finally:
+            fanout.shutdown()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,87 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from cowork import loadtest
+
+
+class Command(BaseCommand):
+    help = (
+        "Load tests ChatConsumer or NotificationConsumer with simulated clients and reports connect "
+        "rate, broadcast latency, messages/sec and RSS as JSON. Without --url the clients talk to the "
+        "ASGI app in this process, on a throwaway test database. With --url they open real sockets to "
+        "a running server (e.g. daphne coloby.asgi:application) that shares this project's database; "
+        "the users and rooms made for the run are only deleted afterwards with --cleanup."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--consumer", choices=sorted(loadtest.PATHS), default="chat")
+        parser.add_argument("--clients", type=int, default=1000)
+        parser.add_argument("--rooms", type=int, default=50)
+        parser.add_argument("--messages", type=int, default=5, help="Messages sent by each client.")
+        parser.add_argument("--interval", type=float, default=1.0, help="Seconds between a client's messages.")
+        parser.add_argument("--timeout", type=float, default=30.0, help="Seconds to wait for the last broadcasts.")
+        parser.add_argument("--url", help="Base URL of a running server, e.g. ws://127.0.0.1:8000.")
+        parser.add_argument("--server-pid", type=int, help="Also report the RSS of this server process.")
+        parser.add_argument("--output", help="Write the results to this JSON file.")
+        parser.add_argument(
+            "--cleanup", action="store_true",
+            help="With --url, delete the users and rooms made for this run once it is over.",
+        )
+
+    def handle(self, *args, **options):
+        if options["clients"] < 1 or options["rooms"] < 1:
+            raise CommandError("--clients and --rooms must be at least 1.")
+        run_options = {
+            "consumer": options["consumer"],
+            "messages": options["messages"],
+            "interval": options["interval"],
+            "timeout": options["timeout"],
+        }
+
+        if options["url"]:
+            run_id = loadtest.new_run_id()
+            users, rooms = loadtest.create_fixtures(options["clients"], options["rooms"], run_id)
+            cookies = [loadtest.session_cookie(user) for user in users]
+            try:
+                results = asyncio.run(loadtest.run_against_server(options["url"], users, rooms, cookies, **run_options))
+            finally:
+                if options["cleanup"]:
+                    loadtest.delete_fixtures(run_id)
+                else:
+                    self.stderr.write(
+                        f"Left the users and rooms starting with {loadtest.run_prefix(run_id)} in place; "
+                        "pass --cleanup to delete them."
+                    )
+            results["mode"] = "sockets"
+            results["run_id"] = run_id
+        else:
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                users, rooms = loadtest.create_fixtures(options["clients"], options["rooms"])
+                results = asyncio.run(loadtest.run_in_process(users, rooms, **run_options))
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+            results["mode"] = "in-process"
+
+        if options["server_pid"]:
+            results["server_rss_kb"] = self.server_rss_kb(options["server_pid"])
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+        self.stdout.write(output)
+
+    def server_rss_kb(self, pid):
+        # Peak resident set size, as ru_maxrss reports it for this process.
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1])
+        except OSError as e:
+            raise CommandError(f"Cannot read RSS of process {pid}: {e}")
+        return None
@@ -0,0 +1,64 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import RestrictedError
+from django.utils import timezone
+
+from cowork.models import Comment, InboxItem, Message, Notification, Room, Task
+
+# Children before parents, so rows are gone before whatever they point at.
+MODELS = (InboxItem, Notification, Comment, Message, Task, Room)
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes for good the rows that were soft-deleted more than --days days ago, "
+        "--chunk-size rows per transaction so no table is locked for long."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=30)
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument("--dry-run", action="store_true", help="Only count what would be deleted.")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        for model in MODELS:
+            expired = model.objects.with_deleted().filter(deleted_at__lt=cutoff)
+            if options["dry_run"]:
+                self.stdout.write(f"{model.__name__}: {expired.count()} rows to purge")
+                continue
+            purged, kept = self.purge(expired, options["chunk_size"])
+            line = f"{model.__name__}: {purged} rows purged"
+            if kept:
+                line += f", {kept} kept because live rows still refer to them"
+            self.stdout.write(line)
+
+    def purge(self, expired, chunk_size):
+        # Walks the primary key once instead of rescanning from the start
+        # for every chunk.
+        purged = kept = 0
+        last = None
+        while True:
+            chunk = expired.order_by('pk')
+            if last is not None:
+                chunk = chunk.filter(pk__gt=last)
+            pks = list(chunk.values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                return purged, kept
+            last = pks[-1]
+            try:
+                with transaction.atomic():
+                    expired.filter(pk__in=pks).hard_delete()
+                purged += len(pks)
+            except RestrictedError:
+                # A live row (say, a task in a deleted room) still points at
+                # some of these; delete the others one by one.
+                for pk in pks:
+                    try:
+                        with transaction.atomic():
+                            expired.filter(pk=pk).hard_delete()
+                        purged += 1
+                    except RestrictedError:
+                        kept += 1
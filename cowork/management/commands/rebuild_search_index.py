@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from cowork import search
+from cowork.models import SearchEntry
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds the search index from scratch, e.g. after loading data with bulk_create or "
+        "loaddata, which bypass the signals that keep it current."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        with transaction.atomic():
+            SearchEntry.objects.all().delete()
+            for model in search.DOCUMENTS:
+                indexed = 0
+                batch = []
+                for instance in model.objects.order_by('pk').iterator(chunk_size=batch_size):
+                    entry = search.build_entry(instance)
+                    if entry is not None:
+                        batch.append(entry)
+                    if len(batch) >= batch_size:
+                        indexed += len(SearchEntry.objects.bulk_create(batch))
+                        batch = []
+                indexed += len(SearchEntry.objects.bulk_create(batch))
+                self.stdout.write(f"{model.__name__}: {indexed} entries")
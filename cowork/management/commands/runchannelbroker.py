@@ -0,0 +1,38 @@
+import asyncio
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from cowork.layers import DEFAULT_BROKER_HOST, ChannelBroker, parse_address
+
+
+class Command(BaseCommand):
+    help = "Runs a channel layer broker shared by all ASGI workers."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--bind",
+            default=None,
+            help="Address to listen on, e.g. unix:///tmp/coloby-channels.sock or tcp://0.0.0.0:7400. "
+                 "Defaults to the first entry of CHANNEL_BROKER_HOSTS.",
+        )
+        parser.add_argument("--group-expiry", type=int, default=86400)
+
+    def handle(self, *args, **options):
+        bind = options["bind"] or (settings.CHANNEL_BROKER_HOSTS.split() or [DEFAULT_BROKER_HOST])[0]
+        family, target = parse_address(bind)
+        if family == "unix" and os.path.exists(target):
+            os.unlink(target)
+
+        broker = ChannelBroker(group_expiry=options["group_expiry"])
+        self.stdout.write(f"Channel broker listening on {bind}")
+        try:
+            asyncio.run(self.serve(broker, bind))
+        except KeyboardInterrupt:
+            pass
+
+    async def serve(self, broker, bind):
+        server = await broker.serve(bind)
+        async with server:
+            await server.serve_forever()
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from cowork import outbox
+
+
+class Command(BaseCommand):
+    help = (
+        "Sends the queued transactional email that is due. With --loop, keeps doing so every "
+        "--interval seconds; run it that way when EMAIL_OUTBOX['SEND_ON_COMMIT'] is off."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--loop", action="store_true")
+        parser.add_argument("--interval", type=float, default=5.0)
+        parser.add_argument("--batch-size", type=int, default=None)
+
+    def handle(self, *args, **options):
+        while True:
+            sent = outbox.send_pending(options["batch_size"])
+            if sent or not options["loop"]:
+                self.stdout.write(f"Sent {sent} emails, {outbox.pending().count()} still queued")
+            if not options["loop"]:
+                return
+            try:
+                time.sleep(options["interval"])
+            except KeyboardInterrupt:
+                return
@@ -0,0 +1,236 @@
+"""
+Process-wide performance metrics, served in the Prometheus text format.
+
+MetricsMiddleware times every request and labels it with the name of the
+URL pattern it resolved to, so cardinality stays bounded by the routes in
+cowork/urls.py and accounts/urls.py. For each view it records a latency
+histogram, the number and total time of its database queries, the time
+spent producing serializer .data, and the bytes it responded with.
+ConsumerMetricsMixin does the same for the WebSocket consumers:
+connections, open sockets, frames received and a receive-time histogram.
+
+The metrics endpoint adds gauges read from the rest of the process when
+scraped: the send queues, the database executor and the user cache.
+Every number is per process; Prometheus sums them across workers.
+"""
+import contextvars
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+HELP = {
+    "coloby_http_request_duration_seconds": ("histogram", "Request latency by URL name."),
+    "coloby_http_requests_total": ("counter", "Requests by URL name, method and status."),
+    "coloby_http_db_queries_total": ("counter", "Database queries made while serving requests."),
+    "coloby_http_db_query_seconds_total": ("counter", "Time spent in database queries while serving requests."),
+    "coloby_http_serializer_seconds_total": ("counter", "Time spent producing serializer data."),
+    "coloby_http_response_bytes_total": ("counter", "Response body bytes, streaming responses excluded."),
+    "coloby_websocket_connections_total": ("counter", "WebSocket connections by consumer."),
+    "coloby_websocket_open": ("gauge", "Open WebSocket connections by consumer."),
+    "coloby_websocket_frames_received_total": ("counter", "Frames received by consumer."),
+    "coloby_websocket_receive_duration_seconds": ("histogram", "Time spent handling a received frame."),
+}
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+
+class Registry:
+    def __init__(self, buckets=None):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # (name, labels) -> value, where labels is a tuple of (name, value)
+        self._values = {}
+        # (name, labels) -> [bucket counts..., sum, count]
+        self._histograms = {}
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, tuple(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        buckets = self.buckets or settings.METRICS["BUCKETS"]
+        key = (name, tuple(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+            self._histograms.clear()
+
+    def samples(self):
+        """
+        Yields (name, labels, value) for every series, histograms expanded
+        into their _bucket, _sum and _count series.
+        """
+        buckets = self.buckets or settings.METRICS["BUCKETS"]
+        with self._lock:
+            values = sorted(self._values.items())
+            histograms = sorted((key, list(counts)) for key, counts in self._histograms.items())
+        for (name, labels), value in values:
+            yield name, labels, value
+        for (name, labels), counts in histograms:
+            cumulative = 0
+            for bound, count in zip(buckets, counts):
+                cumulative += count
+                yield f"{name}_bucket", labels + (("le", repr(float(bound))),), cumulative
+            yield f"{name}_bucket", labels + (("le", "+Inf"),), counts[-1]
+            yield f"{name}_sum", labels, counts[-2]
+            yield f"{name}_count", labels, counts[-1]
+
+
+registry = Registry()
+
+
+def render(gauges=()):
+    """
+    Returns the registry, followed by `gauges` of (name, help, value), as
+    Prometheus text.
+    """
+    lines = []
+    described = set()
+    for name, labels, value in registry.samples():
+        family = next((family for family in HELP if name == family or name.startswith(family + "_")), name)
+        if family not in described:
+            kind, text = HELP.get(family, ("untyped", ""))
+            lines += [f"# HELP {family} {text}", f"# TYPE {family} {kind}"]
+            described.add(family)
+        lines.append(f"{name}{format_labels(labels)} {value}")
+    for name, text, value in gauges:
+        lines += [f"# HELP {name} {text}", f"# TYPE {name} gauge", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+# The current request's totals, shared with code it calls into, such as
+# the serializer hook below.
+current_request = contextvars.ContextVar("coloby_metrics_request", default=None)
+
+
+class RequestTotals:
+    __slots__ = ("queries", "query_seconds", "serializer_seconds", "serializing")
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.serializer_seconds = 0.0
+        self.serializing = False
+
+    def __call__(self, execute, sql, params, many, context):
+        # A connection.execute_wrapper timing every query.
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_seconds += time.perf_counter() - started
+
+
+def instrument_serializers():
+    """
+    Wraps BaseSerializer.data so the time serializers spend building their
+    output is added to the current request. Nested serializers are part of
+    the outermost one's time.
+    """
+    from rest_framework.serializers import BaseSerializer
+
+    data = BaseSerializer.data
+    if getattr(data.fget, "instrumented", False):
+        return
+
+    def timed_data(serializer):
+        totals = current_request.get()
+        if totals is None or totals.serializing:
+            return data.fget(serializer)
+        totals.serializing = True
+        started = time.perf_counter()
+        try:
+            return data.fget(serializer)
+        finally:
+            totals.serializer_seconds += time.perf_counter() - started
+            totals.serializing = False
+
+    timed_data.instrumented = True
+    BaseSerializer.data = property(timed_data)
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        instrument_serializers()
+
+    def __call__(self, request):
+        totals = RequestTotals()
+        token = current_request.set(totals)
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(totals))
+                response = self.get_response(request)
+        finally:
+            current_request.reset(token)
+        elapsed = time.perf_counter() - started
+
+        match = getattr(request, "resolver_match", None)
+        view = match.view_name if match is not None and match.view_name else "<unmatched>"
+        labels = (("view", view),)
+        registry.observe("coloby_http_request_duration_seconds", labels + (("method", request.method),), elapsed)
+        registry.inc(
+            "coloby_http_requests_total",
+            labels + (("method", request.method), ("status", response.status_code)),
+        )
+        registry.inc("coloby_http_db_queries_total", labels, totals.queries)
+        registry.inc("coloby_http_db_query_seconds_total", labels, totals.query_seconds)
+        registry.inc("coloby_http_serializer_seconds_total", labels, totals.serializer_seconds)
+        if not response.streaming:
+            registry.inc("coloby_http_response_bytes_total", labels, len(response.content))
+        return response
+
+
+class ConsumerMetricsMixin:
+    """
+    Counts a WebSocket consumer's connections and received frames. List it
+    before the consumer base class.
+    """
+
+    def metrics_labels(self):
+        return (("consumer", type(self).__name__),)
+
+    async def websocket_connect(self, message):
+        registry.inc("coloby_websocket_connections_total", self.metrics_labels())
+        registry.inc("coloby_websocket_open", self.metrics_labels())
+        await super().websocket_connect(message)
+
+    async def websocket_receive(self, message):
+        started = time.perf_counter()
+        try:
+            await super().websocket_receive(message)
+        finally:
+            registry.inc("coloby_websocket_frames_received_total", self.metrics_labels())
+            registry.observe(
+                "coloby_websocket_receive_duration_seconds", self.metrics_labels(), time.perf_counter() - started
+            )
+
+    async def websocket_disconnect(self, message):
+        registry.inc("coloby_websocket_open", self.metrics_labels(), -1)
+        await super().websocket_disconnect(message)
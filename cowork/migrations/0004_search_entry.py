@@ -0,0 +1,93 @@
+# Generated by Django 3.2 on 2026-10-18 17:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+POSTGRES_FORWARDS = [
+    """
+    ALTER TABLE cowork_searchentry ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(body, '')), 'B')
+    ) STORED
+    """,
+    "CREATE INDEX searchentry_vector_gin ON cowork_searchentry USING GIN (search_vector)",
+]
+
+POSTGRES_BACKWARDS = [
+    "DROP INDEX IF EXISTS searchentry_vector_gin",
+    "ALTER TABLE cowork_searchentry DROP COLUMN IF EXISTS search_vector",
+]
+
+SQLITE_FORWARDS = [
+    """
+    CREATE VIRTUAL TABLE cowork_searchentry_fts USING fts5(
+        title, body, content='cowork_searchentry', content_rowid='id'
+    )
+    """,
+    """
+    CREATE TRIGGER cowork_searchentry_fts_insert AFTER INSERT ON cowork_searchentry BEGIN
+        INSERT INTO cowork_searchentry_fts(rowid, title, body) VALUES (new.id, new.title, new.body);
+    END
+    """,
+    """
+    CREATE TRIGGER cowork_searchentry_fts_delete AFTER DELETE ON cowork_searchentry BEGIN
+        INSERT INTO cowork_searchentry_fts(cowork_searchentry_fts, rowid, title, body)
+        VALUES ('delete', old.id, old.title, old.body);
+    END
+    """,
+    """
+    CREATE TRIGGER cowork_searchentry_fts_update AFTER UPDATE ON cowork_searchentry BEGIN
+        INSERT INTO cowork_searchentry_fts(cowork_searchentry_fts, rowid, title, body)
+        VALUES ('delete', old.id, old.title, old.body);
+        INSERT INTO cowork_searchentry_fts(rowid, title, body) VALUES (new.id, new.title, new.body);
+    END
+    """,
+]
+
+SQLITE_BACKWARDS = [
+    "DROP TRIGGER IF EXISTS cowork_searchentry_fts_update",
+    "DROP TRIGGER IF EXISTS cowork_searchentry_fts_delete",
+    "DROP TRIGGER IF EXISTS cowork_searchentry_fts_insert",
+    "DROP TABLE IF EXISTS cowork_searchentry_fts",
+]
+
+
+def run_for_vendor(postgres, sqlite):
+    def run(apps, schema_editor):
+        statements = {'postgresql': postgres, 'sqlite': sqlite}.get(schema_editor.connection.vendor, [])
+        for statement in statements:
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cowork', '0003_message_history_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('room', 'Room'), ('task', 'Task'), ('message', 'Message'), ('file', 'File')], max_length=16)),
+                ('object_id', models.BigIntegerField()),
+                ('title', models.CharField(max_length=255)),
+                ('body', models.TextField(blank=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='cowork.room')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='searchentry',
+            constraint=models.UniqueConstraint(fields=('kind', 'object_id'), name='searchentry_kind_object_unique'),
+        ),
+        # Other databases fall back to substring matching, see cowork/search.py.
+        migrations.RunPython(
+            run_for_vendor(POSTGRES_FORWARDS, SQLITE_FORWARDS),
+            run_for_vendor(POSTGRES_BACKWARDS, SQLITE_BACKWARDS),
+        ),
+    ]
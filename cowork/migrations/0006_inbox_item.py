@@ -0,0 +1,79 @@
+# Generated by Django 3.2 on 2026-10-18 17:28
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def deliver_existing(apps, schema_editor):
+    """
+    Gives the current members of each room an inbox item for its existing
+    notifications, keeping the notification's read state, and drops the
+    unread counters so they are recounted from the items.
+    """
+    Notification = apps.get_model('cowork', 'Notification')
+    Room = apps.get_model('cowork', 'Room')
+    members = Room.users.through._meta.db_table
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO cowork_inboxitem (recipient_id, notification_id, is_read, timestamp, deleted_at)
+            SELECT m.customuser_id, n.id, n.is_read, n.timestamp, NULL
+            FROM cowork_notification n JOIN {members} m ON m.room_id = n.room_id
+            WHERE m.customuser_id <> n.sender_id AND n.deleted_at IS NULL
+            """
+        )
+    Notification.objects.update(delivered_at=models.F('timestamp'))
+    apps.get_model('cowork', 'UnreadCounter').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('cowork', '0005_notification_unread'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboxItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('deleted_at', models.DateTimeField(blank=True, null=True)),
+                ('is_read', models.BooleanField(default=False)),
+                ('timestamp', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='delivered_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['delivered_at', 'id'], name='notification_delivery_idx'),
+        ),
+        migrations.AddField(
+            model_name='inboxitem',
+            name='notification',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='cowork.notification'),
+        ),
+        migrations.AddField(
+            model_name='inboxitem',
+            name='recipient',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='inboxitem',
+            index=models.Index(fields=['recipient', 'is_read', 'timestamp'], name='inboxitem_recipient_unread_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='inboxitem',
+            index=models.Index(fields=['recipient', 'timestamp', 'id'], name='inboxitem_recipient_time_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='inboxitem',
+            constraint=models.UniqueConstraint(fields=('recipient', 'notification'), name='inboxitem_recipient_notification_unique'),
+        ),
+        migrations.RunPython(deliver_existing, migrations.RunPython.noop),
+    ]
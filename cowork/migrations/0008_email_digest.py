@@ -0,0 +1,24 @@
+# Generated by Django 3.2 on 2026-10-18 17:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cowork', '0007_outgoing_email'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailDigest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('to', models.EmailField(max_length=254, unique=True)),
+                ('from_email', models.CharField(max_length=254)),
+                ('entries', models.JSONField(default=list)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('send_after', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
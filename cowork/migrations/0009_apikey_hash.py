@@ -0,0 +1,40 @@
+import hashlib
+
+from django.db import migrations, models
+
+
+def hash_existing_keys(apps, schema_editor):
+    # Existing keys keep working: they are found by their first characters
+    # and checked against the hash, like new ones.
+    APIKey = apps.get_model('cowork', 'APIKey')
+    for api_key in APIKey.objects.all().iterator():
+        api_key.prefix = api_key.key[:8]
+        api_key.hashed_key = hashlib.sha256(api_key.key.encode()).hexdigest()
+        api_key.save(update_fields=['prefix', 'hashed_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cowork', '0008_email_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='apikey',
+            name='prefix',
+            field=models.CharField(db_index=True, default='', max_length=8),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='apikey',
+            name='hashed_key',
+            field=models.CharField(default='', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.RunPython(hash_existing_keys, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='apikey',
+            name='key',
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.2 on 2026-10-18 17:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cowork', '0009_apikey_hash'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_room_created_idx',
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(condition=models.Q(deleted_at__isnull=True), fields=['task', 'created_at'], name='comment_task_live_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(deleted_at__isnull=True), fields=['room', 'created_at', 'id'], name='message_room_live_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(deleted_at__isnull=True), fields=['room', 'timestamp'], name='notification_room_live_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(condition=models.Q(deleted_at__isnull=True), fields=['is_private', 'id'], name='room_public_live_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(condition=models.Q(deleted_at__isnull=True), fields=['room', 'created_at'], name='task_room_live_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(condition=models.Q(deleted_at__isnull=True), fields=['assigned_to', 'due_date'], name='task_assignee_live_idx'),
+        ),
+    ]
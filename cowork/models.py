@@ -1,6 +1,8 @@
 from django.contrib.auth.models import AbstractUser
 from collections.abc import Iterable
-from django.db import models
+from django.db import models, transaction
+from django.dispatch import Signal
+from django.db.models.functions import Coalesce
 from django.db.models.query import QuerySet
 
 # Create your models here.
@@ -10,17 +12,25 @@ from django.contrib.auth.models import User
 # import shortuuid
 from django.contrib.auth import get_user_model
 from accounts.models import CustomUser
-import datetime
 from tinymce.models import HTMLField
 
 
 User = get_user_model()
 
 
+import hashlib
 import secrets
 
 class APIKey(models.Model):
-    key = models.CharField(max_length=270, unique=True)
+    """
+    Only a SHA-256 hash of the key is stored, next to its first
+    PREFIX_LENGTH characters so it can be found by an indexed lookup. The
+    key itself is shown once, when created.
+    """
+    PREFIX_LENGTH = 8
+
+    prefix = models.CharField(max_length=PREFIX_LENGTH, db_index=True)
+    hashed_key = models.CharField(max_length=64)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -28,13 +38,82 @@ class APIKey(models.Model):
     def generate_key(cls):
         return secrets.token_urlsafe(32)
 
+    @staticmethod
+    def hash_key(key):
+        # Keys are 256 random bits, so a fast hash is enough; there is
+        # nothing to guess a password-style digest would protect.
+        return hashlib.sha256(key.encode()).hexdigest()
+
     @classmethod
     def create_for_user(cls, user):
-        key = cls(key=cls.generate_key(), user=user)
+        """
+        Creates a key for `user`. The key itself is only available as the
+        returned object's `raw_key`.
+        """
+        raw_key = cls.generate_key()
+        key = cls(prefix=raw_key[:cls.PREFIX_LENGTH], hashed_key=cls.hash_key(raw_key), user=user)
         key.save()
+        key.raw_key = raw_key
         return key
 
-class SoftDeletionManager(models.Manager):
+
+# Sent after SoftDeletionQuerySet.delete() or restore() changed rows without
+# saving them, with `rows`, a queryset of those rows, and `deleted`.
+soft_deletion_changed = Signal()
+
+
+class SoftDeletionQuerySet(QuerySet):
+    # Rows restored per soft_deletion_changed signal.
+    RESTORE_CHUNK_SIZE = 10000
+
+    def delete(self):
+        """
+        Soft-deletes every row with a single UPDATE. Like QuerySet.delete(),
+        returns the number of rows and the number per model.
+        """
+        stamp = timezone.now()
+        count = self.filter(deleted_at__isnull=True).update(deleted_at=stamp)
+        if count:
+            # The rows just deleted are the ones carrying this exact stamp.
+            rows = self.model._default_manager.with_deleted().filter(deleted_at=stamp)
+            soft_deletion_changed.send(sender=self.model, rows=rows, deleted=True)
+        return count, {self.model._meta.label: count}
+
+    delete.queryset_only = True
+
+    def restore(self):
+        """
+        Restores every soft-deleted row with a single UPDATE and returns how
+        many there were.
+        """
+        with transaction.atomic():
+            deleted = self.restorable().filter(deleted_at__isnull=False)
+            pks = list(deleted.values_list('pk', flat=True))
+            count = deleted.update(deleted_at=None)
+        for start in range(0, len(pks), self.RESTORE_CHUNK_SIZE):
+            rows = self.model._default_manager.filter(pk__in=pks[start:start + self.RESTORE_CHUNK_SIZE])
+            soft_deletion_changed.send(sender=self.model, rows=rows, deleted=False)
+        return count
+
+    restore.queryset_only = True
+
+    def restorable(self):
+        """
+        The rows restore() may bring back: all of them, unless a model says
+        otherwise.
+        """
+        return self
+
+    def hard_delete(self):
+        """
+        Deletes the rows for good, as QuerySet.delete() does.
+        """
+        return super().delete()
+
+    hard_delete.queryset_only = True
+
+
+class SoftDeletionManager(models.Manager.from_queryset(SoftDeletionQuerySet)):
     """
     A custom manager for models that support soft deletion. This manager filters out
     objects that have a non-null deleted_at field.
@@ -66,15 +145,44 @@ class BaseModel(models.Model):
         """
         Soft deletes the object by setting the deleted_at field to the current timestamp.
         """
-        self.deleted_at = datetime.datetime.now()
-        self.save()
+        self.deleted_at = timezone.now()
+        self.save(update_fields=['deleted_at'])
 
     def restore(self):
         """
         Restores a soft-deleted object by setting the deleted_at field to null.
         """
         self.deleted_at = None
-        self.save()
+        self.save(update_fields=['deleted_at'])
+
+
+class RoomQuerySet(SoftDeletionQuerySet):
+    def with_members(self):
+        """
+        Loads everything RoomSerializer shows about a room: the creator is
+        joined in, the member count is annotated and member usernames and
+        likes are prefetched, so serializing any number of rooms takes the
+        same three queries.
+        """
+        # A subquery rather than Count('users'): querysets such as
+        # user.room_set already join the membership table, and counting
+        # over that join would only count the one user.
+        member_count = (
+            self.model.users.through.objects
+            .filter(room_id=models.OuterRef('pk'))
+            .order_by()
+            .values('room_id')
+            .annotate(count=models.Count('*'))
+            .values('count')
+        )
+        return (
+            self.select_related('created_by')
+            .annotate(total_users=Coalesce(models.Subquery(member_count), 0))
+            .prefetch_related(
+                models.Prefetch('users', queryset=CustomUser.objects.only('id', 'username'), to_attr='members'),
+                models.Prefetch('likes', queryset=CustomUser.objects.only('id')),
+            )
+        )
 
 
 class Room(BaseModel):
@@ -96,6 +204,14 @@ class Room(BaseModel):
         CustomUser, related_name="liked_rooms", blank=True)
     description = models.CharField(max_length=300, blank=True, null=True)
 
+    objects = SoftDeletionManager.from_queryset(RoomQuerySet)()
+
+    class Meta:
+        indexes = [
+            # Public room listings: search and autocomplete.
+            models.Index(fields=['is_private', 'id'], name='room_public_live_idx', condition=models.Q(deleted_at__isnull=True)),
+        ]
+
     # def save(self, *args, **kwargs):
     #     if not self.unique_link or Room.objects.filter(unique_link=self.unique_link).exists():
     #         self.unique_link = uuid.uuid4().hex[:50]
@@ -106,6 +222,13 @@ class Room(BaseModel):
     def __str__(self):
         return self.name
 
+    def visible_to(self, user):
+        """
+        Whether `user` may see the room: anyone can see a public room, only
+        its members a private one.
+        """
+        return not self.is_private or self.users.filter(pk=user.pk).exists()
+
 class File(models.Model):
     room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='files')
     name = models.CharField(max_length=255)
@@ -134,6 +257,22 @@ class StagedFile(models.Model):
     def __str__(self):
         return f"{self.file.name} in {self.room.name} staging area"
 
+class MessageQuerySet(SoftDeletionQuerySet):
+    def archived_over(self):
+        """
+        The messages that are no newer than the last one archived from their
+        room (see cowork/archive.py).
+        """
+        return self.filter(models.Exists(
+            MessageArchive.objects.filter(room_id=models.OuterRef('room_id'), last_created_at__gte=models.OuterRef('created_at'))
+        ))
+
+    def restorable(self):
+        # History pages through live messages before archived ones, so a
+        # live message may never be older than an archived one.
+        return self.exclude(pk__in=self.archived_over().values('pk'))
+
+
 class Message(BaseModel):
     room = models.ForeignKey(Room, on_delete=models.CASCADE)
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
@@ -141,9 +280,51 @@ class Message(BaseModel):
     media = models.FileField(upload_to='media', null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = SoftDeletionManager.from_queryset(MessageQuerySet)()
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of a room's history, see cowork/history.py.
+            # Only live rows are indexed; soft-deleted ones are never listed.
+            models.Index(fields=['room', 'created_at', 'id'], name='message_room_live_idx', condition=models.Q(deleted_at__isnull=True)),
+        ]
+
+    def restore(self):
+        """
+        Restores the message, raising ValueError if it is older than what its
+        room has archived (see MessageQuerySet.restorable()).
+        """
+        if Message.objects.with_deleted().filter(pk=self.pk).archived_over().exists():
+            raise ValueError("Messages older than the room's archive cannot be restored.")
+        super().restore()
+
     def __str__(self):
         return f"{self.room.name} - {self.user.username}: {self.message}"
 
+
+class MessageArchive(models.Model):
+    """
+    One room's messages from one month, moved out of Message by
+    cowork/archive.py into a gzipped NDJSON file. history_page() reads them
+    back when paging reaches them.
+    """
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='+')
+    # The first day of the month.
+    month = models.DateField()
+    file = models.FileField(upload_to='archive')
+    message_count = models.IntegerField()
+    first_created_at = models.DateTimeField()
+    last_created_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'month'], name='messagearchive_room_month_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.room_id} {self.month:%Y-%m}: {self.message_count} messages"
+
 # A feature where users can create notes to pen ideas down
 
 
@@ -189,6 +370,12 @@ class Task(BaseModel):
     created_by = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='tasks_created')
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=UNDONE)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', 'created_at'], name='task_room_live_idx', condition=models.Q(deleted_at__isnull=True)),
+            models.Index(fields=['assigned_to', 'due_date'], name='task_assignee_live_idx', condition=models.Q(deleted_at__isnull=True)),
+        ]
+
     def __str__(self):
         return self.title
 
@@ -200,6 +387,11 @@ class Comment(BaseModel):
     text = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['task', 'created_at'], name='comment_task_live_idx', condition=models.Q(deleted_at__isnull=True)),
+        ]
+
     def __str__(self):
         return f"Comment by {self.user.username} on {self.task.title}"
 
@@ -211,8 +403,138 @@ class Notification(BaseModel):
     message = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
     is_read = models.BooleanField(default=False)
+    # Set once an InboxItem has been written for every recipient, see
+    # cowork/fanout.py.
+    delivered_at = models.DateTimeField(null=True, blank=True)
+    # When a delivery took the notification, and how many have tried.
+    delivery_claimed_at = models.DateTimeField(null=True, blank=True)
+    delivery_attempts = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Unread counts and keyset pages of a room's notifications, see
+            # cowork/inbox.py
+            models.Index(fields=['room', 'is_read', 'timestamp'], name='notification_room_unread_idx'),
+            models.Index(fields=['delivered_at', 'id'], name='notification_delivery_idx'),
+            models.Index(fields=['room', 'timestamp'], name='notification_room_live_idx', condition=models.Q(deleted_at__isnull=True)),
+        ]
 
     def __str__(self):
         return f"Activity: {self.message} carried out by {self.sender} in room: {self.room}"
 
 
+class InboxItem(BaseModel):
+    """
+    A notification as delivered to one recipient, with their own read state.
+    Dismissing one soft-deletes it.
+    """
+    recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='inbox')
+    notification = models.ForeignKey(Notification, on_delete=models.CASCADE, related_name='deliveries')
+    is_read = models.BooleanField(default=False)
+    # The notification's timestamp, so a user's inbox pages from one index.
+    timestamp = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['recipient', 'notification'], name='inboxitem_recipient_notification_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['recipient', 'is_read', 'timestamp'], name='inboxitem_recipient_unread_idx'),
+            models.Index(fields=['recipient', 'timestamp', 'id'], name='inboxitem_recipient_time_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.notification} for {self.recipient}"
+
+
+class UnreadCounter(models.Model):
+    """
+    How many unread inbox items a user has, kept by cowork/inbox.py so
+    badge counts are a primary key lookup. A missing row means the count is
+    not known and is recounted on the next read.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='+')
+    unread = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.user_id}: {self.unread} unread"
+
+
+class SearchEntry(models.Model):
+    """
+    One searchable room, task, message or file, kept up to date by
+    cowork/search.py. The full-text index itself lives outside the ORM: a
+    generated tsvector column with a GIN index on PostgreSQL, an FTS5 table
+    kept in step by triggers on SQLite (see migration 0004).
+    """
+    ROOM = 'room'
+    TASK = 'task'
+    MESSAGE = 'message'
+    FILE = 'file'
+    KIND_CHOICES = [
+        (ROOM, 'Room'),
+        (TASK, 'Task'),
+        (MESSAGE, 'Message'),
+        (FILE, 'File'),
+    ]
+
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    object_id = models.BigIntegerField()
+    # The room the object belongs to, which decides who may find it.
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='+')
+    title = models.CharField(max_length=255)
+    body = models.TextField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'object_id'], name='searchentry_kind_object_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.object_id}: {self.title}"
+
+
+class OutgoingEmail(models.Model):
+    """
+    An email waiting in the outbox, written in the same transaction as
+    whatever it is about and sent later by cowork/outbox.py.
+    """
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=254)
+    to = models.EmailField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    # When the next attempt is due. A sender claims a message by pushing
+    # this forward, so a crashed attempt is retried once the claim lapses.
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    # Set when the last allowed attempt failed; the message is not retried.
+    failed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sent_at', 'failed_at', 'next_attempt_at'], name='outgoingemail_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {self.to}"
+
+
+class EmailDigest(models.Model):
+    """
+    Email notifications collected for one recipient until send_after, when
+    cowork/outbox.py turns them into a single email. Entries with the same
+    key are merged, so repeats about one task take one line.
+    """
+    to = models.EmailField(unique=True)
+    from_email = models.CharField(max_length=254)
+    # [{"key", "subject", "text", "many", "count"}, ...] in arrival order.
+    entries = models.JSONField(default=list)
+    created_at = models.DateTimeField(auto_now_add=True)
+    send_after = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"Digest of {len(self.entries)} entries to {self.to}"
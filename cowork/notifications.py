@@ -0,0 +1,250 @@
+"""
+Event types accepted by NotificationConsumer.
+
+Each type is a NotificationEvent subclass registered with
+``@notification_events.register``. It names the frame ``type`` it handles, a
+serializer that validates the frame, the row it writes and the payload that
+is broadcast to the room. Rows go through a WriteBehindBuffer per type, so
+the consumer never waits on the database and writes are batched.
+
+A new event type only needs a serializer and a registered subclass here; the
+consumer looks types up by name.
+"""
+import asyncio
+import logging
+
+from django.conf import settings
+from rest_framework import serializers as drf_serializers
+
+from cowork import activity, dashboard
+from cowork.buffers import WriteBehindBuffer
+from cowork.db import db_executor
+from cowork.fanout import fanout
+from cowork.models import Message, Notification, Task
+from cowork.search import index_written
+from serializers.serializers import (
+    BranchActivityEventSerializer,
+    FileUploadEventSerializer,
+    MessageEventSerializer,
+    TaskEventSerializer,
+)
+
+logger = logging.getLogger(__name__)
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def rows_written(model, instances):
+    """
+    The on_write hook of the event and chat message buffers. Buffered rows
+    skip post_save; do what its handlers in cowork/signals.py would.
+    """
+    index_written(model, instances)
+    if model is Notification:
+        fanout.schedule_on_commit()
+    elif model is Message:
+        activity.messages_posted(instances)
+    elif model is Task:
+        activity.tasks_created(instances)
+
+
+class NotificationEvent:
+    # The frame "type" this event handles.
+    type = None
+    model = None
+    serializer_class = None
+    # The frame field naming the user behind the event. Sockets may leave it
+    # out, and may not name anyone else.
+    actor_field = None
+
+    def __init__(self):
+        self._buffer = None
+
+    @property
+    def buffer(self):
+        if self._buffer is None:
+            options = settings.NOTIFICATION_EVENT_BUFFER
+            self._buffer = WriteBehindBuffer(
+                self.model,
+                max_batch=options["MAX_BATCH"],
+                flush_interval=options["FLUSH_INTERVAL_MS"] / 1000,
+                max_pending=options["MAX_PENDING"],
+                on_write=rows_written,
+            )
+        return self._buffer
+
+    def validate(self, data, user=None):
+        """
+        Returns the validated frame, raising a DRF ValidationError if it is
+        not acceptable or `user` is not signed in.
+        """
+        if user is None or not user.is_authenticated:
+            raise drf_serializers.ValidationError("Authentication required.")
+        data = dict(data)
+        actor = data.setdefault(self.actor_field, str(user.pk))
+        if str(actor) != str(user.pk):
+            raise drf_serializers.ValidationError({self.actor_field: ["Must be the connected user."]})
+        serializer = self.serializer_class(data=data)
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data
+
+    def build(self, room_id, data, timestamp):
+        """
+        Returns the unsaved row recording the event.
+        """
+        raise NotImplementedError
+
+    def payload(self, data, timestamp):
+        """
+        Returns the notification broadcast to the room.
+        """
+        raise NotImplementedError
+
+    async def persist(self, room_id, data, timestamp):
+        """
+        Queues the event's row for writing and returns a future for it.
+        """
+        return await self.buffer.add(self.build(room_id, data, timestamp))
+
+
+class NotificationEventRegistry:
+    def __init__(self):
+        self._events = {}
+
+    def register(self, event_class):
+        """
+        Class decorator adding an event type to the registry.
+        """
+        if event_class.type in self._events:
+            raise ValueError(f"Notification type {event_class.type!r} is already registered")
+        self._events[event_class.type] = event_class()
+        return event_class
+
+    def get(self, event_type):
+        return self._events.get(event_type)
+
+    def types(self):
+        return sorted(self._events)
+
+    async def flush(self):
+        for event in self._events.values():
+            if event._buffer is not None:
+                await event._buffer.flush()
+
+
+notification_events = NotificationEventRegistry()
+
+
+@notification_events.register
+class MessageEvent(NotificationEvent):
+    type = 'message'
+    model = Message
+    serializer_class = MessageEventSerializer
+    actor_field = 'sender_id'
+
+    def build(self, room_id, data, timestamp):
+        return Message(room_id=room_id, user_id=data['sender_id'], message=data['message'])
+
+    def payload(self, data, timestamp):
+        return {
+            'type': 'message',
+            'message': data['message'],
+            'sender_id': str(data['sender_id']),
+            'timestamp': timestamp.strftime(TIMESTAMP_FORMAT),
+        }
+
+
+@notification_events.register
+class TaskEvent(NotificationEvent):
+    type = 'task'
+    model = Task
+    serializer_class = TaskEventSerializer
+    actor_field = 'creator_id'
+
+    def __init__(self):
+        super().__init__()
+        # Dashboard refreshes still running, kept so they are not garbage
+        # collected half way.
+        self._refreshes = set()
+
+    def build(self, room_id, data, timestamp):
+        return Task(
+            room_id=room_id,
+            title=data['task_title'],
+            description=data['description'],
+            due_date=data.get('due_date') or timestamp.date(),
+            assigned_to_id=data.get('assigned_to_id') or data['creator_id'],
+            created_by_id=data['creator_id'],
+        )
+
+    async def persist(self, room_id, data, timestamp):
+        persisted = await super().persist(room_id, data, timestamp)
+        refresh = asyncio.get_running_loop().create_task(self.refresh_dashboard(persisted))
+        self._refreshes.add(refresh)
+        refresh.add_done_callback(self.refresh_done)
+        return persisted
+
+    def refresh_done(self, refresh):
+        self._refreshes.discard(refresh)
+        if not refresh.cancelled() and refresh.exception() is not None:
+            logger.error("Could not refresh the task dashboard.", exc_info=refresh.exception())
+
+    async def refresh_dashboard(self, persisted):
+        # Buffered rows skip post_save, so drop the assignee's cached task
+        # list here once the row is in.
+        try:
+            task = await persisted
+        except Exception:
+            return
+        await db_executor.run(dashboard.invalidate, [task.assigned_to_id], ("assigned_tasks",))
+
+    def payload(self, data, timestamp):
+        return {
+            'type': 'task',
+            'task_title': data['task_title'],
+            'creator_id': str(data['creator_id']),
+            'timestamp': timestamp.strftime(TIMESTAMP_FORMAT),
+        }
+
+
+@notification_events.register
+class FileUploadEvent(NotificationEvent):
+    type = 'file_upload'
+    model = Notification
+    serializer_class = FileUploadEventSerializer
+    actor_field = 'uploader_id'
+
+    def build(self, room_id, data, timestamp):
+        # The file itself arrives over HTTP; the event is kept as activity.
+        return Notification(room_id=room_id, sender_id=data['uploader_id'], message=f"uploaded {data['file_name']}")
+
+    def payload(self, data, timestamp):
+        return {
+            'type': 'file_upload',
+            'file_name': data['file_name'],
+            'uploader_id': str(data['uploader_id']),
+            'timestamp': timestamp.strftime(TIMESTAMP_FORMAT),
+        }
+
+
+@notification_events.register
+class BranchActivityEvent(NotificationEvent):
+    type = 'branch_activity'
+    model = Notification
+    serializer_class = BranchActivityEventSerializer
+    actor_field = 'actor_id'
+
+    def build(self, room_id, data, timestamp):
+        return Notification(
+            room_id=room_id,
+            sender_id=data['actor_id'],
+            message=f"{data['activity']} branch {data['branch_name']}",
+        )
+
+    def payload(self, data, timestamp):
+        return {
+            'type': 'branch_activity',
+            'branch_name': data['branch_name'],
+            'actor_id': str(data['actor_id']),
+            'timestamp': timestamp.strftime(TIMESTAMP_FORMAT),
+        }
@@ -0,0 +1,300 @@
+"""
+Transactional email through a database outbox.
+
+enqueue() only writes OutgoingEmail rows, in the caller's transaction, so
+an email exists exactly when the change it is about was committed and no
+request waits on SMTP. Once that transaction commits, a background thread
+sends everything due over one SMTP connection, claiming
+EMAIL_OUTBOX["BATCH_SIZE"] messages at a time; `manage.py send_outbox` does
+the same from a separate worker.
+
+A sender claims messages by pushing their next_attempt_at forward by
+CLAIM_SECONDS (skipping rows another sender has locked, where the database
+can), so concurrent senders do not share messages and the messages of a
+sender that died are retried once the claim lapses. A failed message is
+retried with exponential backoff and given up after MAX_ATTEMPTS.
+
+Notification email goes through notify(). With EMAIL_DIGEST["ENABLED"] it
+is collected in the recipient's EmailDigest instead, which is sent as one
+email WINDOW seconds after its first entry; entries with the same key,
+such as several comments on one task, are merged into one line.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import connection as db_connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from cowork.models import EmailDigest, OutgoingEmail
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(subject, body, to, from_email=None):
+    """
+    Queues one email per address in `to` and returns the rows.
+    """
+    messages = [
+        OutgoingEmail.objects.create(
+            subject=subject, body=body, from_email=from_email or settings.DEFAULT_FROM_EMAIL, to=address
+        )
+        for address in to
+    ]
+    if messages:
+        outbox.schedule_on_commit()
+    return messages
+
+
+def letter(text):
+    return f"Hello,\n\n{text}\n\nRegards,\n{settings.EMAIL_HOST_USER}"
+
+
+def notify(to, subject, text, key=None, many=None, from_email=None):
+    """
+    Emails the notification `text` to each address in `to`, now or as part
+    of their digest. Entries sharing a `key` are merged in a digest and
+    shown with the `many` template, which gets the {count}.
+    """
+    if key is None or not settings.EMAIL_DIGEST["ENABLED"]:
+        return enqueue(subject, letter(text), to, from_email)
+    entry = {"key": key, "subject": subject, "text": text, "many": many or text, "count": 1}
+    for address in to:
+        add_to_digest(address, entry, from_email or settings.DEFAULT_FROM_EMAIL)
+    outbox.schedule_on_commit()
+
+
+def add_to_digest(address, entry, from_email):
+    with transaction.atomic():
+        digest, _ = EmailDigest.objects.select_for_update().get_or_create(
+            to=address,
+            defaults={
+                "from_email": from_email,
+                "send_after": timezone.now() + timedelta(seconds=settings.EMAIL_DIGEST["WINDOW"]),
+            },
+        )
+        for existing in digest.entries:
+            if existing["key"] == entry["key"]:
+                existing["count"] += 1
+                break
+        else:
+            digest.entries.append(dict(entry))
+        digest.save(update_fields=['entries'])
+
+
+def render_digest(entries):
+    """
+    Returns the (subject, body) of the email for a digest's `entries`.
+    """
+    if len(entries) == 1 and entries[0]["count"] == 1:
+        return entries[0]["subject"], letter(entries[0]["text"])
+    lines = []
+    for entry in entries:
+        text = entry["text"] if entry["count"] == 1 else entry["many"].replace("{count}", str(entry["count"]))
+        lines.append(f"- {text}")
+    total = sum(entry["count"] for entry in entries)
+    return f"{total} new notifications", letter("Here is what happened:\n\n" + "\n".join(lines))
+
+
+def flush_digests(batch_size=None):
+    """
+    Queues the email of every digest whose window has passed. Returns how
+    many were queued.
+    """
+    batch_size = batch_size or settings.EMAIL_OUTBOX["BATCH_SIZE"]
+    flushed = 0
+    while True:
+        with transaction.atomic():
+            digests = list(
+                EmailDigest.objects.filter(send_after__lte=timezone.now())
+                .order_by('send_after', 'pk')
+                .select_for_update(skip_locked=True)[:batch_size]
+            )
+            if not digests:
+                return flushed
+            emails = []
+            for digest in digests:
+                subject, body = render_digest(digest.entries)
+                emails.append(OutgoingEmail(subject=subject, body=body, from_email=digest.from_email, to=digest.to))
+            OutgoingEmail.objects.bulk_create(emails)
+            EmailDigest.objects.filter(pk__in=[digest.pk for digest in digests]).delete()
+        flushed += len(digests)
+
+
+def pending():
+    return OutgoingEmail.objects.filter(sent_at__isnull=True, failed_at__isnull=True)
+
+
+def backoff(attempts):
+    """
+    Seconds to wait before retrying a message that failed `attempts` times.
+    """
+    config = settings.EMAIL_OUTBOX
+    return min(config["RETRY_BACKOFF"] * 2 ** (attempts - 1), config["MAX_BACKOFF"])
+
+
+def claim(batch_size=None):
+    """
+    Claims up to `batch_size` messages that are due, oldest first.
+    """
+    batch_size = batch_size or settings.EMAIL_OUTBOX["BATCH_SIZE"]
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            pending().filter(next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'pk')
+            .select_for_update(skip_locked=True)
+            .values_list('pk', flat=True)[:batch_size]
+        )
+        OutgoingEmail.objects.filter(pk__in=ids).update(
+            next_attempt_at=now + timedelta(seconds=settings.EMAIL_OUTBOX["CLAIM_SECONDS"])
+        )
+    return list(OutgoingEmail.objects.filter(pk__in=ids).order_by('pk'))
+
+
+def record_failure(message, error):
+    attempts = message.attempts + 1
+    now = timezone.now()
+    gave_up = attempts >= settings.EMAIL_OUTBOX["MAX_ATTEMPTS"]
+    OutgoingEmail.objects.filter(pk=message.pk).update(
+        attempts=attempts,
+        last_error=f"{type(error).__name__}: {error}"[:1000],
+        next_attempt_at=now + timedelta(seconds=backoff(attempts)),
+        failed_at=now if gave_up else None,
+    )
+    logger.warning(
+        "Email %s to %s failed (attempt %s%s): %s",
+        message.pk, message.to, attempts, ", giving up" if gave_up else "", error,
+    )
+
+
+def send_batch(messages, smtp):
+    """
+    Sends `messages` over the open `smtp` connection and records the
+    outcome of each. Returns how many were sent.
+    """
+    sent = []
+    for i, message in enumerate(messages):
+        email = EmailMessage(message.subject, message.body, message.from_email, [message.to], connection=smtp)
+        try:
+            email.send()
+        except Exception as e:
+            record_failure(message, e)
+            # The server may have dropped us halfway through; reconnect once
+            # for the rest of the batch. A closed connection would otherwise
+            # make send() open and close a session per message.
+            smtp.close()
+            try:
+                smtp.open()
+            except Exception as e:
+                for message in messages[i + 1:]:
+                    record_failure(message, e)
+                break
+        else:
+            sent.append(message.pk)
+    OutgoingEmail.objects.filter(pk__in=sent).update(sent_at=timezone.now(), attempts=F('attempts') + 1, last_error='')
+    return len(sent)
+
+
+def send_pending(batch_size=None, smtp=None):
+    """
+    Queues the digests that are due, then sends every message that is due,
+    batch by batch over a single SMTP connection. Returns how many were
+    sent.
+    """
+    flush_digests(batch_size)
+    smtp = smtp or get_connection()
+    sent = 0
+    try:
+        while True:
+            messages = claim(batch_size)
+            if not messages:
+                return sent
+            try:
+                smtp.open()
+            except Exception as e:
+                # Nothing can go out; every claimed message counts a failed
+                # attempt and waits out its backoff.
+                for message in messages:
+                    record_failure(message, e)
+                return sent
+            sent += send_batch(messages, smtp)
+    finally:
+        smtp.close()
+
+
+def next_attempt():
+    """
+    When the earliest message or digest still to be sent is due, or None.
+    """
+    due = [
+        pending().order_by('next_attempt_at').values_list('next_attempt_at', flat=True).first(),
+        EmailDigest.objects.order_by('send_after').values_list('send_after', flat=True).first(),
+    ]
+    return min((when for when in due if when is not None), default=None)
+
+
+class Outbox:
+    """
+    Runs send_pending() on a single background thread after each commit
+    that queued email, and again when the earliest retry or digest is due. Calls made
+    while a run is queued are folded into it.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._timer = None
+        self._lock = threading.Lock()
+        self._queued = False
+
+    def schedule(self):
+        with self._lock:
+            if self._queued:
+                return
+            self._queued = True
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="coloby-outbox")
+            self._executor.submit(self._run)
+
+    def schedule_on_commit(self):
+        if settings.EMAIL_OUTBOX["SEND_ON_COMMIT"]:
+            transaction.on_commit(self.schedule)
+
+    def _run(self):
+        with self._lock:
+            self._queued = False
+        try:
+            send_pending()
+            due = next_attempt()
+        except Exception:
+            logger.exception("Error sending queued email")
+            due = None
+        finally:
+            db_connection.close()
+        if due is not None:
+            self._retry_at(due)
+
+    def _retry_at(self, due):
+        delay = max((due - timezone.now()).total_seconds(), 1)
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(delay, self.schedule)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def shutdown(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+outbox = Outbox()
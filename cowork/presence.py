@@ -0,0 +1,229 @@
+"""
+Who is online in each room.
+
+Presence used to be tracked by adding and removing users on ``Room.users`` for
+every socket that opened or closed. It is now kept apart from membership:
+
+* every worker keeps in-memory sets of its own sockets per room, refreshed by
+  client heartbeats and expired after ``TTL`` seconds of silence;
+* workers share their local sets with each other through the channel layer,
+  one ``presence.sync`` message per room per change (plus a periodic refresh
+  so a crashed worker's users expire);
+* every ``BROADCAST_INTERVAL`` the worker sends each of its sockets a single
+  batched diff of users who came online or went away since the last one.
+"""
+import asyncio
+import json
+import logging
+import time
+import uuid
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def presence_group(room_slug):
+    return f"presence_{room_slug}"
+
+
+def merge_diffs(older, newer):
+    """
+    Folds two presence diff frames for the same room into one, so a client
+    that has not read the first yet gets the net change.
+    """
+    older, newer = json.loads(older), json.loads(newer)
+    joined = {user["id"]: user for user in older["joined"]}
+    left = set(older["left"])
+    for user_id in newer["left"]:
+        if joined.pop(user_id, None) is None:
+            left.add(user_id)
+    for user in newer["joined"]:
+        if user["id"] in left:
+            left.discard(user["id"])
+        else:
+            joined[user["id"]] = user
+    return json.dumps({
+        "type": "presence",
+        "stream": "chat",
+        "room": newer["room"],
+        "joined": [joined[user_id] for user_id in sorted(joined)],
+        "left": sorted(left),
+    })
+
+
+class PresenceRegistry:
+    def __init__(self, ttl=None, interval=None, channel_layer=None):
+        self.ttl = ttl or settings.PRESENCE["TTL"]
+        self.interval = interval or settings.PRESENCE["BROADCAST_INTERVAL"]
+        self.worker_id = uuid.uuid4().hex
+        self._channel_layer = channel_layer
+        self._reset(None)
+
+    def _reset(self, loop):
+        self._loop = loop
+        self.channel_name = None
+        # room -> {channel_name: [user_id, username, last_seen]}
+        self.local = {}
+        # room -> {channel_name: coroutine function taking a text frame}
+        self.listeners = {}
+        # room -> {worker_id: (users, expires_at)}
+        self.remote = {}
+        # room -> (users, announced_at) as last told to the other workers
+        self.announced = {}
+        # room -> users as last shown to our own sockets
+        self.visible = {}
+        self._tasks = []
+
+    @property
+    def channel_layer(self):
+        if self._channel_layer is None:
+            self._channel_layer = get_channel_layer()
+        return self._channel_layer
+
+    async def start(self, background=True):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._reset(loop)
+        self.channel_name = await self.channel_layer.new_channel()
+        self._tasks.append(loop.create_task(self._receive_loop()))
+        if background:
+            self._tasks.append(loop.create_task(self._tick_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._reset(None)
+
+    # Socket lifecycle
+
+    async def join(self, room, channel_name, user_id, username, send):
+        """
+        Registers a socket and returns who is online in the room right now.
+        """
+        await self.start()
+        first_here = room not in self.local
+        self.local.setdefault(room, {})[channel_name] = [user_id, username, time.monotonic()]
+        self.listeners.setdefault(room, {})[channel_name] = send
+        if first_here:
+            # Ask the other workers to re-announce so our view fills in
+            # within one interval instead of one refresh period.
+            await self.channel_layer.group_add(presence_group(room), self.channel_name)
+            await self.channel_layer.group_send(presence_group(room), {
+                "type": "presence.sync",
+                "worker": self.worker_id,
+                "room": room,
+                "users": self.local_users(room),
+                "request": True,
+            })
+            self.announced[room] = (self.local_users(room), time.monotonic())
+        return self.online(room)
+
+    def touch(self, room, channel_name):
+        entry = self.local.get(room, {}).get(channel_name)
+        if entry is not None:
+            entry[2] = time.monotonic()
+
+    async def leave(self, room, channel_name):
+        self.local.get(room, {}).pop(channel_name, None)
+        self.listeners.get(room, {}).pop(channel_name, None)
+
+    # State
+
+    def local_users(self, room):
+        cutoff = time.monotonic() - self.ttl
+        return {
+            user_id: username
+            for user_id, username, last_seen in self.local.get(room, {}).values()
+            if last_seen >= cutoff
+        }
+
+    def online(self, room):
+        users = {}
+        now = time.monotonic()
+        for remote_users, expires_at in self.remote.get(room, {}).values():
+            if expires_at >= now:
+                users.update(remote_users)
+        users.update(self.local_users(room))
+        return users
+
+    # Periodic work
+
+    async def _tick_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.tick()
+            except Exception as e:
+                logger.error(f"Presence tick failed: {str(e)}")
+
+    async def tick(self):
+        now = time.monotonic()
+        for room in list(set(self.local) | set(self.remote) | set(self.visible)):
+            users = self.local_users(room)
+
+            announced = self.announced.get(room)
+            if announced is None or announced[0] != users or now - announced[1] > self.ttl / 2:
+                if users or announced is not None:
+                    await self.channel_layer.group_send(presence_group(room), {
+                        "type": "presence.sync",
+                        "worker": self.worker_id,
+                        "room": room,
+                        "users": users,
+                    })
+                self.announced[room] = (users, now)
+
+            remote = self.remote.get(room, {})
+            for worker, (_, expires_at) in list(remote.items()):
+                if expires_at < now:
+                    del remote[worker]
+
+            await self._broadcast_diff(room)
+
+            if not self.local.get(room):
+                if not users and not remote:
+                    self.announced.pop(room, None)
+                    self.visible.pop(room, None)
+                    self.remote.pop(room, None)
+                if room in self.local:
+                    del self.local[room]
+                    self.listeners.pop(room, None)
+                    await self.channel_layer.group_discard(presence_group(room), self.channel_name)
+
+    async def _broadcast_diff(self, room):
+        online = self.online(room)
+        visible = self.visible.get(room, {})
+        joined = {user_id: online[user_id] for user_id in online.keys() - visible.keys()}
+        left = sorted(visible.keys() - online.keys())
+        self.visible[room] = online
+        listeners = list(self.listeners.get(room, {}).values())
+        if not (joined or left) or not listeners:
+            return
+
+        frame = json.dumps({
+            "type": "presence",
+            "stream": "chat",
+            "room": room,
+            "joined": [{"id": user_id, "username": username} for user_id, username in sorted(joined.items())],
+            "left": left,
+        })
+        for send in listeners:
+            await send(frame)
+
+    async def _receive_loop(self):
+        while True:
+            message = await self.channel_layer.receive(self.channel_name)
+            if message.get("type") != "presence.sync" or message["worker"] == self.worker_id:
+                continue
+            if message.get("request"):
+                self.announced.pop(message["room"], None)
+            room_workers = self.remote.setdefault(message["room"], {})
+            if message["users"]:
+                room_workers[message["worker"]] = (message["users"], time.monotonic() + self.ttl)
+            else:
+                room_workers.pop(message["worker"], None)
+
+
+presence = PresenceRegistry()
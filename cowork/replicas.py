@@ -0,0 +1,216 @@
+"""
+Read replicas, for the read-only API views.
+
+Replicas are extra DATABASES aliases listed in REPLICAS["ALIASES"]. Reads go
+to one of them only while ReplicaMiddleware is serving a GET or HEAD to a
+view with ReplicaReadsMixin, and only until the request writes anything.
+Everything else, the WebSocket consumers, management commands, and reads
+inside a transaction included, stays on the primary.
+
+A request that writes pins its user, and its browser through a cookie, to
+the primary for REPLICAS["STICKY_SECONDS"], so what they just changed is
+what they read next, however far the replicas have fallen behind. Pins are
+kept in Django's cache, which must be shared for them to reach every
+process.
+
+Replicas are checked every REPLICAS["CHECK_INTERVAL"] seconds, on a
+background thread started when the next read asks for one, so no request
+waits on a replica that is down; until the first check is in, reads stay on
+the primary. Those that fail to answer, or on PostgreSQL are more than
+REPLICAS["MAX_LAG"] seconds behind, are left out until the next check
+passes.
+
+To try this locally with two SQLite files, copy the database and point
+DATABASE_REPLICA_URLS at the copy; the tests mirror a replica onto the test
+database instead.
+"""
+import contextvars
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from rest_framework.permissions import SAFE_METHODS
+
+logger = logging.getLogger(__name__)
+
+PIN_COOKIE = "primary_pin"
+
+
+class RequestState:
+    __slots__ = ("replica_reads", "wrote")
+
+    def __init__(self):
+        self.replica_reads = False
+        self.wrote = False
+
+
+# The state of the request being served, if any.
+current_request = contextvars.ContextVar("coloby_replica_request", default=None)
+
+
+def pin_key(user_id):
+    return f"primary-pin:{user_id}"
+
+
+def pinned(request):
+    if request.COOKIES.get(PIN_COOKIE):
+        return True
+    user = getattr(request, "user", None)
+    return bool(user is not None and user.is_authenticated and cache.get(pin_key(user.pk)))
+
+
+def allow_reads(request):
+    """
+    Lets the rest of `request` read from a replica, if it is a GET or HEAD
+    and did not write recently.
+    """
+    state = current_request.get()
+    if state is not None and request.method in SAFE_METHODS and not pinned(request):
+        state.replica_reads = True
+
+
+class ReplicaHealth:
+    def __init__(self):
+        # Held while a check runs.
+        self._lock = threading.Lock()
+        self._checking = None
+        self._checked_at = None
+        self._healthy = []
+
+    def lag(self, alias):
+        """
+        Returns how many seconds `alias` is behind the primary. Only
+        PostgreSQL reports it; other databases count as up to date once they
+        answer.
+        """
+        connection = connections[alias]
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute(
+                    "SELECT CASE WHEN pg_is_in_recovery() "
+                    "THEN COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) ELSE 0 END"
+                )
+            else:
+                cursor.execute("SELECT 0")
+            return float(cursor.fetchone()[0])
+
+    def check(self):
+        healthy = []
+        for alias in settings.REPLICAS["ALIASES"]:
+            try:
+                lag = self.lag(alias)
+            except DatabaseError as e:
+                logger.warning(f"Replica {alias} is unreachable: {e}")
+                continue
+            if lag > settings.REPLICAS["MAX_LAG"]:
+                logger.warning(f"Replica {alias} is {lag:.1f}s behind, reading from the primary instead.")
+                continue
+            healthy.append(alias)
+        self._healthy = healthy
+        self._checked_at = time.monotonic()
+        return healthy
+
+    def healthy(self):
+        """
+        Returns the replicas that passed the last check, none before the
+        first one. Once it is CHECK_INTERVAL seconds old, a check starts in
+        the background; callers go on with the previous answer meanwhile.
+        """
+        if self.due() and self._lock.acquire(blocking=False):
+            self._checking = threading.Thread(target=self._check_in_background, name="replica-health", daemon=True)
+            self._checking.start()
+        return self._healthy
+
+    def _check_in_background(self):
+        try:
+            self.check()
+        except Exception:
+            logger.exception("Error checking the read replicas")
+        finally:
+            self._lock.release()
+            connections.close_all()
+
+    def wait(self):
+        """
+        Waits for a check running in the background to finish.
+        """
+        checking = self._checking
+        if checking is not None:
+            checking.join()
+
+    def due(self):
+        return self._checked_at is None or time.monotonic() - self._checked_at > settings.REPLICAS["CHECK_INTERVAL"]
+
+    def reset(self):
+        self._checked_at = None
+        self._healthy = []
+
+    def stats(self):
+        return {"configured": len(settings.REPLICAS["ALIASES"]), "healthy": len(self._healthy)}
+
+
+replica_health = ReplicaHealth()
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = current_request.get()
+        if state is None or not state.replica_reads or state.wrote or not settings.REPLICAS["ALIASES"]:
+            return None
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        healthy = replica_health.healthy()
+        return random.choice(healthy) if healthy else None
+
+    def db_for_write(self, model, **hints):
+        state = current_request.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.REPLICAS["ALIASES"]}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class ReplicaMiddleware:
+    """
+    Tracks whether each request wrote, and pins whoever made it to the
+    primary if it did.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state = RequestState()
+        token = current_request.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_request.reset(token)
+
+        if state.wrote and settings.REPLICAS["ALIASES"]:
+            sticky = settings.REPLICAS["STICKY_SECONDS"]
+            user = getattr(request, "user", None)
+            if user is not None and user.is_authenticated:
+                cache.set(pin_key(user.pk), True, sticky)
+            response.set_cookie(PIN_COOKIE, "1", max_age=sticky, httponly=True, samesite="Lax")
+        return response
+
+
+class ReplicaReadsMixin:
+    """
+    Lets GET and HEAD requests to an API view read from a replica. List it
+    before the view's base class.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        allow_reads(request)
@@ -6,4 +6,7 @@ websocket_urlpatterns = [
     path('chat/<str:room_slug>/', consumers.ChatConsumer.as_asgi()),
     re_path(r'ws/chat/send/(?P<room_slug>\w+)/$', consumers.ChatConsumer.as_asgi()),
     re_path(r'ws/chat/get/(?P<room_slug>\w+)/$', consumers.ChatConsumer.as_asgi()),
+    # One socket for any number of rooms, see MultiplexConsumer.
+    path('ws/', consumers.MultiplexConsumer.as_asgi()),
+    re_path(r'ws/notifications/(?P<room_name>\w+)/$', consumers.NotificationConsumer.as_asgi()),
 ]
@@ -0,0 +1,228 @@
+"""
+Full-text search over rooms, tasks, messages and files.
+
+Every searchable object has one SearchEntry row holding its title and text
+and the room that decides who may see it. Entries are written from
+post_save/post_delete (see cowork/signals.py) and, for rows inserted in
+bulk by a WriteBehindBuffer, from the buffer's `on_write` hook.
+
+Matching and ranking depend on the database:
+
+* PostgreSQL: the generated ``search_vector`` column and its GIN index,
+  ranked with ts_rank;
+* SQLite: the ``cowork_searchentry_fts`` FTS5 table, ranked with bm25;
+* anything else: case-insensitive substring matching, unranked.
+
+Results are paged by keyset on (rank, id), so deep pages cost the same as
+the first one.
+"""
+import base64
+import logging
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+
+from cowork.models import File, Message, Room, SearchEntry, Task
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'cowork_searchentry_fts'
+
+
+def room_document(room):
+    if room.deleted_at is not None:
+        return None
+    return SearchEntry.ROOM, room.pk, room.name, room.description or ''
+
+
+def task_document(task):
+    if task.deleted_at is not None:
+        return None
+    return SearchEntry.TASK, task.room_id, task.title, task.description or ''
+
+
+def message_document(message):
+    if message.deleted_at is not None or not message.message:
+        return None
+    return SearchEntry.MESSAGE, message.room_id, message.message[:80], message.message
+
+
+def file_document(file):
+    return SearchEntry.FILE, file.room_id, file.name, ''
+
+
+# model -> function returning (kind, room_id, title, body), or None when the
+# object should not be found.
+DOCUMENTS = {
+    Room: room_document,
+    Task: task_document,
+    Message: message_document,
+    File: file_document,
+}
+
+KINDS = {
+    Room: SearchEntry.ROOM,
+    Task: SearchEntry.TASK,
+    Message: SearchEntry.MESSAGE,
+    File: SearchEntry.FILE,
+}
+
+
+def build_entry(instance):
+    document = DOCUMENTS[type(instance)](instance)
+    if document is None:
+        return None
+    kind, room_id, title, body = document
+    return SearchEntry(kind=kind, object_id=instance.pk, room_id=room_id, title=title[:255], body=body)
+
+
+def index(instance):
+    entry = build_entry(instance)
+    if entry is None:
+        unindex(instance)
+        return
+    SearchEntry.objects.update_or_create(
+        kind=entry.kind,
+        object_id=entry.object_id,
+        defaults={'room_id': entry.room_id, 'title': entry.title, 'body': entry.body},
+    )
+
+
+def unindex(instance):
+    SearchEntry.objects.filter(kind=KINDS[type(instance)], object_id=instance.pk).delete()
+
+
+def unindex_rows(model, rows):
+    """
+    Drops the entries of `rows`, a queryset of `model`, in one DELETE.
+    """
+    if model in DOCUMENTS:
+        SearchEntry.objects.filter(kind=KINDS[model], object_id__in=rows.values('pk')).delete()
+
+
+def index_written(model, instances):
+    """
+    Indexes rows inserted with bulk_create, which sends no signals. Some
+    databases (SQLite among them) do not hand back the new primary keys;
+    then the newest len(instances) rows of the model are indexed instead.
+    Called in the inserting transaction, as WriteBehindBuffer's on_write
+    is, those are the rows just written: SQLite lets one writer in at a
+    time.
+    """
+    if model not in DOCUMENTS:
+        return
+    if any(instance.pk is None for instance in instances):
+        instances = model.objects.order_by('-pk')[:len(instances)]
+    entries = [entry for entry in map(build_entry, instances) if entry is not None]
+    SearchEntry.objects.bulk_create(entries, batch_size=500, ignore_conflicts=True)
+
+
+# Matching
+
+def terms(query):
+    return re.findall(r'\w+', query)
+
+
+def match_postgresql(entries, query):
+    tsquery = "plainto_tsquery('simple', %s)"
+    return entries.annotate(
+        rank=RawSQL(f"ts_rank(cowork_searchentry.search_vector, {tsquery})", (query,), output_field=FloatField()),
+    ).extra(where=[f"cowork_searchentry.search_vector @@ {tsquery}"], params=[query])
+
+
+def match_sqlite(entries, query):
+    # Quote every term so FTS5 reads user input as words, not query syntax.
+    fts_query = " ".join('"%s"' % term.replace('"', '""') for term in terms(query))
+    return entries.extra(
+        tables=[FTS_TABLE],
+        where=[f"{FTS_TABLE}.rowid = cowork_searchentry.id", f"{FTS_TABLE} MATCH %s"],
+        params=[fts_query],
+    ).annotate(
+        # bm25 is lower for better matches; negate it so higher ranks first
+        # on every database. Titles weigh twice as much as bodies.
+        rank=RawSQL(f"-bm25({FTS_TABLE}, 2.0, 1.0)", (), output_field=FloatField()),
+    )
+
+
+def match_contains(entries, query):
+    for term in terms(query):
+        entries = entries.filter(Q(title__icontains=term) | Q(body__icontains=term))
+    return entries.annotate(rank=Value(0.0, output_field=FloatField()))
+
+
+MATCHERS = {
+    'postgresql': match_postgresql,
+    'sqlite': match_sqlite,
+}
+
+
+# Paging
+
+def encode_cursor(rank, pk):
+    raw = f"{rank!r}|{pk}"
+    return base64.urlsafe_b64encode(raw.encode("utf8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    Returns the (rank, id) pair a cursor points at. Raises ValueError for
+    anything that is not a cursor we handed out.
+    """
+    try:
+        rank, pk = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf8").split("|")
+        return float(rank), int(pk)
+    except (UnicodeError, TypeError, ValueError) as e:
+        raise ValueError("Invalid search cursor") from e
+
+
+def page_size(requested=None):
+    if not requested:
+        return settings.SEARCH["PAGE_SIZE"]
+    return max(1, min(int(requested), settings.SEARCH["MAX_PAGE_SIZE"]))
+
+
+def visible_rooms(user):
+    rooms = Room.objects.filter(is_private=False)
+    if user.is_authenticated:
+        rooms = Room.objects.filter(Q(is_private=False) | Q(users=user) | Q(created_by=user))
+    return rooms.values('pk')
+
+
+def search(user, query, kinds=None, cursor=None, limit=None):
+    """
+    Returns one page of entries matching `query` in rooms `user` may see,
+    best match first, continuing after `cursor`. `next` is the cursor for
+    the following page, or None on the last one.
+    """
+    limit = page_size(limit)
+    if not terms(query):
+        return {"results": [], "next": None}
+
+    entries = SearchEntry.objects.filter(room__in=visible_rooms(user)).select_related('room')
+    if kinds:
+        entries = entries.filter(kind__in=kinds)
+    entries = MATCHERS.get(connection.vendor, match_contains)(entries, query)
+    if cursor:
+        rank, pk = decode_cursor(cursor)
+        entries = entries.filter(Q(rank__lt=rank) | Q(rank=rank, id__lt=pk))
+
+    rows = list(entries.order_by('-rank', '-id')[: limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    return {
+        "results": [
+            {
+                "type": entry.kind,
+                "id": entry.object_id,
+                "title": entry.title,
+                "room": entry.room.slug,
+                "rank": entry.rank,
+            }
+            for entry in rows
+        ],
+        "next": encode_cursor(rows[-1].rank, rows[-1].id) if has_more else None,
+    }
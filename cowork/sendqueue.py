@@ -0,0 +1,287 @@
+"""
+Bounded outbound queues for WebSocket connections.
+
+A consumer handles its channel messages one at a time, so a socket whose
+client reads slowly used to hold up everything addressed to it: frames piled
+up in the channel layer and in the server's write buffer without limit. With
+``SendQueueMixin`` a consumer's ``send()`` only puts the frame on a bounded
+per-connection queue, and a separate task writes the queue to the socket.
+
+Daphne hands every frame straight to Twisted, whose write buffer never
+refuses one, so the writer instead waits on the transport itself:
+``BackpressureMiddleware`` registers a ``TransportProducer`` with each
+connection's transport, which Twisted pauses while more than its
+``bufferSize`` is waiting for the client. Frames then stay in the queue,
+where the policy below applies. Under other servers there is no such signal
+and the queue only bounds what the writer has not caught up with.
+
+``WEBSOCKET_SEND_QUEUE["POLICY"]`` decides how the queue stays bounded:
+
+* ``drop_oldest`` drops the oldest queued frame to make room when full;
+* ``coalesce`` merges a frame sent under a ``coalesce`` key (e.g. presence
+  updates) into the one with the same key that is still waiting, and
+  otherwise drops the oldest frame when full;
+* ``disconnect`` closes the socket once the queue is full.
+
+With the first two, a client is still closed once it has had
+``DISCONNECT_AFTER`` frames dropped.
+"""
+import asyncio
+import collections
+import functools
+import logging
+import weakref
+
+from django.conf import settings
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+# "Try Again Later": the server is shedding this client, not failing.
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+# Totals for connections that have already gone away.
+_closed_totals = collections.Counter()
+_live_queues = weakref.WeakSet()
+
+
+class SendQueue:
+    def __init__(self, write, close, max_size=None, policy=None, disconnect_after=None, merge=None, writable=None):
+        options = settings.WEBSOCKET_SEND_QUEUE
+        self.write = write
+        self.close_socket = close
+        self.max_size = max_size or options["MAX_SIZE"]
+        self.policy = policy or options["POLICY"]
+        self.disconnect_after = disconnect_after if disconnect_after is not None else options["DISCONNECT_AFTER"]
+        # merge(key, queued_text, new_text) -> text placed in the queue when
+        # a frame is coalesced with one still waiting.
+        self.merge = merge
+        # An asyncio.Event cleared while the socket cannot take more, if the
+        # server tells us (see TransportProducer).
+        self.writable = writable
+        if self.policy not in POLICIES:
+            raise ValueError(f"Unknown send queue policy: {self.policy}")
+
+        # Entries are [coalesce_key, text_data, bytes_data]
+        self.frames = collections.deque()
+        self.keyed = {}
+        self.high_water = 0
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.closed = False
+        self._ready = asyncio.Event()
+        self._writer = None
+        _live_queues.add(self)
+
+    def put(self, text_data=None, bytes_data=None, coalesce=None):
+        """
+        Queues a frame without waiting for the socket. Returns False once the
+        queue has given up on the connection.
+        """
+        if self.closed:
+            return False
+
+        if coalesce is not None and self.policy == "coalesce" and coalesce in self.keyed:
+            entry = self.keyed[coalesce]
+            if self.merge is not None and text_data is not None and entry[1] is not None:
+                text_data = self.merge(coalesce, entry[1], text_data)
+            entry[1], entry[2] = text_data, bytes_data
+            self.coalesced += 1
+            return True
+
+        if len(self.frames) >= self.max_size:
+            if self.policy == "disconnect":
+                self._give_up("queue full")
+                return False
+            dropped = self.frames.popleft()
+            if dropped[0] is not None and self.keyed.get(dropped[0]) is dropped:
+                del self.keyed[dropped[0]]
+            self.dropped += 1
+            if self.disconnect_after and self.dropped >= self.disconnect_after:
+                self._give_up(f"{self.dropped} frames dropped")
+                return False
+
+        entry = [coalesce, text_data, bytes_data]
+        self.frames.append(entry)
+        if coalesce is not None:
+            self.keyed[coalesce] = entry
+        self.high_water = max(self.high_water, len(self.frames))
+
+        if self._writer is None:
+            self._writer = asyncio.get_running_loop().create_task(self._write_loop())
+        self._ready.set()
+        return True
+
+    async def _write_loop(self):
+        try:
+            while not self.closed:
+                if not self.frames:
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+                if self.writable is not None and not self.writable.is_set():
+                    # Frames wait here, counted against the queue, until
+                    # the client catches up.
+                    await self.writable.wait()
+                    continue
+                entry = self.frames.popleft()
+                key, text_data, bytes_data = entry
+                if key is not None and self.keyed.get(key) is entry:
+                    del self.keyed[key]
+                await self.write(text_data, bytes_data)
+                self.sent += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"WebSocket send failed: {str(e)}")
+            self.stop()
+
+    def _give_up(self, reason):
+        logger.warning(
+            f"Closing slow WebSocket client ({reason}, high water {self.high_water}, "
+            f"{self.dropped} dropped)"
+        )
+        _closed_totals["disconnected"] += 1
+        self.stop()
+        asyncio.get_running_loop().create_task(self.close_socket(SLOW_CONSUMER_CLOSE_CODE))
+
+    def stop(self):
+        """
+        Discards whatever is still queued and stops the writer.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.frames.clear()
+        self.keyed.clear()
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        _closed_totals["sent"] += self.sent
+        _closed_totals["dropped"] += self.dropped
+        _closed_totals["coalesced"] += self.coalesced
+        _closed_totals["max_high_water"] = max(_closed_totals["max_high_water"], self.high_water)
+        _live_queues.discard(self)
+
+    def stats(self):
+        return {
+            "depth": len(self.frames),
+            "high_water": self.high_water,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
+
+
+def send_queue_stats():
+    """
+    Totals across this process's connections, for monitoring. `high_water`
+    is the deepest any currently open queue has been; `max_high_water`
+    includes connections that have closed.
+    """
+    live = [queue.stats() for queue in list(_live_queues)]
+    high_water = max((stats["high_water"] for stats in live), default=0)
+    return {
+        "connections": len(live),
+        "depth": sum(stats["depth"] for stats in live),
+        "high_water": high_water,
+        "max_high_water": max(high_water, _closed_totals["max_high_water"]),
+        "sent": _closed_totals["sent"] + sum(stats["sent"] for stats in live),
+        "dropped": _closed_totals["dropped"] + sum(stats["dropped"] for stats in live),
+        "coalesced": _closed_totals["coalesced"] + sum(stats["coalesced"] for stats in live),
+        "disconnected": _closed_totals["disconnected"],
+    }
+
+
+@implementer(IPushProducer)
+class TransportProducer:
+    """
+    Registered as the streaming producer of a daphne connection's Twisted
+    transport, which pauses it while the client is behind on reading and
+    resumes it once the buffer has been written out.
+    """
+
+    def __init__(self):
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def pauseProducing(self):
+        self.writable.clear()
+
+    def resumeProducing(self):
+        self.writable.set()
+
+    def stopProducing(self):
+        self.writable.set()
+
+
+def daphne_protocol(send):
+    """
+    Returns the Twisted protocol behind a daphne `send` callable, which is
+    partial(server.handle_reply, protocol), or None under another server.
+    """
+    if isinstance(send, functools.partial) and send.args and hasattr(send.args[0], "registerProducer"):
+        return send.args[0]
+    return None
+
+
+class BackpressureMiddleware:
+    """
+    Outermost ASGI middleware for WebSocket connections: under daphne, puts
+    a TransportProducer for the connection in the scope as
+    "send_backpressure", where SendQueueMixin picks it up.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        protocol = daphne_protocol(send)
+        if protocol is not None:
+            producer = TransportProducer()
+            try:
+                protocol.registerProducer(producer, True)
+            except RuntimeError:
+                # The transport already has a producer; go without.
+                logger.warning("WebSocket transport already has a producer, sending without backpressure")
+            else:
+                scope = dict(scope, send_backpressure=producer)
+        return await self.inner(scope, receive, send)
+
+
+class SendQueueMixin:
+    """
+    Routes an AsyncWebsocketConsumer's send() through a SendQueue. Pass
+    `coalesce=<key>` to send() for frames that may be merged with an
+    earlier one still waiting; override `merge_frames` to control how.
+    """
+
+    send_queue = None
+
+    async def send(self, text_data=None, bytes_data=None, close=False, coalesce=None):
+        if close:
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+            return
+        if self.send_queue is None:
+            producer = self.scope.get("send_backpressure")
+            self.send_queue = SendQueue(
+                self._write_frame,
+                self.close,
+                merge=self.merge_frames,
+                writable=producer.writable if producer is not None else None,
+            )
+        self.send_queue.put(text_data, bytes_data, coalesce=coalesce)
+
+    async def _write_frame(self, text_data, bytes_data):
+        await super().send(text_data=text_data, bytes_data=bytes_data)
+
+    def merge_frames(self, key, queued, frame):
+        return frame
+
+    async def websocket_disconnect(self, message):
+        if self.send_queue is not None:
+            self.send_queue.stop()
+        await super().websocket_disconnect(message)
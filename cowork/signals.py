@@ -1,19 +1,25 @@
-from django.db.models.signals import post_save
-from django.dispatch import receiver
-from .models import Message, Task, Room, Notification, Comment
-from django.core.mail import send_mail
 from django.conf import settings
+from django.db import transaction
+from django.db.models import DEFERRED
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save, pre_delete
+from django.dispatch import receiver
+
+from accounts.models import CustomUser
+from cowork import activity, dashboard, inbox, outbox, search
+from cowork.apikeys import key_cache
+from cowork.autocomplete import room_autocomplete
+from cowork.fanout import fanout
+from .models import (
+    APIKey, Comment, File, InboxItem, Message, MessageArchive, Notification, Room, Task, soft_deletion_changed,
+)
+
+
 @receiver(post_save, sender=Message)
 def create_message_notification(sender, instance, created, **kwargs):
+    # One room-wide notification; cowork/fanout.py delivers it to every
+    # other member once this is committed.
     if created:
-        room = instance.room
-        sender = instance.sender
-        participants = room.participants.exclude(id=sender.id)
-        message = f"{sender.username} sent a message: {instance.content}"
-        Notification.objects.bulk_create([
-            Notification(room=room, sender=sender, recipient=participant, message=message)
-            for participant in participants
-        ])
+        activity.messages_posted([instance])
 
 # @receiver(post_save, sender=UploadedFile)
 # def create_file_notification(sender, instance, created, **kwargs):
@@ -28,18 +34,10 @@ def create_message_notification(sender, instance, created, **kwargs):
 #         ])
 
 
-
 @receiver(post_save, sender=Task)
 def create_task_notification(sender, instance, created, **kwargs):
     if created:
-        message = f"Task '{instance.title}' assigned to you in room '{instance.room.name}'"
-        Notification.objects.create(room=instance.room, sender=instance.created_by, message=message)
-
-        # Send email notification
-        subject = 'New Task Assignment'
-        message = f"Hello,\n\n{message}\n\nRegards,\n{settings.EMAIL_HOST_USER}"
-        recipient_email = instance.assigned_to.email
-        send_mail(subject, message, settings.EMAIL_HOST_USER, [recipient_email])
+        activity.tasks_created([instance])
 
 @receiver(post_save, sender=Comment)
 def create_comment_notification(sender, instance, created, **kwargs):
@@ -47,11 +45,13 @@ def create_comment_notification(sender, instance, created, **kwargs):
         message = f"New comment added to task '{instance.task.title}' in room '{instance.task.room.name}'"
         Notification.objects.create(room=instance.task.room, sender=instance.user, message=message)
 
-        # Send email notification
-        subject = 'New Comment on Task'
-        message = f"Hello,\n\n{message}\n\nRegards,\n{settings.EMAIL_HOST_USER}"
-        recipient_email = instance.task.assigned_to.email
-        send_mail(subject, message, settings.EMAIL_HOST_USER, [recipient_email])
+        # Queue the email; cowork/outbox.py sends it once this commits.
+        # Several comments on one task make one line of a digest.
+        many = f"{{count}} new comments added to task '{instance.task.title}' in room '{instance.task.room.name}'"
+        outbox.notify(
+            [instance.task.assigned_to.email], 'New Comment on Task', message,
+            key=f"task:{instance.task_id}:comments", many=many, from_email=settings.EMAIL_HOST_USER,
+        )
 
 
 # @receiver(post_save, sender=Branch)
@@ -64,4 +64,228 @@ def create_comment_notification(sender, instance, created, **kwargs):
 #         Notification.objects.bulk_create([
 #             Notification(room=room, sender=sender, recipient=participant, message=message)
 #             for participant in participants
-#         ])
\ No newline at end of file
+#         ])
+
+# Keep the cached userdata summaries (cowork/dashboard.py) in step with the
+# rows they are built from.
+
+
+@receiver(post_init, sender=Task)
+def remember_task_assignee(sender, instance, **kwargs):
+    instance._loaded_assigned_to_id = instance.assigned_to_id
+
+
+@receiver(post_save, sender=Task)
+@receiver(post_delete, sender=Task)
+def refresh_task_dashboards(sender, instance, **kwargs):
+    dashboard.invalidate([instance.assigned_to_id, instance._loaded_assigned_to_id], ("assigned_tasks",))
+    instance._loaded_assigned_to_id = instance.assigned_to_id
+
+
+@receiver(post_save, sender=Room)
+@receiver(pre_delete, sender=Room)
+def refresh_room_dashboards(sender, instance, **kwargs):
+    dashboard.invalidate_rooms([instance.pk])
+
+
+@receiver(m2m_changed, sender=Room.users.through)
+@receiver(m2m_changed, sender=Room.likes.through)
+def refresh_membership_dashboards(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+    if not reverse:
+        dashboard.invalidate_rooms([instance.pk], pk_set or ())
+        return
+    # user.room_set / user.liked_rooms: `instance` is the user.
+    if pk_set is None:
+        field = "users" if sender is Room.users.through else "likes"
+        pk_set = Room.objects.with_deleted().filter(**{field: instance}).values_list('pk', flat=True)
+    dashboard.invalidate_rooms(pk_set, [instance.pk])
+
+
+@receiver(post_init, sender=CustomUser)
+def remember_username(sender, instance, **kwargs):
+    instance._loaded_username = instance.username
+
+
+@receiver(post_save, sender=CustomUser)
+def refresh_user_dashboards(sender, instance, created, **kwargs):
+    if created:
+        return
+    dashboard.invalidate([instance.pk], ("user", "assigned_tasks"))
+    if instance.username != instance._loaded_username:
+        # Usernames show up in the member lists of every room the user is in.
+        room_ids = set(instance.room_set.values_list('pk', flat=True))
+        room_ids.update(instance.created_rooms.values_list('pk', flat=True))
+        dashboard.invalidate_rooms(room_ids, [instance.pk])
+        instance._loaded_username = instance.username
+
+
+# Keep the search index (cowork/search.py) in step. Soft deletes are saves,
+# and index() drops entries for soft-deleted objects.
+
+
+@receiver(post_save, sender=Room)
+@receiver(post_save, sender=Task)
+@receiver(post_save, sender=Message)
+@receiver(post_save, sender=File)
+def update_search_entry(sender, instance, **kwargs):
+    search.index(instance)
+
+
+@receiver(post_delete, sender=Room)
+@receiver(post_delete, sender=Task)
+@receiver(post_delete, sender=Message)
+@receiver(post_delete, sender=File)
+def delete_search_entry(sender, instance, **kwargs):
+    search.unindex(instance)
+
+
+# Keep the room autocomplete index (cowork/autocomplete.py) in step.
+
+
+@receiver(post_save, sender=Room)
+def update_room_autocomplete(sender, instance, **kwargs):
+    room_autocomplete.update(instance)
+
+
+@receiver(post_delete, sender=Room)
+def remove_room_autocomplete(sender, instance, **kwargs):
+    room_autocomplete.remove(instance.pk)
+
+
+@receiver(m2m_changed, sender=Room.users.through)
+def refresh_room_autocomplete_members(sender, instance, action, reverse, pk_set, **kwargs):
+    if not room_autocomplete.tracking:
+        return
+    if not reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            room_autocomplete.refresh_members([instance.pk])
+        return
+    # user.room_set: `instance` is the user and pk_set holds room ids.
+    if action == "pre_clear":
+        instance._cleared_room_ids = list(instance.room_set.values_list('pk', flat=True))
+    elif action == "post_clear":
+        room_autocomplete.refresh_members(getattr(instance, '_cleared_room_ids', ()))
+    elif action in ("post_add", "post_remove"):
+        room_autocomplete.refresh_members(pk_set)
+
+
+# Deliver notifications to inboxes (cowork/fanout.py) and keep unread
+# counters (cowork/inbox.py) in step.
+
+
+@receiver(post_save, sender=Notification)
+def deliver_notification(sender, instance, created, **kwargs):
+    if created:
+        fanout.schedule_on_commit()
+    elif instance.deleted_at is not None:
+        inbox.forget(instance.deliveries.values_list('recipient', flat=True))
+
+
+def counts_as_unread(item):
+    return item.pk is not None and not item.is_read and item.deleted_at is None
+
+
+@receiver(post_init, sender=InboxItem)
+def remember_inbox_item_state(sender, instance, **kwargs):
+    instance._loaded_unread = counts_as_unread(instance)
+
+
+@receiver(post_save, sender=InboxItem)
+def adjust_unread_counter(sender, instance, **kwargs):
+    unread = counts_as_unread(instance)
+    inbox.adjust([instance.recipient_id], int(unread) - int(instance._loaded_unread))
+    instance._loaded_unread = unread
+
+
+@receiver(post_delete, sender=InboxItem)
+def drop_unread_counter(sender, instance, **kwargs):
+    inbox.adjust([instance.recipient_id], -int(instance._loaded_unread))
+
+
+@receiver(post_init, sender=Room)
+def remember_room_deleted_at(sender, instance, **kwargs):
+    # Rooms are often loaded with only(); don't query for a deferred field.
+    instance._loaded_deleted_at = instance.__dict__.get('deleted_at', DEFERRED)
+
+
+@receiver(post_save, sender=Room)
+def forget_room_unread_counters(sender, instance, created, **kwargs):
+    # Soft-deleting or restoring a room hides or shows its notifications.
+    if not created and instance.deleted_at != instance._loaded_deleted_at:
+        inbox.forget(
+            InboxItem.objects.filter(notification__room=instance, is_read=False)
+            .values_list('recipient', flat=True).distinct()
+        )
+    instance._loaded_deleted_at = instance.deleted_at
+
+
+# Drop cached API keys (cowork/apikeys.py) that no longer authenticate as
+# they did.
+
+
+@receiver(post_save, sender=APIKey)
+@receiver(post_delete, sender=APIKey)
+def drop_cached_api_key(sender, instance, **kwargs):
+    key_cache.discard(key_id=instance.pk)
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def drop_cached_user_api_keys(sender, instance, **kwargs):
+    key_cache.discard(user_id=instance.pk)
+
+
+# Queryset soft deletes and restores (SoftDeletionQuerySet) are single
+# UPDATEs and send no post_save; catch the search index, the caches and the
+# unread counters up for the whole set of rows at once.
+
+
+@receiver(soft_deletion_changed)
+def update_search_entries(sender, rows, deleted, **kwargs):
+    if deleted:
+        search.unindex_rows(sender, rows)
+    else:
+        search.index_written(sender, list(rows))
+
+
+@receiver(soft_deletion_changed, sender=Room)
+def rooms_soft_deletion_changed(sender, rows, deleted, **kwargs):
+    rooms = list(rows.only('pk', 'name', 'slug', 'is_private', 'deleted_at'))
+    room_ids = [room.pk for room in rooms]
+    dashboard.invalidate_rooms(room_ids)
+    for room in rooms:
+        room_autocomplete.update(room)
+    if not deleted:
+        room_autocomplete.refresh_members(room_ids)
+    inbox.forget(
+        InboxItem.objects.filter(notification__room_id__in=room_ids, is_read=False)
+        .values_list('recipient', flat=True).distinct()
+    )
+
+
+@receiver(soft_deletion_changed, sender=Task)
+def tasks_soft_deletion_changed(sender, rows, deleted, **kwargs):
+    dashboard.invalidate(rows.values_list('assigned_to_id', flat=True), ("assigned_tasks",))
+
+
+@receiver(soft_deletion_changed, sender=Notification)
+def notifications_soft_deletion_changed(sender, rows, deleted, **kwargs):
+    inbox.forget(InboxItem.objects.filter(notification__in=rows).values_list('recipient', flat=True).distinct())
+
+
+@receiver(soft_deletion_changed, sender=InboxItem)
+def inbox_items_soft_deletion_changed(sender, rows, deleted, **kwargs):
+    inbox.forget(rows.values_list('recipient', flat=True).distinct())
+
+
+# An archived month (cowork/archive.py) goes with its file, such as when its
+# room is purged. The file is only deleted once the row's deletion commits,
+# so a rolled back delete keeps its history.
+
+
+@receiver(post_delete, sender=MessageArchive)
+def delete_archive_file(sender, instance, **kwargs):
+    file = instance.file
+    transaction.on_commit(lambda: file.delete(save=False))
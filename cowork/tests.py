@@ -1,20 +1,70 @@
-from django.test import TestCase
-from rest_framework.test import APIClient, APITestCase
-from rest_framework import status
-from rest_framework.authtoken.models import Token
+import asyncio
+import functools
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+from datetime import datetime, timedelta, timezone
+from io import StringIO
+from unittest import mock
+
+from aiosmtpd.controller import Controller
+from asgiref.sync import sync_to_async
+from channels.layers import InMemoryChannelLayer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from daphne.server import Server as DaphneServer
+from daphne.ws_protocol import WebSocketProtocol
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from .models import Room, UploadedFile, Message, Task
-from serializers.serializers import TaskSerializer 
+from django.contrib.auth.models import AnonymousUser
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, connection, connections, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import override_settings
-from django.conf import settings
-from datetime import timezone, datetime
-import tempfile
-import shutil
+from django.utils import timezone as django_timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APITestCase, APITransactionTestCase
+from twisted.internet.abstract import FileDescriptor
+
+from cowork import archive, dashboard, inbox, loadtest, metrics, outbox, search
+from cowork.apikeys import key_cache
+from cowork.autocomplete import RoomAutocomplete, room_autocomplete
+from cowork.buffers import WriteBehindBuffer
+from cowork.consumers import message_buffer
+from cowork.db import DatabaseExecutor
+from cowork.fanout import deliver, deliver_chunk, deliver_pending
+from cowork.history import history_page
+from cowork.layers import BrokerChannelLayer, ChannelBroker
+from cowork.models import (
+    APIKey, Comment, EmailDigest, File, InboxItem, Message, MessageArchive, Notification, OutgoingEmail, Room,
+    SearchEntry, Task, UnreadCounter,
+)
+from cowork.notifications import TaskEvent, notification_events, rows_written
+from cowork.presence import PresenceRegistry, merge_diffs
+from cowork.replicas import PIN_COOKIE, ReplicaHealth, replica_health
+from cowork.routing import websocket_urlpatterns
+from cowork.sendqueue import SLOW_CONSUMER_CLOSE_CODE, BackpressureMiddleware, SendQueue, TransportProducer
+from serializers.serializers import RoomSerializer
 
 
 User = get_user_model()
+
+# TransactionTestCases really commit. Deliver notifications inline and leave
+# emails queued, so no background thread races the test database.
+no_background_delivery = override_settings(
+    NOTIFICATION_FANOUT={**settings.NOTIFICATION_FANOUT, "BACKGROUND": False},
+    EMAIL_OUTBOX={**settings.EMAIL_OUTBOX, "SEND_ON_COMMIT": False},
+)
+
 # @override_settings(MEDIA_ROOT=tempfile.mkdtemp(prefix="media"))
 # class MessageAPITests(APITestCase):
 #     def setUp(self):
@@ -269,54 +319,1548 @@ User = get_user_model()
 #     #     self.assertEqual(Task.objects.count(), 1)
 
 
-from django.test import TestCase
-from rest_framework.test import APIClient
-from cowork.models import Room
-from cowork.models import UploadedFile, Branch, Commit, UploadedFileVersion
-from serializers.serializers import UploadedFileSerializer
+class BrokerChannelLayerTests(SimpleTestCase):
+    """Group messaging through the broker between two "worker processes"."""
+
+    async def start_brokers(self, count):
+        tmp = tempfile.mkdtemp(prefix="broker")
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        hosts = [f"unix://{os.path.join(tmp, f'{i}.sock')}" for i in range(count)]
+        self.brokers = [ChannelBroker() for _ in hosts]
+        servers = [await broker.serve(host) for broker, host in zip(self.brokers, hosts)]
+        return hosts, servers
+
+    async def settle(self):
+        # Each worker has its own broker connection, so let the broker read
+        # the membership changes before another worker broadcasts.
+        await asyncio.sleep(0.05)
+
+    async def stop(self, servers, *layers):
+        for layer in layers:
+            await layer.close()
+        await self.settle()
+        for server in servers:
+            server.close()
+
+    async def test_group_send_reaches_other_worker(self):
+        hosts, servers = await self.start_brokers(1)
+        worker_a = BrokerChannelLayer(hosts=hosts)
+        worker_b = BrokerChannelLayer(hosts=hosts)
+        channel_a = await worker_a.new_channel()
+        channel_b = await worker_b.new_channel()
+        await worker_a.group_add("chat_room", channel_a)
+        await worker_b.group_add("chat_room", channel_b)
+        await self.settle()
+
+        await worker_a.group_send("chat_room", {"type": "chat_message", "message": "hi"})
+
+        self.assertEqual((await asyncio.wait_for(worker_a.receive(channel_a), 1))["message"], "hi")
+        self.assertEqual((await asyncio.wait_for(worker_b.receive(channel_b), 1))["message"], "hi")
+        await self.stop(servers, worker_a, worker_b)
+
+    async def test_group_discard_stops_delivery(self):
+        hosts, servers = await self.start_brokers(1)
+        worker_a = BrokerChannelLayer(hosts=hosts)
+        worker_b = BrokerChannelLayer(hosts=hosts)
+        channel_b = await worker_b.new_channel()
+        await worker_b.group_add("chat_room", channel_b)
+        await worker_b.group_discard("chat_room", channel_b)
+        await self.settle()
+
+        await worker_a.group_send("chat_room", {"type": "chat_message", "message": "hi"})
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(worker_b.receive(channel_b), 0.2)
+        await self.stop(servers, worker_a, worker_b)
+
+    async def test_groups_are_sharded_across_brokers(self):
+        hosts, servers = await self.start_brokers(3)
+        worker_a = BrokerChannelLayer(hosts=hosts)
+        worker_b = BrokerChannelLayer(hosts=hosts)
+        groups = [f"chat_{i}" for i in range(12)]
+        channel_b = await worker_b.new_channel()
+        for group in groups:
+            await worker_b.group_add(group, channel_b)
+        await self.settle()
+
+        for group in groups:
+            await worker_a.group_send(group, {"type": "chat_message", "group": group})
+
+        received = set()
+        for _ in groups:
+            received.add((await asyncio.wait_for(worker_b.receive(channel_b), 1))["group"])
+        self.assertEqual(received, set(groups))
+        self.assertTrue(all(broker.groups for broker in self.brokers))
+        await self.stop(servers, worker_a, worker_b)
+
+    async def test_receiver_reconnects_after_losing_the_broker(self):
+        hosts, servers = await self.start_brokers(1)
+        worker_a = BrokerChannelLayer(hosts=hosts)
+        worker_b = BrokerChannelLayer(hosts=hosts)
+        channel_b = await worker_b.new_channel()
+        await worker_b.group_add("chat_room", channel_b)
+        receiving = asyncio.ensure_future(worker_b.receive(channel_b))
+        await self.settle()
+
+        # The broker drops worker b, which is only waiting to receive.
+        self.brokers[0].clients[worker_b.client_prefix].close()
+        await asyncio.sleep(0.3)
+        self.assertIn(worker_b.client_prefix, self.brokers[0].clients)
+
+        await worker_a.group_send("chat_room", {"type": "chat_message", "message": "still here"})
+        self.assertEqual((await asyncio.wait_for(receiving, 1))["message"], "still here")
+        await self.stop(servers, worker_a, worker_b)
+
+
+@no_background_delivery
+class WriteBehindBufferTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='buffer@example.com', password='testpassword', username='buffer')
+        self.room = Room.objects.create(name='Buffer Room', slug='buffer-room')
+
+    def message(self, text):
+        return Message(room=self.room, user=self.user, message=text)
+
+    async def count(self):
+        return await sync_to_async(Message.objects.filter(room=self.room).count)()
+
+    async def test_flushes_when_batch_is_full(self):
+        buffer = WriteBehindBuffer(Message, max_batch=2, flush_interval=60)
+        await buffer.add(self.message("one"))
+        self.assertEqual(await self.count(), 0)
+        persisted = await buffer.add(self.message("two"))
+        await persisted
+        self.assertEqual(await self.count(), 2)
+
+    async def test_flushes_after_interval(self):
+        buffer = WriteBehindBuffer(Message, max_batch=100, flush_interval=0.01)
+        await (await buffer.add(self.message("one")))
+        self.assertEqual(await self.count(), 1)
+
+    async def test_waits_for_flush_when_full(self):
+        buffer = WriteBehindBuffer(Message, max_batch=100, flush_interval=60, max_pending=3)
+        for i in range(4):
+            await buffer.add(self.message(str(i)))
+        self.assertEqual(await self.count(), 3)
+        self.assertEqual(len(buffer.pending), 1)
+        await sync_to_async(buffer.flush_sync)()
+        self.assertEqual(await self.count(), 4)
+
+    async def test_bad_row_only_fails_its_own_future(self):
+        buffer = WriteBehindBuffer(Message, max_batch=3, flush_interval=60)
+        good = await buffer.add(self.message("good"))
+        bad = await buffer.add(Message(room=self.room, user_id=uuid.uuid4(), message="orphan"))
+        also_good = await buffer.add(self.message("also good"))
+        with self.assertLogs('cowork.buffers', 'ERROR'):
+            await buffer.flush()
+
+        self.assertEqual((await good).message, "good")
+        self.assertEqual((await also_good).message, "also good")
+        with self.assertRaises(IntegrityError):
+            await bad
+        self.assertEqual(await self.count(), 2)
 
-@override_settings(MEDIA_ROOT=tempfile.mkdtemp(prefix="media"))
-class UploadFileViewTests(TestCase):
 
+class DatabaseExecutorTests(SimpleTestCase):
+    async def test_runs_on_pool_threads(self):
+        executor = DatabaseExecutor(max_workers=2)
+        self.addCleanup(executor.shutdown)
+        name = await executor.run(lambda: threading.current_thread().name)
+        self.assertTrue(name.startswith("coloby-db"))
+        self.assertEqual(executor.stats()["completed"], 1)
+
+    async def test_reports_queue_depth(self):
+        executor = DatabaseExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        release = threading.Event()
+        blocker = asyncio.ensure_future(executor.run(release.wait, 5))
+        waiting = [asyncio.ensure_future(executor.run(lambda: None)) for _ in range(3)]
+        await asyncio.sleep(0.05)
+
+        self.assertEqual(executor.stats()["active"], 1)
+        self.assertEqual(executor.stats()["queue_depth"], 3)
+
+        release.set()
+        await asyncio.gather(blocker, *waiting)
+        self.assertEqual(executor.stats()["queue_depth"], 0)
+
+
+class PresenceRegistryTests(SimpleTestCase):
+    """Two registries sharing a channel layer behave like two workers."""
+
+    async def start_workers(self):
+        layer = InMemoryChannelLayer()
+        self.worker_a = PresenceRegistry(ttl=30, interval=60, channel_layer=layer)
+        self.worker_b = PresenceRegistry(ttl=30, interval=60, channel_layer=layer)
+        await self.worker_a.start(background=False)
+        await self.worker_b.start(background=False)
+        self.frames = {"a": [], "b": []}
+
+    def listener(self, name):
+        async def send(frame):
+            self.frames[name].append(json.loads(frame))
+        return send
+
+    async def tick_all(self):
+        for _ in range(2):
+            await self.worker_a.tick()
+            await self.worker_b.tick()
+            await asyncio.sleep(0.01)
+
+    async def test_presence_is_shared_between_workers(self):
+        await self.start_workers()
+        await self.worker_a.join("room", "chan-a", "1", "alice", self.listener("a"))
+        await self.worker_b.join("room", "chan-b", "2", "bob", self.listener("b"))
+        await self.tick_all()
+
+        self.assertEqual(self.worker_a.online("room"), {"1": "alice", "2": "bob"})
+        self.assertEqual(self.worker_b.online("room"), {"1": "alice", "2": "bob"})
+        joined = [user["username"] for frame in self.frames["a"] for user in frame["joined"]]
+        self.assertEqual(sorted(joined), ["alice", "bob"])
+
+        await self.worker_b.leave("room", "chan-b")
+        await self.tick_all()
+        self.assertEqual(self.worker_a.online("room"), {"1": "alice"})
+        self.assertEqual(self.frames["a"][-1]["left"], ["2"])
+        await self.worker_a.stop()
+        await self.worker_b.stop()
+
+    async def test_silent_sockets_expire(self):
+        await self.start_workers()
+        await self.worker_a.join("room", "chan-a", "1", "alice", self.listener("a"))
+        await self.worker_a.join("room", "chan-c", "3", "carol", self.listener("a"))
+        await self.tick_all()
+
+        self.worker_a.local["room"]["chan-c"][2] -= 60
+        self.worker_a.touch("room", "chan-a")
+        await self.tick_all()
+
+        self.assertEqual(self.worker_a.online("room"), {"1": "alice"})
+        self.assertEqual(self.frames["a"][-1]["left"], ["3"])
+        await self.worker_a.stop()
+        await self.worker_b.stop()
+
+
+class HistoryPageTests(TestCase):
     def setUp(self):
-        # Create a room
-        self.room = Room.objects.create(name='Test Room')
-
-        # Create a user
-        self.user = User.objects.create(username='testuser')
-
-        # Create an uploaded file
-        self.file = SimpleUploadedFile('testfile.txt', b'This is a test file.')
-
-    def test_create_file(self):
-        # Create an API client
-        client = APIClient()
-        client.force_authenticate(user=self.user)
-
-        # Send a POST request to the upload file view with the file
-        data = {
-            'file': self.file,
-            'room_slug': self.room.slug,
-        }
-        response = client.post('/api/v1/room/upload/file/<str:room_slug>/', data=data, format='multipart')
-
-        # Verify that the response is successful
-        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
-
-        # Verify that the uploaded file was saved to the database
-        uploaded_file = UploadedFile.objects.get(pk=response.data['id'])
-        self.assertEqual(uploaded_file.file, self.file)
-
-        # Verify that the commit was created
-        commit = Commit.objects.get(pk=uploaded_file.commit.pk)
-        self.assertEqual(commit.uploader, self.user)
-
-        # Verify that the version was created
-        version = UploadedFileVersion.objects.get(pk=uploaded_file.version.pk)
-        self.assertEqual(version.file, self.file)
-
-        # Verify that the branch was created
-        branch = Branch.objects.get(pk=uploaded_file.branch.pk)
-        self.assertEqual(branch.original_file, uploaded_file)
-        self.assertEqual(branch.created_by, self.user)
-        self.assertEqual(branch.room, self.room)
+        self.user = User.objects.create_user(email='history@example.com', password='testpassword', username='history')
+        self.room = Room.objects.create(name='History Room', slug='history-room')
+        Message.objects.bulk_create([Message(room=self.room, user=self.user, message=str(i)) for i in range(7)])
+        # Give two messages the same timestamp to exercise the id tie-breaker.
+        start = django_timezone.now() - timedelta(days=1)
+        for i, message in enumerate(Message.objects.filter(room=self.room).order_by('id')):
+            Message.objects.filter(pk=message.pk).update(created_at=start + timedelta(minutes=min(i, 5)))
+
+    def test_pages_walk_back_through_history(self):
+        seen, cursor = [], None
+        for expected_size in (3, 3, 1):
+            page = history_page(self.room, before=cursor, limit=3)
+            self.assertEqual(len(page["messages"]), expected_size)
+            seen.extend(m["message"] for m in page["messages"])
+            cursor = page["next"]
+        self.assertIsNone(cursor)
+        self.assertEqual(seen, [str(i) for i in reversed(range(7))])
+
+    def test_page_is_a_single_query(self):
+        with self.assertNumQueries(1):
+            history_page(self.room, limit=3)
+
+    def test_rejects_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            history_page(self.room, before="not-a-cursor")
+        with self.assertRaisesMessage(ValueError, "Invalid history cursor."):
+            history_page(self.room, before={"created_at": 1})
+
+    def test_rejects_invalid_limit(self):
+        for limit in ("ten", [3], {"n": 3}):
+            with self.assertRaisesMessage(ValueError, "Invalid history limit."):
+                history_page(self.room, limit=limit)
+
+
+@no_background_delivery
+class ChatConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='socket@example.com', password='testpassword', username='socket')
+        self.room = Room.objects.create(name='Socket Room', slug='socket-room')
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/chat/{self.room.slug}/")
+        communicator.scope["user"] = self.user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        snapshot = await communicator.receive_json_from()
+        self.assertEqual(snapshot["type"], "presence")
+        return communicator
+
+    async def test_chat_messages_reach_the_other_members_inboxes(self):
+        others = [
+            await sync_to_async(User.objects.create_user)(email=f'member{i}@example.com', password='x', username=f'member{i}')
+            for i in range(2)
+        ]
+        await sync_to_async(self.room.users.add)(self.user, *others)
+        communicator = await self.connect()
+        await communicator.send_json_to({"message": "hello"})
+        await communicator.receive_json_from()
+        await message_buffer.flush()
+
+        recipients = await sync_to_async(list)(
+            InboxItem.objects.filter(notification__message="socket sent a message: hello").values_list('recipient', flat=True)
+        )
+        self.assertEqual(sorted(recipients), sorted(other.pk for other in others))
+        await communicator.disconnect()
+
+    async def test_broadcast_is_forwarded_as_encoded_by_sender(self):
+        communicator = await self.connect()
+        await communicator.send_json_to({"message": "hello", "client_id": "c1"})
+
+        # The ack and the broadcast race each other back to the socket.
+        frames = {await communicator.receive_from(), await communicator.receive_from()}
+        self.assertEqual(frames, {
+            json.dumps({"stream": "chat", "room": "socket-room", "message": "hello", "username": "socket"}),
+            json.dumps({"type": "ack", "client_id": "c1"}),
+        })
+
+        await message_buffer.flush()
+        await communicator.send_json_to({"type": "history", "limit": 10})
+        page = await communicator.receive_json_from()
+        self.assertEqual([m["message"] for m in page["messages"]], ["hello"])
+        await communicator.disconnect()
+
+    async def test_private_rooms_refuse_non_members(self):
+        self.room.is_private = True
+        await sync_to_async(self.room.save)()
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/chat/{self.room.slug}/")
+        communicator.scope["user"] = self.user
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+        await sync_to_async(self.room.users.add)(self.user)
+        communicator = await self.connect()
+        await communicator.disconnect()
+
+
+class StalledTransport(FileDescriptor):
+    """
+    Twisted's own write buffering, over a socket whose peer only reads when
+    told to.
+    """
+    connected = True
+    bufferSize = 1024
+    peer_reading = False
+
+    def __init__(self):
+        super().__init__(reactor=self)
+
+    def addWriter(self, writer):
+        pass
+
+    def removeWriter(self, writer):
+        pass
+
+    def writeSomeData(self, data):
+        return len(data) if self.peer_reading else 0
+
+
+class SendQueueTests(SimpleTestCase):
+    def make_queue(self, **kwargs):
+        self.written = []
+        self.closed_with = []
+        self.release = asyncio.Event()
+
+        async def write(text_data, bytes_data):
+            await self.release.wait()
+            self.written.append(text_data)
+
+        async def close(code):
+            self.closed_with.append(code)
+
+        return SendQueue(write, close, **kwargs)
+
+    async def test_drop_oldest_keeps_newest_frames(self):
+        queue = self.make_queue(max_size=3, policy="drop_oldest", disconnect_after=0)
+        queue.put("0")
+        # Let the writer take "0" and block on the socket.
+        await asyncio.sleep(0)
+        for i in range(1, 6):
+            queue.put(str(i))
+        self.release.set()
+        await asyncio.sleep(0.01)
+
+        self.assertEqual(self.written, ["0", "3", "4", "5"])
+        self.assertEqual(queue.stats(), {"depth": 0, "high_water": 3, "sent": 4, "dropped": 2, "coalesced": 0})
+        queue.stop()
+
+    async def test_coalesce_merges_waiting_presence_diffs(self):
+        queue = self.make_queue(max_size=10, policy="coalesce", merge=lambda key, old, new: merge_diffs(old, new))
+
+        def diff(joined=(), left=()):
+            return json.dumps({"type": "presence", "room": "r", "left": list(left),
+                               "joined": [{"id": user_id, "username": user_id} for user_id in joined]})
+
+        queue.put(diff(joined=["a", "b"]), coalesce="presence")
+        queue.put(diff(left=["a"], joined=["c"]), coalesce="presence")
+        queue.put(diff(left=["d"]), coalesce="presence")
+        self.release.set()
+        await asyncio.sleep(0.01)
+
+        self.assertEqual(queue.coalesced, 2)
+        self.assertEqual(len(self.written), 1)
+        frame = json.loads(self.written[0])
+        self.assertEqual([user["id"] for user in frame["joined"]], ["b", "c"])
+        self.assertEqual(frame["left"], ["d"])
+        queue.stop()
+
+    async def test_disconnect_policy_closes_slow_client(self):
+        queue = self.make_queue(max_size=2, policy="disconnect")
+        results = [queue.put(str(i)) for i in range(4)]
+        await asyncio.sleep(0.01)
+
+        self.assertEqual(results, [True, True, False, False])
+        self.assertEqual(self.closed_with, [SLOW_CONSUMER_CLOSE_CODE])
+        self.assertTrue(queue.closed)
+
+    async def test_twisted_transport_backpressure_fills_the_queue(self):
+        transport = StalledTransport()
+        producer = TransportProducer()
+        transport.registerProducer(producer, True)
+        self.closed_with = []
+
+        async def write(text_data, bytes_data):
+            # What daphne does: hand the frame to Twisted, which never blocks.
+            transport.write(text_data.encode())
+
+        async def close(code):
+            self.closed_with.append(code)
+
+        queue = SendQueue(write, close, max_size=5, policy="drop_oldest", disconnect_after=0, writable=producer.writable)
+        for i in range(20):
+            queue.put(str(i) * 400)
+            await asyncio.sleep(0)
+        # Twisted paused the producer once its buffer passed bufferSize, so
+        # the rest stayed in the queue and the oldest of them were dropped.
+        self.assertFalse(producer.writable.is_set())
+        self.assertEqual(len(queue.frames), 5)
+        self.assertGreater(queue.dropped, 0)
+
+        transport.peer_reading = True
+        while queue.frames:
+            transport.doWrite()
+            await asyncio.sleep(0)
+        self.assertTrue(producer.writable.is_set())
+        self.assertEqual(queue.sent + queue.dropped, 20)
+        queue.stop()
+
+    async def test_middleware_registers_with_the_daphne_transport(self):
+        protocol = WebSocketProtocol()
+        protocol.transport = StalledTransport()
+        scopes = []
+
+        async def app(scope, receive, send):
+            scopes.append(scope)
+
+        # How daphne's Server.create_application builds an application's send.
+        send = functools.partial(DaphneServer(app, endpoints=["tcp:port=0"]).handle_reply, protocol)
+        await BackpressureMiddleware(app)({"type": "websocket"}, None, send)
+        self.assertIs(protocol.transport.producer, scopes[0]["send_backpressure"])
+        # Anything other than daphne gets no producer.
+        await BackpressureMiddleware(app)({"type": "websocket"}, None, lambda message: None)
+        self.assertNotIn("send_backpressure", scopes[1])
+
+
+@no_background_delivery
+class LoadTestHarnessTests(TransactionTestCase):
+    async def test_in_process_chat_run_delivers_every_broadcast(self):
+        users, rooms = await sync_to_async(loadtest.create_fixtures)(6, 2)
+        results = await loadtest.run_in_process(users, rooms, messages=2, interval=0.01, timeout=5)
+
+        self.assertEqual(results["connect"]["connected"], 6)
+        # Two rooms of three clients: every message reaches all three.
+        self.assertEqual(results["broadcast"]["expected"], 36)
+        self.assertEqual(results["broadcast"]["delivered"], 36)
+        self.assertEqual(results["broadcast"]["latency"]["count"], 36)
+        self.assertEqual(json.loads(json.dumps(results)), results)
+
+    def test_delete_fixtures_only_removes_its_own_run(self):
+        bystander = User.objects.create_user(email='bystander@example.com', password='x', username='loadtest-1')
+        Room.objects.create(name='Theirs', slug='loadtest-0')
+        loadtest.create_fixtures(2, 1, run_id="other")
+        loadtest.create_fixtures(2, 1, run_id="mine")
+
+        loadtest.delete_fixtures("mine")
+
+        self.assertFalse(User.objects.filter(username__startswith="loadtest-mine-").exists())
+        self.assertEqual(User.objects.filter(username__startswith="loadtest-other-").count(), 2)
+        self.assertTrue(User.objects.filter(pk=bystander.pk).exists())
+        self.assertEqual(sorted(Room.objects.values_list('slug', flat=True)), ['loadtest-0', 'loadtest-other-0'])
+
+
+@no_background_delivery
+class NotificationConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='notify@example.com', password='testpassword', username='notify')
+        self.room = Room.objects.create(name='Notify Room', slug='notify-room')
+
+    async def connect(self, room_id=None):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f"/ws/notifications/{room_id or self.room.pk}/"
+        )
+        communicator.scope["user"] = self.user
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    async def test_task_event_is_broadcast_and_written(self):
+        communicator, connected = await self.connect()
+        self.assertTrue(connected)
+        await communicator.send_json_to({"type": "task", "task_title": "Ship it"})
+
+        notification = await communicator.receive_json_from()
+        self.assertEqual(notification["type"], "task")
+        self.assertEqual(notification["task_title"], "Ship it")
+        self.assertEqual(notification["creator_id"], str(self.user.pk))
+
+        await notification_events.flush()
+        task = await sync_to_async(Task.objects.get)(room=self.room)
+        self.assertEqual((task.title, task.created_by_id, task.assigned_to_id), ("Ship it", self.user.pk, self.user.pk))
+        await communicator.disconnect()
+
+    async def test_task_event_notifies_and_emails_the_assignee(self):
+        communicator, _ = await self.connect()
+        await communicator.send_json_to({"type": "task", "task_title": "Ship it"})
+        await communicator.receive_json_from()
+        await notification_events.flush()
+
+        task = await sync_to_async(Task.objects.get)(room=self.room)
+        message = "Task 'Ship it' assigned to you in room 'Notify Room'"
+        self.assertTrue(await sync_to_async(Notification.objects.filter(room=self.room, message=message).exists)())
+        emails = await sync_to_async(OutgoingEmail.objects.filter(to='notify@example.com').count)()
+        digests = await sync_to_async(EmailDigest.objects.filter(to='notify@example.com').count)()
+        self.assertEqual(emails + digests, 1)
+        self.assertIsNotNone(task.pk)
+        await communicator.disconnect()
+
+    async def test_branch_activity_is_kept_as_a_notification(self):
+        communicator, _ = await self.connect()
+        await communicator.send_json_to({"type": "branch_activity", "branch_name": "main", "activity": "merged"})
+        self.assertEqual((await communicator.receive_json_from())["branch_name"], "main")
+
+        await notification_events.flush()
+        notification = await sync_to_async(Notification.objects.get)(room=self.room)
+        self.assertEqual(notification.message, "merged branch main")
+        await communicator.disconnect()
+
+    async def test_invalid_frames_get_an_error(self):
+        communicator, _ = await self.connect()
+        await communicator.send_json_to({"type": "poll"})
+        self.assertEqual((await communicator.receive_json_from())["type"], "error")
+
+        # An authenticated socket cannot speak for someone else.
+        await communicator.send_json_to({"type": "message", "message": "hi", "sender_id": str(uuid.uuid4())})
+        error = await communicator.receive_json_from()
+        self.assertIn("sender_id", error["error_message"])
+
+        await communicator.send_json_to({"type": "file_upload"})
+        error = await communicator.receive_json_from()
+        self.assertIn("file_name", error["error_message"])
+        await communicator.disconnect()
+
+    async def test_unknown_room_is_refused(self):
+        _, connected = await self.connect(room_id=self.room.pk + 1000)
+        self.assertFalse(connected)
+
+    async def test_private_room_refuses_non_members(self):
+        self.room.is_private = True
+        await sync_to_async(self.room.save)()
+        _, connected = await self.connect()
+        self.assertFalse(connected)
+
+        await sync_to_async(self.room.users.add)(self.user)
+        communicator, connected = await self.connect()
+        self.assertTrue(connected)
+        await communicator.disconnect()
+
+    async def test_anonymous_socket_is_refused(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/notifications/{self.room.pk}/")
+        communicator.scope["user"] = AnonymousUser()
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+        # Nor can anyone get an event past validation without a user.
+        with self.assertRaises(ValidationError):
+            notification_events.get("message").validate({"message": "hi", "sender_id": str(self.user.pk)}, None)
+
+    async def test_failed_dashboard_refresh_is_logged(self):
+        event = TaskEvent()
+        persisted = asyncio.get_running_loop().create_future()
+        persisted.set_result(Task(assigned_to_id=self.user.pk))
+        data = {"task_title": "T", "description": "", "creator_id": self.user.pk}
+        with mock.patch("cowork.notifications.db_executor.run", side_effect=DatabaseError("down")):
+            with self.assertLogs("cowork.notifications", "ERROR"):
+                with mock.patch.object(WriteBehindBuffer, "add", return_value=persisted):
+                    await event.persist(self.room.pk, data, django_timezone.now())
+                self.assertEqual(len(event._refreshes), 1)
+                await asyncio.gather(*event._refreshes, return_exceptions=True)
+                await asyncio.sleep(0)
+        self.assertEqual(event._refreshes, set())
+
+
+@no_background_delivery
+class MultiplexConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='mux@example.com', password='testpassword', username='mux')
+        self.rooms = [Room.objects.create(name=f'Mux {i}', slug=f'mux-{i}') for i in range(2)]
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/")
+        communicator.scope["user"] = self.user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def subscribe(self, communicator, stream, room):
+        await communicator.send_json_to({"type": "subscribe", "stream": stream, "room": room})
+        self.assertEqual(await communicator.receive_json_from(), {"type": "subscribed", "stream": stream, "room": room})
+        if stream == "chat":
+            snapshot = await communicator.receive_json_from()
+            self.assertEqual((snapshot["type"], snapshot["room"]), ("presence", room))
+
+    async def test_one_socket_carries_several_rooms(self):
+        communicator = await self.connect()
+        await self.subscribe(communicator, "chat", "mux-0")
+        await self.subscribe(communicator, "chat", "mux-1")
+        await self.subscribe(communicator, "notifications", "mux-1")
+
+        await communicator.send_json_to({"stream": "chat", "room": "mux-1", "message": "hi"})
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame, {"stream": "chat", "room": "mux-1", "message": "hi", "username": "mux"})
+
+        await communicator.send_json_to({"stream": "notifications", "room": "mux-1", "type": "task", "task_title": "T"})
+        frame = await communicator.receive_json_from()
+        self.assertEqual((frame["stream"], frame["room"], frame["type"]), ("notifications", "mux-1", "task"))
+
+        await communicator.send_json_to({"type": "unsubscribe", "stream": "chat", "room": "mux-1"})
+        self.assertEqual((await communicator.receive_json_from())["type"], "unsubscribed")
+        await communicator.send_json_to({"stream": "chat", "room": "mux-1", "message": "gone"})
+        error = await communicator.receive_json_from()
+        self.assertEqual((error["type"], error["room"]), ("error", "mux-1"))
+
+        await communicator.disconnect()
+        await notification_events.flush()
+
+    async def test_unknown_room_and_anonymous_user(self):
+        communicator = await self.connect()
+        await communicator.send_json_to({"type": "subscribe", "stream": "chat", "room": "nowhere"})
+        self.assertEqual((await communicator.receive_json_from())["detail"], "Unknown room.")
+        await communicator.disconnect()
+
+        anonymous = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/")
+        anonymous.scope["user"] = AnonymousUser()
+        connected, _ = await anonymous.connect()
+        self.assertFalse(connected)
+
+    async def test_private_rooms_are_for_members_only(self):
+        private = await sync_to_async(Room.objects.create)(name='Secret', slug='secret', is_private=True)
+        communicator = await self.connect()
+        for stream in ("chat", "notifications"):
+            await communicator.send_json_to({"type": "subscribe", "stream": stream, "room": "secret"})
+            error = await communicator.receive_json_from()
+            self.assertEqual((error["type"], error["detail"]), ("error", "You do not have access to this room."))
+        await communicator.send_json_to({"stream": "chat", "room": "secret", "message": "hi"})
+        self.assertEqual((await communicator.receive_json_from())["detail"], "Not subscribed.")
+
+        await sync_to_async(private.users.add)(self.user)
+        await self.subscribe(communicator, "chat", "secret")
+        await communicator.disconnect()
+
+
+class RoomSerializerQueryTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='rooms@example.com', password='testpassword', username='rooms')
+        self.other = User.objects.create_user(email='other@example.com', password='testpassword', username='other')
+
+    def create_rooms(self, count, first=0):
+        slugs = [f'room-{i}' for i in range(first, first + count)]
+        Room.objects.bulk_create([Room(name=slug, slug=slug, created_by=self.user) for slug in slugs])
+        rooms = list(Room.objects.filter(slug__in=slugs))
+        Room.users.through.objects.bulk_create(
+            [Room.users.through(room=room, customuser=self.user) for room in rooms]
+            + [Room.users.through(room=room, customuser=self.other) for room in rooms]
+        )
+        return rooms
+
+    def user_data_queries(self):
+        # Rooms here are bulk created without signals; measure a cold build.
+        cache.clear()
+        self.client.force_authenticate(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('userdata'))
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_serializing_rooms_takes_a_fixed_number_of_queries(self):
+        self.create_rooms(1)
+        with self.assertNumQueries(3):
+            data = RoomSerializer(Room.objects.with_members(), many=True).data
+        self.assertEqual(data[0]['total_users'], 2)
+        self.assertEqual(sorted(data[0]['users']), ['other', 'rooms'])
+        self.assertEqual(data[0]['created_by'], 'rooms')
+
+        self.create_rooms(500, first=1)
+        with self.assertNumQueries(3):
+            data = RoomSerializer(Room.objects.with_members(), many=True).data
+        self.assertEqual(len(data), 501)
+
+    def test_user_data_queries_do_not_grow_with_rooms(self):
+        self.create_rooms(1)
+        response, one_room = self.user_data_queries()
+        # Counted over the whole room, not just the requesting user's join.
+        self.assertEqual(response.data['joined_rooms'][0]['total_users'], 2)
+
+        self.create_rooms(499, first=1)
+        response, many_rooms = self.user_data_queries()
+        self.assertEqual(len(response.data['joined_rooms']), 500)
+        self.assertEqual(many_rooms, one_room)
+
+
+@no_background_delivery
+class DashboardTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='dash@example.com', password='testpassword', username='dash')
+        self.other = User.objects.create_user(email='peer@example.com', password='testpassword', username='peer')
+        self.room = Room.objects.create(name='Dash', slug='dash', created_by=self.other)
+        self.room.users.add(self.user, self.other)
+        self.client.force_authenticate(self.user)
+
+    def get(self, fields=None):
+        response = self.client.get(reverse('userdata'), {'fields': fields} if fields else {})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_second_request_is_served_from_cache(self):
+        data = self.get()
+        self.assertEqual(list(data), ['user', 'joined_rooms', 'created_rooms', 'assigned_tasks'])
+        self.assertEqual([room['slug'] for room in data['user']['rooms']], ['dash'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get(), data)
+
+    def test_writes_refresh_only_what_they_touch(self):
+        self.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            joined = Room.objects.create(name='Second', slug='second')
+            joined.users.add(self.user)
+        self.assertEqual(sorted(room['slug'] for room in self.get('joined_rooms')['joined_rooms']), ['dash', 'second'])
+
+        # Another member joining changes the member list everyone sees.
+        newcomer = User.objects.create_user(email='new@example.com', password='testpassword', username='newcomer')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room.users.add(newcomer)
+        rooms = {room['slug']: room for room in self.get('joined_rooms')['joined_rooms']}
+        self.assertEqual(rooms['dash']['total_users'], 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Task.objects.create(
+                room=self.room, title='Review', description='', due_date=datetime(2030, 1, 1).date(),
+                assigned_to=self.user, created_by=self.other,
+            )
+        self.assertEqual([task['title'] for task in self.get('assigned_tasks')['assigned_tasks']], ['Review'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.room_set.remove(joined)
+        self.assertEqual([room['slug'] for room in self.get('joined_rooms')['joined_rooms']], ['dash'])
+
+    def test_sections_are_dropped_when_the_write_commits(self):
+        self.get()
+        key = dashboard.cache_key(self.user.pk, 'joined_rooms')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room.users.remove(self.other)
+            # A request made before the commit would see the old members.
+            self.assertIsNotNone(cache.get(key))
+        self.assertIsNone(cache.get(key))
+        rooms = self.get('joined_rooms')['joined_rooms']
+        self.assertEqual(rooms[0]['total_users'], 1)
+
+    def test_fields_selects_sections(self):
+        self.assertEqual(list(self.get('assigned_tasks,joined_rooms')), ['joined_rooms', 'assigned_tasks'])
+        response = self.client.get(reverse('userdata'), {'fields': 'rooms'})
+        self.assertEqual(response.status_code, 400)
+
+
+class SearchTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='finder@example.com', password='testpassword', username='finder')
+        self.outsider = User.objects.create_user(email='out@example.com', password='testpassword', username='out')
+        self.room = Room.objects.create(name='Rocket launch', slug='rocket', description='Planning the launch window')
+        self.room.users.add(self.user)
+        self.secret = Room.objects.create(name='Secret launch', slug='secret', is_private=True)
+        self.client.force_authenticate(self.user)
+
+    def get(self, **params):
+        response = self.client.get(reverse('search'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_indexes_on_save_and_drops_on_soft_delete(self):
+        task = Task.objects.create(
+            room=self.room, title='Fuel check', description='Check the launch fuel levels',
+            due_date=datetime(2030, 1, 1).date(), assigned_to=self.user, created_by=self.user,
+        )
+        File.objects.create(room=self.room, name='launch-checklist.pdf', path='room_files/launch-checklist.pdf', uploaded_by=self.user)
+        results = self.get(q='launch')['results']
+        self.assertEqual(sorted(result['type'] for result in results), ['file', 'room', 'task'])
+        self.assertTrue(all(result['room'] == 'rocket' for result in results))
+
+        task.delete()
+        self.assertEqual([result['type'] for result in self.get(q='fuel')['results']], [])
+        task.restore()
+        self.assertEqual([result['id'] for result in self.get(q='fuel')['results']], [task.pk])
+
+    def test_private_rooms_are_only_searchable_by_members(self):
+        self.assertEqual([result['room'] for result in self.get(q='launch', type='room')['results']], ['rocket'])
+        self.secret.users.add(self.user)
+        slugs = sorted(result['room'] for result in self.get(q='launch', type='room')['results'])
+        self.assertEqual(slugs, ['rocket', 'secret'])
+
+    def test_buffered_messages_are_indexed_and_paged(self):
+        messages = [Message(room=self.room, user=self.user, message=f"launch update {i}") for i in range(5)]
+        Message.objects.bulk_create(messages)
+        search.index_written(Message, messages)
+        self.assertEqual(SearchEntry.objects.filter(kind=SearchEntry.MESSAGE).count(), 5)
+
+        seen = []
+        page = self.get(q='update', type='message', limit=2)
+        while True:
+            seen.extend(result['id'] for result in page['results'])
+            if not page['next']:
+                break
+            page = self.get(q='update', type='message', limit=2, cursor=page['next'])
+        self.assertEqual(sorted(seen), sorted(Message.objects.values_list('pk', flat=True)))
+
+    def test_buffered_rows_without_keys_only_index_the_batch(self):
+        # Rows that were never indexed (here, written before the index
+        # existed) stay out of it; only the batch just written goes in.
+        Message.objects.bulk_create([Message(room=self.room, user=self.user, message=f"old {i}") for i in range(3)])
+        messages = [Message(room=self.room, user=self.user, message=f"new {i}") for i in range(2)]
+        with transaction.atomic():
+            Message.objects.bulk_create(messages)
+            search.index_written(Message, messages)
+        titles = SearchEntry.objects.filter(kind=SearchEntry.MESSAGE).values_list('title', flat=True)
+        self.assertEqual(sorted(titles), ['new 0', 'new 1'])
+
+    def test_title_matches_rank_first(self):
+        Task.objects.create(
+            room=self.room, title='Telemetry', description='Compare with the booster telemetry',
+            due_date=datetime(2030, 1, 1).date(), assigned_to=self.user, created_by=self.user,
+        )
+        Task.objects.create(
+            room=self.room, title='Booster', description='Inspect the booster',
+            due_date=datetime(2030, 1, 1).date(), assigned_to=self.user, created_by=self.user,
+        )
+        self.assertEqual([result['title'] for result in self.get(q='booster')['results']], ['Booster', 'Telemetry'])
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.get(reverse('search')).status_code, 400)
+        self.assertEqual(self.client.get(reverse('search'), {'q': 'launch', 'type': 'user'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('search'), {'q': 'launch', 'cursor': 'nope'}).status_code, 400)
+        self.client.force_authenticate(None)
+        self.assertIn(self.client.get(reverse('search'), {'q': 'launch'}).status_code, (401, 403))
+
+
+class RoomAutocompleteTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='typist@example.com', password='testpassword', username='typist')
+        self.others = [
+            User.objects.create_user(email=f'm{i}@example.com', password='testpassword', username=f'm{i}')
+            for i in range(3)
+        ]
+        self.design = Room.objects.create(name='Design review', slug='design-review')
+        self.desk = Room.objects.create(name='Help desk', slug='help-desk')
+        self.desk.users.add(*self.others)
+        Room.objects.create(name='Design secrets', slug='design-secrets', is_private=True)
+        room_autocomplete.reset()
+        self.client.force_authenticate(self.user)
+
+    def tearDown(self):
+        room_autocomplete.reset()
+
+    def slugs(self, q, **params):
+        response = self.client.get(reverse('room-autocomplete'), {'q': q, **params})
+        self.assertEqual(response.status_code, 200)
+        return [room['slug'] for room in response.data['results']]
+
+    def test_matches_word_prefixes_ranked_by_members(self):
+        self.assertEqual(self.slugs('des'), ['help-desk', 'design-review'])
+        self.assertEqual(self.slugs('desi'), ['design-review'])
+        self.assertEqual(self.slugs('design rev'), ['design-review'])
+        self.assertEqual(self.slugs('DES', limit=1), ['help-desk'])
+        self.assertEqual(self.slugs('esign'), [])
+        self.assertEqual(self.slugs(''), [])
+
+    def test_follows_saves_membership_and_soft_deletes(self):
+        self.assertEqual(self.slugs('des'), ['help-desk', 'design-review'])
+        self.design.users.add(self.user, *self.others)
+        self.assertEqual(self.slugs('des'), ['design-review', 'help-desk'])
+
+        self.design.name = 'Architecture review'
+        self.design.save()
+        self.assertEqual(self.slugs('arch'), ['design-review'])
+
+        self.desk.delete()
+        self.assertEqual(self.slugs('des'), ['design-review'])
+        self.desk.restore()
+        self.assertEqual(self.slugs('help'), ['help-desk'])
+
+        self.user.room_set.clear()
+        rooms = self.client.get(reverse('room-autocomplete'), {'q': 'review'}).data['results']
+        self.assertEqual(rooms[0]['members'], 3)
+
+    def test_build_picks_up_writes_without_signals(self):
+        index = RoomAutocomplete()
+        self.assertEqual([room['slug'] for room in index.lookup('help')], ['help-desk'])
+        Room.objects.filter(pk=self.desk.pk).update(name='Support', slug='support')
+        self.assertEqual(index.lookup('supp'), [])
+        index.build()
+        self.assertEqual([room['slug'] for room in index.lookup('supp')], ['support'])
+
+    def test_first_lookups_share_one_build(self):
+        index = RoomAutocomplete()
+        started, release = threading.Event(), threading.Event()
+        rows = [(self.desk.pk, self.desk.name, self.desk.slug, 3)]
+
+        def slow_build():
+            # Loads fixed rows: the test's own rows are not visible to the
+            # threads' database connections.
+            started.set()
+            release.wait(5)
+            index.load(rows)
+
+        with mock.patch.object(index, 'build', side_effect=slow_build) as patched:
+            first = threading.Thread(target=index.ensure_built)
+            first.start()
+            started.wait(5)
+            second = threading.Thread(target=index.ensure_built)
+            second.start()
+            release.set()
+            first.join(5)
+            second.join(5)
+        self.assertEqual(patched.call_count, 1)
+        self.assertEqual([room['slug'] for room in index.lookup('help')], ['help-desk'])
+
+    def test_changes_during_a_build_outlive_its_snapshot(self):
+        index = RoomAutocomplete()
+        load = index.load
+
+        def load_late(rows):
+            # The room is renamed after the build read it.
+            self.desk.name = 'Support'
+            self.desk.slug = 'support'
+            index.update(self.desk)
+            index.remove(self.design.pk)
+            load(rows)
+
+        with mock.patch.object(index, 'load', side_effect=load_late):
+            index.build()
+        self.assertEqual([room['slug'] for room in index.lookup('supp')], ['support'])
+        self.assertEqual(index.lookup('help'), [])
+        self.assertEqual(index.lookup('design'), [])
+        rooms = index.lookup('supp')
+        self.assertEqual(rooms[0]['members'], 3)
+
+
+@override_settings(NOTIFICATION_FANOUT={**settings.NOTIFICATION_FANOUT, "CHUNK_SIZE": 1000, "BACKGROUND": False})
+class NotificationInboxTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='reader@example.com', password='testpassword', username='reader')
+        self.other = User.objects.create_user(email='writer@example.com', password='testpassword', username='writer')
+        self.room = Room.objects.create(name='Inbox', slug='inbox')
+        self.room.users.add(self.user, self.other)
+        for i in range(5):
+            Notification.objects.create(room=self.room, sender=self.other, message=f"event {i}")
+        deliver_pending()
+        self.items = list(InboxItem.objects.filter(recipient=self.user).order_by('id'))
+        self.client.force_authenticate(self.user)
+
+    def unread(self):
+        response = self.client.get(reverse('notification-unread-count'))
+        self.assertEqual(response.status_code, 200)
+        return response.data['unread']
+
+    def test_delivers_to_every_member_but_the_sender(self):
+        self.assertEqual(len(self.items), 5)
+        self.assertFalse(InboxItem.objects.filter(recipient=self.other).exists())
+        self.assertFalse(Notification.objects.filter(delivered_at__isnull=True).exists())
+
+        members = [
+            User.objects.create_user(email=f'fan{i}@example.com', password='testpassword', username=f'fan{i}')
+            for i in range(5)
+        ]
+        self.room.users.add(*members)
+        self.assertEqual(inbox.recount([members[0].pk]), {members[0].pk: 0})
+        with self.captureOnCommitCallbacks() as callbacks:
+            Message.objects.create(room=self.room, user=self.other, message="hello everyone")
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(InboxItem.objects.count(), 5)
+
+        deliver_pending(chunk_size=2)
+        self.assertEqual(InboxItem.objects.count(), 5 + 6)
+        self.assertEqual(UnreadCounter.objects.get(user=members[0]).unread, 1)
+        item = InboxItem.objects.get(recipient=members[0])
+        self.assertEqual(item.notification.message, "writer sent a message: hello everyone")
+
+    def test_delivery_is_claimed_and_counts_only_new_items(self):
+        self.assertEqual(self.unread(), 5)
+        late = User.objects.create_user(email='late@example.com', password='testpassword', username='late')
+        self.room.users.add(late)
+        UnreadCounter.objects.create(user=late, unread=0)
+        notification = Notification.objects.create(room=self.room, sender=self.other, message="event 5")
+
+        # Taken by a delivery still running elsewhere.
+        Notification.objects.filter(pk=notification.pk).update(delivery_claimed_at=django_timezone.now())
+        self.assertIsNone(deliver(notification))
+        self.assertEqual(deliver_pending(), 0)
+
+        # One item written before the other delivery stopped, and counted.
+        InboxItem.objects.create(recipient=self.user, notification=notification, timestamp=notification.timestamp)
+        UnreadCounter.objects.filter(user=self.user).update(unread=6)
+        Notification.objects.filter(pk=notification.pk).update(
+            delivery_claimed_at=django_timezone.now() - timedelta(hours=1)
+        )
+        self.assertEqual(deliver(notification), 2)
+        self.assertIsNone(deliver(notification))
+        self.assertEqual(UnreadCounter.objects.get(user=self.user).unread, 6)
+        self.assertEqual(UnreadCounter.objects.get(user=late).unread, 1)
+        notification.refresh_from_db()
+        self.assertEqual((notification.delivery_attempts, notification.delivery_claimed_at), (1, None))
+
+    def test_failing_notification_does_not_block_the_rest(self):
+        broken = Notification.objects.create(room=self.room, sender=self.other, message="broken")
+        fine = Notification.objects.create(room=self.room, sender=self.other, message="fine")
+
+        def fail_broken(notification, recipients):
+            if notification.pk == broken.pk:
+                raise DatabaseError("boom")
+            deliver_chunk(notification, recipients)
+
+        with mock.patch("cowork.fanout.deliver_chunk", side_effect=fail_broken):
+            with self.assertLogs("cowork.fanout", "ERROR"):
+                self.assertEqual(deliver_pending(), 1)
+            self.assertTrue(InboxItem.objects.filter(notification=fine).exists())
+            for _ in range(settings.NOTIFICATION_FANOUT["MAX_ATTEMPTS"] - 1):
+                with self.assertLogs("cowork.fanout", "ERROR"):
+                    deliver_pending()
+            # Out of attempts: left alone from now on.
+            self.assertEqual(deliver_pending(), 0)
+        broken.refresh_from_db()
+        self.assertIsNone(broken.delivered_at)
+        self.assertEqual(broken.delivery_attempts, settings.NOTIFICATION_FANOUT["MAX_ATTEMPTS"])
+
+    def test_counter_follows_writes(self):
+        self.assertEqual(self.unread(), 5)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.unread(), 5)
+
+        response = self.client.patch(reverse('mark-notification-as-read', args=[self.items[0].pk]))
+        self.assertEqual(response.status_code, 200)
+        self.items[1].delete()
+        Notification.objects.create(room=self.room, sender=self.other, message="event 5")
+        buffered = [Notification(room=self.room, sender=self.other, message="buffered")]
+        with self.captureOnCommitCallbacks(execute=True):
+            Notification.objects.bulk_create(buffered)
+            rows_written(Notification, buffered)
+        deliver_pending()
+        self.assertEqual(UnreadCounter.objects.get(user=self.user).unread, 5)
+        self.assertEqual(self.unread(), inbox.notifications_for(self.user).filter(is_read=False).count())
+
+        # Joining a room does not deliver what was sent before; soft-deleting
+        # one hides its notifications.
+        other_room = Room.objects.create(name='Elsewhere', slug='elsewhere')
+        Notification.objects.create(room=other_room, sender=self.other, message="elsewhere")
+        deliver_pending()
+        other_room.users.add(self.user)
+        self.assertEqual(self.unread(), 5)
+        self.room.delete()
+        self.assertEqual(self.unread(), 0)
+
+    def test_only_soft_deletes_and_restores_forget_room_counters(self):
+        self.assertEqual(self.unread(), 5)
+        with mock.patch("cowork.signals.inbox.forget") as forget:
+            self.room.name = 'Renamed'
+            self.room.save()
+            Room.objects.get(pk=self.room.pk).save()
+            forget.assert_not_called()
+            self.room.delete()
+            self.room.restore()
+            self.assertEqual(forget.call_count, 2)
+
+    def test_pages_by_timestamp_and_id(self):
+        InboxItem.objects.update(timestamp=self.items[0].timestamp)
+        seen = []
+        params = {'limit': 2}
+        while True:
+            response = self.client.get(reverse('notification-list'), params)
+            self.assertEqual(response.status_code, 200)
+            seen.extend(item['id'] for item in response.data['results'])
+            if not response.data['next']:
+                break
+            params['before'] = response.data['next']
+        self.assertEqual(seen, sorted((item.pk for item in self.items), reverse=True))
+        self.assertEqual(response.data['results'][-1]['message'], 'event 0')
+
+        response = self.client.get(reverse('notification-list'), {'before': 'nope'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_actions_are_one_update_each(self):
+        self.unread()
+        for item, minutes in zip(self.items, range(5)):
+            item.timestamp = django_timezone.now() - timedelta(minutes=10 - minutes)
+        InboxItem.objects.bulk_update(self.items, ['timestamp'])
+
+        url = reverse('notifications-mark-read')
+        response = self.client.post(url, {'ids': [self.items[0].pk, self.items[1].pk]}, format='json')
+        self.assertEqual(response.data, {'updated': 2, 'unread': 3})
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, {'up_to': self.items[3].timestamp.isoformat()}, format='json')
+        self.assertEqual(response.data, {'updated': 2, 'unread': 1})
+        self.assertEqual(sum(query['sql'].startswith('UPDATE "cowork_inboxitem"') for query in queries), 1)
+
+        response = self.client.post(reverse('notifications-dismiss'), {}, format='json')
+        self.assertEqual(response.data, {'updated': 5, 'unread': 0})
+        self.assertFalse(inbox.notifications_for(self.user).exists())
+        self.assertEqual(inbox.recount([self.user.pk]), {self.user.pk: 0})
+
+        response = self.client.post(url, {'ids': [1], 'up_to': django_timezone.now().isoformat()}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='assignee@example.com', password='testpassword', username='assignee')
+        self.room = Room.objects.create(name='Mail', slug='mail')
+
+    def test_task_email_is_queued_and_sent_after_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            Task.objects.create(
+                room=self.room, title='Review', description='', due_date=datetime(2030, 1, 1).date(),
+                assigned_to=self.user, created_by=self.user,
+            )
+        self.assertEqual(mail.outbox, [])
+        email = OutgoingEmail.objects.get()
+        self.assertEqual((email.to, email.subject), ('assignee@example.com', 'New Task Assignment'))
+        self.assertIn(outbox.outbox.schedule, callbacks)
+
+        self.assertEqual(outbox.send_pending(), 1)
+        self.assertEqual([message.to for message in mail.outbox], [['assignee@example.com']])
+        email.refresh_from_db()
+        self.assertIsNotNone(email.sent_at)
+        self.assertEqual(outbox.send_pending(), 0)
+
+    @override_settings(
+        EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend', EMAIL_HOST='127.0.0.1',
+        EMAIL_USE_TLS=False, EMAIL_TIMEOUT=1,
+    )
+    def test_failures_back_off_then_give_up(self):
+        with self.settings(EMAIL_PORT=free_port(), EMAIL_OUTBOX={**settings.EMAIL_OUTBOX, "MAX_ATTEMPTS": 3}):
+            outbox.enqueue('Hi', 'Body', ['someone@example.com'])
+            self.assertEqual(outbox.send_pending(), 0)
+            email = OutgoingEmail.objects.get()
+            self.assertEqual(email.attempts, 1)
+            self.assertIn('ConnectionRefusedError', email.last_error)
+            self.assertGreater(email.next_attempt_at, django_timezone.now() + timedelta(seconds=25))
+            # Not due yet.
+            self.assertEqual(outbox.send_pending(), 0)
+            self.assertEqual(OutgoingEmail.objects.get().attempts, 1)
+
+            for attempts in (2, 3):
+                OutgoingEmail.objects.update(next_attempt_at=django_timezone.now())
+                outbox.send_pending()
+            email = OutgoingEmail.objects.get()
+            self.assertEqual(email.attempts, 3)
+            self.assertIsNotNone(email.failed_at)
+            self.assertIsNone(outbox.next_attempt())
+
+    def smtp_server(self, refuse=()):
+        class Handler:
+            def __init__(self):
+                self.sessions = []
+                self.recipients = []
+
+            async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+                if address in refuse:
+                    return '550 No such user'
+                envelope.rcpt_tos.append(address)
+                return '250 OK'
+
+            async def handle_DATA(self, server, session, envelope):
+                self.sessions.append(session)
+                self.recipients.extend(envelope.rcpt_tos)
+                return '250 OK'
+
+        handler = Handler()
+        port = free_port()
+        controller = Controller(handler, hostname='127.0.0.1', port=port)
+        controller.start()
+        self.addCleanup(controller.stop)
+        smtp_settings = self.settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend', EMAIL_HOST='127.0.0.1',
+            EMAIL_PORT=port, EMAIL_USE_TLS=False, EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='',
+        )
+        smtp_settings.enable()
+        self.addCleanup(smtp_settings.disable)
+        return handler
+
+    def test_sends_batches_over_one_smtp_session(self):
+        handler = self.smtp_server()
+        outbox.enqueue('Hi', 'Body', [f'user{i}@example.com' for i in range(5)])
+        self.assertEqual(outbox.send_pending(batch_size=2), 5)
+        self.assertEqual(sorted(handler.recipients), [f'user{i}@example.com' for i in range(5)])
+        self.assertEqual(len({id(session) for session in handler.sessions}), 1)
+
+    def test_reconnects_once_after_a_failure(self):
+        handler = self.smtp_server(refuse={'user1@example.com'})
+        outbox.enqueue('Hi', 'Body', [f'user{i}@example.com' for i in range(5)])
+        self.assertEqual(outbox.send_pending(batch_size=5), 4)
+        self.assertEqual(OutgoingEmail.objects.get(to='user1@example.com').attempts, 1)
+        # One session before the refusal, one reused by everything after it.
+        self.assertEqual(len({id(session) for session in handler.sessions}), 2)
+
+
+@override_settings(EMAIL_DIGEST={"ENABLED": True, "WINDOW": 60})
+class EmailDigestTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='assignee@example.com', password='testpassword', username='assignee')
+        self.room = Room.objects.create(name='Busy', slug='busy')
+
+    def create_task(self, title):
+        return Task.objects.create(
+            room=self.room, title=title, description='', due_date=datetime(2030, 1, 1).date(),
+            assigned_to=self.user, created_by=self.user,
+        )
+
+    def test_one_email_per_recipient_per_window(self):
+        task = self.create_task('Review')
+        for i in range(3):
+            Comment.objects.create(task=task, user=self.user, text=f"comment {i}")
+        self.create_task('Ship')
+        self.assertEqual(OutgoingEmail.objects.count(), 0)
+        digest = EmailDigest.objects.get()
+        self.assertEqual([entry['count'] for entry in digest.entries], [1, 3, 1])
+
+        self.assertEqual(outbox.send_pending(), 0)
+        EmailDigest.objects.update(send_after=django_timezone.now())
+        self.assertEqual(outbox.send_pending(), 1)
+        self.assertFalse(EmailDigest.objects.exists())
+        [email] = mail.outbox
+        self.assertEqual(email.subject, '5 new notifications')
+        self.assertEqual(email.to, ['assignee@example.com'])
+        self.assertIn("- 3 new comments added to task 'Review' in room 'Busy'\n", email.body)
+        self.assertIn("- Task 'Ship' assigned to you in room 'Busy'", email.body)
+
+    def test_lone_notification_reads_like_a_plain_email(self):
+        self.create_task('Review')
+        EmailDigest.objects.update(send_after=django_timezone.now())
+        outbox.send_pending()
+        self.assertEqual(mail.outbox[0].subject, 'New Task Assignment')
+        self.assertTrue(mail.outbox[0].body.startswith("Hello,\n\nTask 'Review' assigned to you"))
+
+
+class APIKeyAuthenticationTests(APITestCase):
+    def setUp(self):
+        key_cache.clear()
+        self.user = User.objects.create_user(email='keyholder@example.com', password='testpassword', username='keyholder')
+        self.client.force_authenticate(self.user)
+        self.key = self.client.post(reverse('generate_api_key')).data['api_key']
+        self.client.force_authenticate(None)
+
+    def get(self, **kwargs):
+        return self.client.get(reverse('protected'), **kwargs)
+
+    def test_keys_are_stored_hashed(self):
+        api_key = APIKey.objects.get()
+        self.assertEqual(api_key.prefix, self.key[:8])
+        self.assertEqual(api_key.hashed_key, APIKey.hash_key(self.key))
+        self.assertNotIn(self.key, str(APIKey.objects.values().get()))
+
+    def test_cached_after_first_use_and_dropped_on_delete(self):
+        with self.assertLogs('cowork.authentication', 'INFO') as logs:
+            self.assertEqual(self.get(HTTP_AUTHORIZATION=f'Api-Key {self.key}').status_code, 200)
+        self.assertNotIn(self.key, "\n".join(logs.output))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(reverse('protected'), {'api_key': self.key}).status_code, 200)
+
+        self.assertNotEqual(self.get(HTTP_AUTHORIZATION=f'Api-Key {self.key[:-1]}x').status_code, 200)
+        APIKey.objects.get().delete()
+        self.assertNotEqual(self.get(HTTP_AUTHORIZATION=f'Api-Key {self.key}').status_code, 200)
+
+    def test_inactive_users_are_refused(self):
+        self.assertEqual(self.get(HTTP_AUTHORIZATION=f'Api-Key {self.key}').status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.get(HTTP_AUTHORIZATION=f'Api-Key {self.key}').status_code, 403)
+
+    def test_body_is_not_read(self):
+        response = self.client.post(reverse('protected'), {'api_key': self.key}, format='multipart')
+        self.assertEqual(response.status_code, 403)
+
+
+@override_settings(METRICS={"TOKEN": "scrape", "BUCKETS": (0.1, 1)})
+class MetricsTests(APITestCase):
+    def setUp(self):
+        metrics.registry.reset()
+        self.user = User.objects.create_user(email='watched@example.com', password='testpassword', username='watched')
+        self.client.force_authenticate(self.user)
+
+    def scrape(self, **headers):
+        return self.client.get(reverse('metrics'), **headers)
+
+    def test_requests_are_recorded_per_url_name(self):
+        self.client.get(reverse('notification-list'))
+        response = self.scrape(HTTP_AUTHORIZATION='Bearer scrape')
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('# TYPE coloby_http_request_duration_seconds histogram', text)
+        self.assertIn('coloby_http_request_duration_seconds_count{view="notification-list",method="GET"} 1', text)
+        self.assertIn('coloby_http_requests_total{view="notification-list",method="GET",status="200"} 1', text)
+        samples = dict(line.rsplit(' ', 1) for line in text.splitlines() if not line.startswith('#'))
+        self.assertGreater(float(samples['coloby_http_db_queries_total{view="notification-list"}']), 0)
+        self.assertGreater(float(samples['coloby_http_serializer_seconds_total{view="notification-list"}']), 0)
+        self.assertGreater(float(samples['coloby_http_response_bytes_total{view="notification-list"}']), 0)
+        self.assertIn('coloby_send_queue_connections', samples)
+        self.assertIn('coloby_db_executor_active', samples)
+
+    def test_scrapes_need_the_token(self):
+        self.assertEqual(self.scrape().status_code, 403)
+        with self.settings(METRICS={"TOKEN": "", "BUCKETS": (0.1, 1)}):
+            self.assertEqual(self.scrape(HTTP_AUTHORIZATION='Bearer ').status_code, 404)
+
+    def test_histogram_buckets_are_cumulative(self):
+        for value in (0.05, 0.5, 0.7, 3):
+            metrics.registry.observe('coloby_websocket_receive_duration_seconds', (('consumer', 'ChatConsumer'),), value)
+        text = metrics.render()
+        self.assertIn('coloby_websocket_receive_duration_seconds_bucket{consumer="ChatConsumer",le="0.1"} 1', text)
+        self.assertIn('coloby_websocket_receive_duration_seconds_bucket{consumer="ChatConsumer",le="1.0"} 3', text)
+        self.assertIn('coloby_websocket_receive_duration_seconds_bucket{consumer="ChatConsumer",le="+Inf"} 4', text)
+
+
+class SoftDeletionTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='tidy@example.com', password='testpassword', username='tidy')
+        self.room = Room.objects.create(name='Orbit', slug='orbit')
+        self.tasks = [
+            Task.objects.create(
+                room=self.room, title=f'Burn {i}', description='Plan the orbit burn',
+                due_date=datetime(2030, 1, 1).date(), assigned_to=self.user, created_by=self.user,
+            )
+            for i in range(3)
+        ]
+
+    def test_queryset_delete_is_one_update_and_drops_search_entries(self):
+        with CaptureQueriesContext(connection) as queries:
+            count, _ = Task.objects.filter(room=self.room).delete()
+        self.assertEqual(count, 3)
+        self.assertEqual(sum(query['sql'].startswith('UPDATE') for query in queries.captured_queries), 1)
+        self.assertFalse(Task.objects.exists())
+        self.assertEqual(Task.objects.with_deleted().count(), 3)
+        self.assertFalse(SearchEntry.objects.filter(kind='task').exists())
+
+    def test_restore_brings_rows_back(self):
+        Task.objects.filter(room=self.room).delete()
+        self.assertEqual(Task.objects.with_deleted().filter(room=self.room).restore(), 3)
+        self.assertEqual(Task.objects.count(), 3)
+        self.assertEqual(SearchEntry.objects.filter(kind='task').count(), 3)
+
+    def test_purge_removes_old_rows_children_first(self):
+        old = django_timezone.now() - timedelta(days=40)
+        Task.objects.filter(pk=self.tasks[0].pk).update(deleted_at=old)
+        Task.objects.filter(pk=self.tasks[1].pk).update(deleted_at=django_timezone.now())
+        other = Room.objects.create(name='Empty', slug='empty')
+        Room.objects.filter(pk__in=[self.room.pk, other.pk]).update(deleted_at=old)
+
+        out = StringIO()
+        call_command('purge_soft_deleted', '--days=30', '--chunk-size=1', stdout=out)
+        self.assertEqual(list(Task.objects.with_deleted().order_by('pk')), self.tasks[1:])
+        # The room still has tasks, which RESTRICT keeps it from losing.
+        self.assertEqual(list(Room.objects.with_deleted()), [self.room])
+        self.assertIn('Room: 1 rows purged, 1 kept', out.getvalue())
+
+
+class MessageArchiveTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp(prefix="archive")
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        archive.archive_cache.clear()
+        self.user = User.objects.create_user(email='archivist@example.com', password='testpassword', username='archivist')
+        self.room = Room.objects.create(name='Archive Room', slug='archive-room')
+        # Two messages in each of two old months, then two recent ones.
+        for i, created_at in enumerate([
+            datetime(2020, 1, 10, tzinfo=timezone.utc), datetime(2020, 1, 20, tzinfo=timezone.utc),
+            datetime(2020, 2, 10, tzinfo=timezone.utc), datetime(2020, 2, 20, tzinfo=timezone.utc),
+            django_timezone.now() - timedelta(hours=2), django_timezone.now() - timedelta(hours=1),
+        ]):
+            message = Message.objects.create(room=self.room, user=self.user, message=str(i))
+            Message.objects.filter(pk=message.pk).update(created_at=created_at)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def walk(self, limit):
+        seen, cursor = [], None
+        while True:
+            page = history_page(self.room, before=cursor, limit=limit)
+            seen.extend(m["message"] for m in page["messages"])
+            cursor = page["next"]
+            if cursor is None:
+                return seen
+
+    def test_old_months_move_to_files_and_still_page(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(archive.archive(django_timezone.now() - timedelta(days=30)), (4, 2))
+        self.assertEqual(Message.objects.with_deleted().count(), 2)
+        self.assertFalse(SearchEntry.objects.filter(kind='message', title__in=['0', '1', '2', '3']).exists())
+        archives = list(MessageArchive.objects.order_by('month'))
+        self.assertEqual([(a.month.month, a.message_count) for a in archives], [(1, 2), (2, 2)])
+        self.assertTrue(all(os.path.exists(a.file.path) for a in archives))
+        self.assertEqual(self.walk(limit=3), ['5', '4', '3', '2', '1', '0'])
+        self.assertEqual(self.walk(limit=1), ['5', '4', '3', '2', '1', '0'])
+
+    def test_rearchiving_a_month_merges_it(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            archive.archive(django_timezone.now() - timedelta(days=30))
+        first_path = MessageArchive.objects.get(month__month=1).file.path
+        late = Message.objects.create(room=self.room, user=self.user, message='late')
+        Message.objects.filter(pk=late.pk).update(created_at=datetime(2020, 1, 15, tzinfo=timezone.utc))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(archive.archive(django_timezone.now() - timedelta(days=30)), (1, 1))
+        january = MessageArchive.objects.get(month__month=1)
+        self.assertEqual(january.message_count, 3)
+        self.assertFalse(os.path.exists(first_path))
+        self.assertEqual(self.walk(limit=2), ['5', '4', '3', '2', '1', 'late', '0'])
+
+        path = january.file.path
+        # A delete that rolls back keeps the file.
+        with self.assertRaises(DatabaseError):
+            with transaction.atomic():
+                MessageArchive.objects.filter(pk=january.pk).delete()
+                raise DatabaseError("rolled back")
+        self.assertTrue(os.path.exists(path))
+        with self.captureOnCommitCallbacks(execute=True):
+            january.delete()
+        self.assertFalse(os.path.exists(path))
+
+    def test_messages_older_than_the_archive_stay_deleted(self):
+        old = Message.objects.create(room=self.room, user=self.user, message='old')
+        Message.objects.filter(pk=old.pk).update(created_at=datetime(2019, 12, 1, tzinfo=timezone.utc))
+        recent = Message.objects.filter(message='5').get()
+        Message.objects.filter(pk__in=[old.pk, recent.pk]).delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            archive.archive(django_timezone.now() - timedelta(days=30))
+
+        self.assertEqual(Message.objects.with_deleted().filter(deleted_at__isnull=False).restore(), 1)
+        self.assertTrue(Message.objects.filter(pk=recent.pk).exists())
+        old = Message.objects.with_deleted().get(pk=old.pk)
+        with self.assertRaises(ValueError):
+            old.restore()
+        self.assertIsNotNone(Message.objects.with_deleted().get(pk=old.pk).deleted_at)
+        self.assertEqual(self.walk(limit=2), ['5', '4', '3', '2', '1', '0'])
+
+
+class ReplicaHealthTests(TestCase):
+    class FakeLagHealth(ReplicaHealth):
+        lags = {}
+
+        def lag(self, alias):
+            if self.lags[alias] is None:
+                raise DatabaseError("connection refused")
+            return self.lags[alias]
+
+    @override_settings(REPLICAS={"ALIASES": ["fast", "slow", "down"], "STICKY_SECONDS": 5, "MAX_LAG": 10, "CHECK_INTERVAL": 60})
+    def test_lagging_and_unreachable_replicas_are_dropped(self):
+        health = self.FakeLagHealth()
+        health.lags = {"fast": 0.5, "slow": 30, "down": None}
+        with self.assertLogs('cowork.replicas', 'WARNING') as logs:
+            health.healthy()
+            health.wait()
+            self.assertEqual(health.healthy(), ["fast"])
+        self.assertEqual(len(logs.output), 2)
+        self.assertEqual(health.stats(), {"configured": 3, "healthy": 1})
+
+        # Not checked again until CHECK_INTERVAL has passed.
+        health.lags = {"fast": 0.5, "slow": 1, "down": 1}
+        self.assertEqual(health.healthy(), ["fast"])
+        with self.settings(REPLICAS={"ALIASES": ["fast", "slow", "down"], "STICKY_SECONDS": 5, "MAX_LAG": 10, "CHECK_INTERVAL": 0}):
+            health.healthy()
+            health.wait()
+        self.assertEqual(health.healthy(), ["fast", "slow", "down"])
+
+    @override_settings(REPLICAS={"ALIASES": ["stuck"], "STICKY_SECONDS": 5, "MAX_LAG": 10, "CHECK_INTERVAL": 60})
+    def test_requests_do_not_wait_for_a_check(self):
+        release = threading.Event()
+
+        class StuckHealth(ReplicaHealth):
+            def lag(self, alias):
+                release.wait(5)
+                return 0
+
+        health = StuckHealth()
+        started = time.monotonic()
+        self.assertEqual(health.healthy(), [])
+        self.assertEqual(health.healthy(), [])
+        self.assertLess(time.monotonic() - started, 1)
+        release.set()
+        health.wait()
+        self.assertEqual(health.healthy(), ["stuck"])
+
+
+# coloby/test_settings.py configures a replica mirrored onto the test database.
+@unittest.skipUnless(settings.REPLICAS["ALIASES"], "No read replica configured.")
+@no_background_delivery
+class ReplicaRoutingTests(APITransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        replica_health.reset()
+        replica_health.check()
+        cache.clear()
+        self.replica = connections[settings.REPLICAS["ALIASES"][0]]
+        self.user = User.objects.create_user(email='reader@example.com', password='testpassword', username='reader')
+        self.room = Room.objects.create(name='Replica Room', slug='replica-room')
+        self.room.users.add(self.user)
+        self.task = Task.objects.create(
+            room=self.room, title='Read me', description='From a replica',
+            due_date=datetime(2030, 1, 1).date(), assigned_to=self.user, created_by=self.user,
+        )
+        self.client.force_authenticate(self.user)
+
+    def replica_queries(self, method, url):
+        with CaptureQueriesContext(self.replica) as queries:
+            response = getattr(self.client, method)(url)
+        self.assertLess(response.status_code, 300)
+        return [query['sql'] for query in queries.captured_queries if query['sql'] != 'SELECT 0']
+
+    def test_safe_requests_read_from_a_replica(self):
+        self.assertTrue(self.replica_queries('get', reverse('task-list', args=['replica-room'])))
+        self.assertTrue(self.replica_queries('get', reverse('search') + '?q=read'))
+        # Views that are not marked stay on the primary.
+        self.assertFalse(self.replica_queries('get', reverse('notification-unread-count')))
+
+    def test_writers_stay_on_the_primary_for_a_while(self):
+        other = Task.objects.create(
+            room=self.room, title='Delete me', description='Soon gone',
+            due_date=datetime(2030, 1, 1).date(), assigned_to=self.user, created_by=self.user,
+        )
+        response = self.client.delete(reverse('task-detail', args=['replica-room', other.pk]))
+        self.assertIn(PIN_COOKIE, response.cookies)
+        self.assertFalse(self.replica_queries('get', reverse('task-list', args=['replica-room'])))
+
+        # The pin is kept for the user as well as in the cookie.
+        self.client.cookies.pop(PIN_COOKIE)
+        self.assertFalse(self.replica_queries('get', reverse('task-list', args=['replica-room'])))
+        cache.clear()
+        self.assertTrue(self.replica_queries('get', reverse('task-list', args=['replica-room'])))
@@ -1,6 +1,6 @@
 from django.urls import path
 from django.views.generic import TemplateView
-from cowork import views
+from cowork import inbox, views
 # from .views import (
 #     UploadFileView,
 #     SwitchBranchView,
@@ -37,15 +37,20 @@ urlpatterns = [
 
     # Search 
     path('search/', views.SearchAPIView.as_view(), name='search'),
+    path('rooms/autocomplete/', views.RoomAutocompleteView.as_view(), name='room-autocomplete'),
 
     path('userdata', views.user_data, name='userdata'),
 
     #  path('send-email/', views.send_email_view, name='send_email'),
     path('protected/', views.ProtectedAPIView.as_view(), name='protected'),
     path('generate-api-key/', views.GenerateAPIKeyView.as_view(), name='generate_api_key'),
+    path('metrics/', views.metrics_view, name='metrics'),
 
 
     path('notifications/', views.NotificationList.as_view(), name='notification-list'),
+    path('notifications/unread-count/', views.UnreadNotificationCount.as_view(), name='notification-unread-count'),
+    path('notifications/mark-read/', views.BulkNotificationAction.as_view(change=inbox.mark_read), name='notifications-mark-read'),
+    path('notifications/dismiss/', views.BulkNotificationAction.as_view(change=inbox.dismiss), name='notifications-dismiss'),
     path('notifications/<int:pk>/', views.NotificationDetail.as_view(), name='notification-detail'),
     path('notifications/<int:pk>/mark-as-read/', views.MarkNotificationAsRead.as_view(), name='mark-notification-as-read'),
 
@@ -18,8 +18,7 @@ from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.renderers import JSONRenderer
 from rest_framework.views import APIView
 from rest_framework.exceptions import NotFound
-from django.core.paginator import Paginator
-from django.db.models import Q
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from serializers.serializers import (
     TaskSerializer, CommentSerializer,
@@ -28,8 +27,8 @@ from serializers.serializers import (
     # BranchSerializer,
     UserNoteSerializer,
     FeatureRequestSerializer,
-    NotificationSerializer,
-    UserSerializer,
+    InboxItemSerializer,
+    NotificationSelectionSerializer,
     FileSerializer,
     StagedFileSerializer
     # Commit, UploadedFileVersion
@@ -37,11 +36,18 @@ from serializers.serializers import (
 )
 
 import hashlib
+import hmac
 from .models import (Task, Comment, Room, Message,
                     File, StagedFile, 
                     Branch,
-                     UserNote, FeatureRequest, Notification
+                     UserNote, FeatureRequest, SearchEntry
                      )
+from cowork import dashboard, inbox, metrics, search
+from cowork.db import db_executor
+from cowork.sendqueue import send_queue_stats
+from cowork.replicas import ReplicaReadsMixin, replica_health
+from accounts.usercache import user_cache
+from cowork.autocomplete import room_autocomplete
 import logging
 
 logger = logging.getLogger(__name__)
@@ -65,7 +71,8 @@ class GenerateAPIKeyView(APIView):
         # Create a new API key for the user
         api_key = APIKey.create_for_user(user)
 
-        return Response({"api_key": api_key.key}, status=status.HTTP_201_CREATED)
+        # Only a hash is stored; this is the one time the key is shown.
+        return Response({"api_key": api_key.raw_key}, status=status.HTTP_201_CREATED)
 
 
 
@@ -219,13 +226,13 @@ class RoomCreateJoinView(APIView):
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class RoomDetailView(APIView):
+class RoomDetailView(ReplicaReadsMixin, APIView):
     permission_classes = [IsAuthenticated, IsOwnerOrReadOnly]
 
     def get(self, request, room_slug):
         try:
-            room = Room.objects.get(slug=room_slug)
-            if room.is_private and request.user not in room.users.all():
+            room = Room.objects.with_members().get(slug=room_slug)
+            if room.is_private and request.user not in room.members:
                 return Response({"detail": "You do not have access to this room."}, status=status.HTTP_403_FORBIDDEN)
             serializer = RoomSerializer(room)
             return Response(serializer.data)
@@ -311,7 +318,7 @@ def get_message(request, room_slug):
     return Response({"error": "Invalid request method."}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
 
-class TaskListCreateView(generics.ListCreateAPIView):
+class TaskListCreateView(ReplicaReadsMixin, generics.ListCreateAPIView):
     serializer_class = TaskSerializer
     permission_classes = [permissions.IsAuthenticated]
 
@@ -338,7 +345,7 @@ class TaskListCreateView(generics.ListCreateAPIView):
         context['room'] = room
         return context
     
-class TaskRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
+class TaskRetrieveUpdateDestroyView(ReplicaReadsMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Task.objects.all()
     serializer_class = TaskSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -427,87 +434,118 @@ def like_room(request, room_slug):
 
 
 
-class SearchAPIView(APIView):
+class SearchAPIView(ReplicaReadsMixin, APIView):
+    """
+    Full-text search across the rooms, tasks, messages and files the user
+    can see, best match first.
+
+    Query parameters:
+        q: the search terms (required).
+        type: comma-separated kinds to search, any of room, task, message, file.
+        cursor: the `next` value of the previous page.
+        limit: results per page, capped at SEARCH["MAX_PAGE_SIZE"].
     """
-    Performs a search across multiple models and returns results in JSON format.
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return Response({'error': "The 'q' parameter is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+        kinds = [kind.strip() for kind in request.GET.get('type', '').split(',') if kind.strip()]
+        known = [kind for kind, _ in SearchEntry.KIND_CHOICES]
+        unknown = sorted(set(kinds) - set(known))
+        if unknown:
+            return Response(
+                {'error': f"Unknown type: {', '.join(unknown)}. Choose from: {', '.join(known)}."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
-    Requires authentication.
+        try:
+            page = search.search(
+                request.user, query, kinds, request.GET.get('cursor'), request.GET.get('limit'),
+            )
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(page, status=status.HTTP_200_OK)
 
-    Raises:
-        ValueError: If the 'q' query parameter is not provided in the request.
+
+class RoomAutocompleteView(APIView):
+    """
+    Public rooms whose name or slug has words starting with the words of
+    ?q=, the ones with the most members first. ?limit= is capped at
+    AUTOCOMPLETE["MAX_RESULTS"].
     """
+    permission_classes = [IsAuthenticated]
+
     def get(self, request):
+        max_results = settings.AUTOCOMPLETE["MAX_RESULTS"]
         try:
-            query = request.GET.get('q', '')
-            if not query:
-                raise ValueError("The 'q' parameter is required.")
-
-            all_results = []
-            all_results.extend(Room.objects.filter(Q(name__icontains=query)))
-            # all_results.extend(UploadedFile.objects.filter(Q(file__icontains=query)))
-            # all_results.extend(Task.objects.filter(Q(title__icontains=query)))
-            # # all_results.extend(Branch.objects.filter(Q(original_file__icontains=query)))
-            # all_results.extend(Message.objects.filter(Q(message__icontains=query)))
-
-            paginator = Paginator(all_results, 25)
-            page_number = request.GET.get('page', 1)
-            page_obj = paginator.get_page(page_number)
-
-            serialized_results = []
-            for result in page_obj:
-                if isinstance(result, Room):
-                    serialized_result = {'id': result.id, 'Room name': result.name}
-                # elif isinstance(result, UploadedFile):
-                #     serialized_result = {'id': result.id, 'file': result.file.name}
-                # elif isinstance(result, Task):
-                #     serialized_result = {'id': result.id, 'title': result.title}
-                # elif isinstance(result, Branch):
-                #     serialized_result = {'id': result.id, 'branch': result.original_file.file.name}
-                # elif isinstance(result, Message):
-                #     serialized_result = {'id': result.id, 'message': result.message}
-                else:
-                    serialized_result = {}
-                serialized_results.append(serialized_result)
-
-            return Response({'results': serialized_results}, status=status.HTTP_200_OK)
-
-        except ValidationError as ve:
-            return Response({'error': str(ve)}, status=status.HTTP_400_BAD_REQUEST)
-        
-        except Exception as e:
-            return Response({'error': f"An unexpected error occurred: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            limit = min(int(request.GET.get('limit', max_results)), max_results)
+        except ValueError:
+            return Response({'error': "'limit' must be a number."}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'results': room_autocomplete.lookup(request.GET.get('q', ''), limit)})
+
 
+class NotificationList(ReplicaReadsMixin, generics.ListAPIView):
+    """
+    The user's inbox, newest first, a page at a time. Pass the previous
+    page's `next` as ?before= for the following page, and ?unread=1 for
+    unread items only.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = InboxItemSerializer
 
+    def list(self, request, *args, **kwargs):
+        try:
+            notifications, next_cursor = inbox.notification_page(
+                request.user,
+                before=request.query_params.get('before'),
+                limit=request.query_params.get('limit'),
+                unread_only=request.query_params.get('unread') in ('1', 'true'),
+            )
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'results': self.get_serializer(notifications, many=True).data, 'next': next_cursor})
 
-class NotificationList(generics.ListAPIView):
+
+class UnreadNotificationCount(APIView):
     permission_classes = [IsAuthenticated]
-    serializer_class = NotificationSerializer
 
-    def get_queryset(self):
-        # Get the rooms the authenticated user is part of
-        user_rooms = Room.objects.filter(users=self.request.user)
-        # Filter notifications based on these rooms
-        return Notification.objects.filter(room__in=user_rooms)
+    def get(self, request):
+        return Response({'unread': inbox.unread_count(request.user)})
 
-class NotificationDetail(generics.RetrieveAPIView):
+
+class BulkNotificationAction(APIView):
+    """
+    Marks read or dismisses (soft-deletes) many items of the user's inbox at
+    once: the listed `ids`, those up to an `up_to` timestamp, or all of
+    them. Answers with how many changed and the new unread count.
+    """
     permission_classes = [IsAuthenticated]
-    serializer_class = NotificationSerializer
+    # inbox.mark_read or inbox.dismiss, set in urls.py.
+    change = None
+
+    def post(self, request):
+        serializer = NotificationSelectionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        updated = self.change(request.user, inbox.select(request.user, **serializer.validated_data))
+        return Response({'updated': updated, 'unread': inbox.unread_count(request.user)})
+
+
+class NotificationDetail(ReplicaReadsMixin, generics.RetrieveAPIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = InboxItemSerializer
 
     def get_queryset(self):
-        # Get the rooms the authenticated user is part of
-        user_rooms = Room.objects.filter(users=self.request.user)
-        # Filter notifications based on these rooms
-        return Notification.objects.filter(room__in=user_rooms)
+        return inbox.notifications_for(self.request.user)
 
 class MarkNotificationAsRead(generics.UpdateAPIView):
     permission_classes = [IsAuthenticated]
-    serializer_class = NotificationSerializer
+    serializer_class = InboxItemSerializer
 
     def get_queryset(self):
-        # Get the rooms the authenticated user is part of
-        user_rooms = Room.objects.filter(users=self.request.user)
-        # Filter notifications based on these rooms
-        return Notification.objects.filter(room__in=user_rooms)
+        return inbox.notifications_for(self.request.user)
 
     def patch(self, request, *args, **kwargs):
         try:
@@ -521,33 +559,48 @@ class MarkNotificationAsRead(generics.UpdateAPIView):
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def user_data(request):
-    user = request.user
-
-    # Retrieve rooms joined by the user
-    joined_rooms = user.room_set.all()
-    joined_rooms_serializer = RoomSerializer(joined_rooms, many=True)
-
-    # Retrieve rooms created by the user
-    created_rooms = user.created_rooms.all()
-    created_rooms_serializer = RoomSerializer(created_rooms, many=True)
-
-    # Retrieve tasks assigned to the user along with the room
-    assigned_tasks = Task.objects.filter(assigned_to=user)
-    assigned_tasks_data = TaskSerializer(assigned_tasks, many=True)
+    """
+    The user, their joined and created rooms and their assigned tasks, from
+    the per-user summary in the cache (see cowork/dashboard.py). Pass
+    ?fields=joined_rooms,assigned_tasks to return only some sections.
+    """
+    try:
+        fields = dashboard.parse_fields(request.query_params.get('fields'))
+    except ValueError as e:
+        return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-    # Serialize user data
-    user_serializer = UserSerializer(user)
+    return Response(dashboard.get_dashboard(request.user, fields))
 
-    # Combine all data into a single dictionary
-    user_data = {
-        'user': user_serializer.data,
-        'joined_rooms': joined_rooms_serializer.data,
-        'created_rooms': created_rooms_serializer.data,
-        'assigned_tasks': assigned_tasks_data.data,
-        # Add more data as needed
-    }
 
-    return Response(user_data)
+def metrics_view(request):
+    """
+    This process's metrics (see cowork/metrics.py) in the Prometheus text
+    format. Scrapers send `Authorization: Bearer <METRICS_TOKEN>`; without a
+    token configured the endpoint only exists under DEBUG.
+    """
+    token = settings.METRICS["TOKEN"]
+    if not token and not settings.DEBUG:
+        raise Http404
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        return HttpResponseForbidden()
+
+    gauges = [
+        (f"coloby_send_queue_{name}", f"WebSocket send queues: {name}.", value)
+        for name, value in send_queue_stats().items()
+    ]
+    gauges += [
+        (f"coloby_db_executor_{name}", f"Database executor: {name}.", value)
+        for name, value in db_executor.stats().items()
+    ]
+    gauges += [
+        (f"coloby_user_cache_{name}", f"Authenticated user cache: {name}.", value)
+        for name, value in user_cache.stats().items()
+    ]
+    gauges += [
+        (f"coloby_db_replicas_{name}", f"Read replicas: {name}.", value)
+        for name, value in replica_health.stats().items()
+    ]
+    return HttpResponse(metrics.render(gauges), content_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 class UploadFileView(APIView):
@@ -585,7 +638,7 @@ class StageFileDecisionView(APIView):
             return Response("Invalid decision", status=status.HTTP_400_BAD_REQUEST)
 
 
-class StagedFilesView(APIView):
+class StagedFilesView(ReplicaReadsMixin, APIView):
     def get(self, request, room_slug):
         try:
             staged_files = File.objects.filter(room__slug=room_slug, is_staged=True)
@@ -594,7 +647,7 @@ class StagedFilesView(APIView):
         except Exception as e:
             return Response(str(e), status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-class RoomFilesView(APIView):
+class RoomFilesView(ReplicaReadsMixin, APIView):
     def get(self, request, room_slug):
         try:
             room_files = File.objects.filter(room__slug=room_slug, is_staged=False)
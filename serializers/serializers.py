@@ -13,6 +13,7 @@ from cowork.models import (
     # Branch,
     UserNote, FeatureRequest,
     Notification,
+    InboxItem,
     StagedFile
     #   Commit, UploadedFileVersion
 )
@@ -133,6 +134,12 @@ class CustomUserSerializer(serializers.ModelSerializer):
         model = CustomUser
         fields = ("username", "email", "password")
 
+class UserSummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CustomUser
+        fields = ('id', 'username', 'email')
+
+
 class UserSerializer(serializers.ModelSerializer):
     rooms = serializers.SerializerMethodField()
     created_rooms = serializers.SerializerMethodField()
@@ -143,11 +150,11 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ('id', 'username', 'email', 'rooms', 'created_rooms')
 
     def get_rooms(self, user):
-        rooms = user.room_set.all()
+        rooms = user.room_set.with_members()
         return RoomSerializer(rooms, many=True).data
 
     def get_created_rooms(self, user):
-        created_rooms = user.created_rooms.all()
+        created_rooms = user.created_rooms.with_members()
         return RoomSerializer(created_rooms, many=True).data
 
 
@@ -162,13 +169,20 @@ class RoomSerializer(serializers.ModelSerializer):
         model = Room
         fields = "__all__"
 
+    # Rooms loaded with Room.objects.with_members() carry their members and
+    # member count; anything else falls back to a query per field.
+
     def get_users(self, room):
+        if hasattr(room, 'members'):
+            return [member.username for member in room.members]
         return room.users.values_list('username', flat=True)
 
     def get_created_by(self, room):
         return room.created_by.username if room.created_by else None
 
     def get_total_users(self, room):
+        if hasattr(room, 'total_users'):
+            return room.total_users
         return room.users.count()
 
     def remove_user(self, username, requester):
@@ -307,3 +321,58 @@ class NotificationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Notification
         fields = ['id', 'room', 'sender', 'message', 'timestamp', 'is_read']
+
+
+class InboxItemSerializer(serializers.ModelSerializer):
+    """
+    A notification as it appears in one user's inbox.
+    """
+    room = serializers.IntegerField(source='notification.room_id', read_only=True)
+    sender = serializers.UUIDField(source='notification.sender_id', read_only=True)
+    message = serializers.CharField(source='notification.message', read_only=True)
+
+    class Meta:
+        model = InboxItem
+        fields = ['id', 'room', 'sender', 'message', 'timestamp', 'is_read']
+        read_only_fields = ['timestamp']
+
+
+class NotificationSelectionSerializer(serializers.Serializer):
+    """
+    Picks the notifications a bulk action applies to: the listed `ids`,
+    everything up to and including `up_to`, or, with neither, all of them.
+    """
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False, allow_empty=False, max_length=1000)
+    up_to = serializers.DateTimeField(required=False)
+
+    def validate(self, attrs):
+        if 'ids' in attrs and 'up_to' in attrs:
+            raise serializers.ValidationError("Pass either ids or up_to, not both.")
+        return attrs
+
+
+# Validators for the events NotificationConsumer accepts, see cowork/notifications.py.
+# They only check the frame's shape; the ids are checked when the rows are written.
+
+class MessageEventSerializer(serializers.Serializer):
+    message = serializers.CharField()
+    sender_id = serializers.UUIDField()
+
+
+class TaskEventSerializer(serializers.Serializer):
+    task_title = serializers.CharField(max_length=100)
+    creator_id = serializers.UUIDField()
+    description = serializers.CharField(required=False, allow_blank=True, default="")
+    due_date = serializers.DateField(required=False)
+    assigned_to_id = serializers.UUIDField(required=False)
+
+
+class FileUploadEventSerializer(serializers.Serializer):
+    file_name = serializers.CharField(max_length=255)
+    uploader_id = serializers.UUIDField()
+
+
+class BranchActivityEventSerializer(serializers.Serializer):
+    branch_name = serializers.CharField(max_length=255)
+    actor_id = serializers.UUIDField()
+    activity = serializers.CharField(max_length=50, required=False, default="updated")